@@ -1,18 +1,44 @@
 import os
+import asyncio
+import bisect
+import contextlib
+import fcntl
+import functools
 import json
+import random
+import re
 import sys
-from datetime import datetime, timedelta
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 import uuid
 import io # <-- لإدارة البايتات
+import mmap
+import queue
 import hashlib # <-- لحساب الهاش
+import heapq
+import itertools
+import zlib
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.util import identity_key
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv # <-- لتحميل متغيرات البيئة
-from PIL import Image # <-- لمعالجة الصور
+from PIL import Image, ImageSequence # <-- لمعالجة الصور
 import google.generativeai as genai # <-- مكتبة Gemini
+try:
+    import cv2 # <-- اختياري: لاستخراج الإطارات من تسجيلات الشاشة (mp4/mov/webm)
+except ImportError:
+    cv2 = None
+try:
+    import brotli # <-- اختياري: ترميز br لضغط الاستجابات (وإلا gzip فقط)
+except ImportError:
+    brotli = None
 
 # --- Load Environment Variables ---
 load_dotenv()
@@ -20,7 +46,7 @@ print("Attempting to load environment variables...") # Debug print
 
 # --- تحديد المسارات ---
 persistent_data_dir = '/tmp' # أو المسار المناسب لبيئتك (للإنتاج، استخدم مسار دائم)
-db_path = os.path.join(persistent_data_dir, 'databases5.db') # تم تغيير اسم قاعدة البيانات لضمان إنشاء جديد إذا لزم الأمر
+db_path = os.environ.get('DATABASE_PATH') or os.path.join(persistent_data_dir, 'databases5.db') # تم تغيير اسم قاعدة البيانات لضمان إنشاء جديد إذا لزم الأمر
 UPLOAD_FOLDER = os.path.join(persistent_data_dir, 'uploads')
 db_dir = os.path.dirname(db_path) # مجلد قاعدة البيانات
 
@@ -48,7 +74,10 @@ db = SQLAlchemy(app)
 
 # --- Configure Gemini API ---
 GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
-gemini_model = None
+GEMINI_STRONG_MODEL_NAME = os.environ.get('GEMINI_STRONG_MODEL', 'gemini-1.5-flash')
+GEMINI_FAST_MODEL_NAME = os.environ.get('GEMINI_FAST_MODEL', 'gemini-1.5-flash-8b') # اتركه فارغًا لتعطيل المستوى السريع
+gemini_model = None # النموذج الأقوى (المستوى الأخير في سلسلة التحقق)
+gemini_fast_model = None # المستوى الأول الأرخص والأسرع
 
 if not GOOGLE_API_KEY:
     print("ERROR: GOOGLE_API_KEY not found in environment variables (.env file). Image analysis will be disabled.")
@@ -56,8 +85,10 @@ else:
     try:
         print("Configuring Gemini API...")
         genai.configure(api_key=GOOGLE_API_KEY)
-        gemini_model = genai.GenerativeModel('gemini-1.5-flash') # تم التغيير إلى فلاش الأحدث
-        print("Gemini Model configured successfully.")
+        gemini_model = genai.GenerativeModel(GEMINI_STRONG_MODEL_NAME) # تم التغيير إلى فلاش الأحدث
+        if GEMINI_FAST_MODEL_NAME:
+            gemini_fast_model = genai.GenerativeModel(GEMINI_FAST_MODEL_NAME)
+        print(f"Gemini Model configured successfully (strong: {GEMINI_STRONG_MODEL_NAME}, fast: {GEMINI_FAST_MODEL_NAME or 'disabled'}).")
     except Exception as e:
         print(f"ERROR configuring Gemini API: {e}. Image analysis will be disabled.")
         gemini_model = None
@@ -78,6 +109,18 @@ COMMENT_DETECTION_PROMPT = """Analyze this social media screenshot (like TikTok,
 SHARE_DETECTION_PROMPT = """Analyze this social media screenshot (like TikTok, Instagram, Facebook). Focus ONLY on the share button/icon (e.g., arrow, paper plane) or any text indicating a share action related to the main post. Determine if the post appears to have been shared by the user who took the screenshot (look for a highlighted or altered share icon, or text like 'Shared'). Respond with ONLY the single digit '1' if the post appears to have been shared. Respond with ONLY the single digit '0' if the post does not appear to have been shared. Do not provide any other text, explanation, or formatting."""
 SUBSCRIBE_DETECTION_PROMPT = """Analyze this social media screenshot (e.g., YouTube, Twitch, etc.). Focus ONLY on the primary subscribe button/icon or text indicating subscription status to the channel/creator featured in the screenshot. Determine if the user who took the screenshot appears to be subscribed to this channel/creator (look for a button that says 'Subscribed', 'Unsubscribe', a highlighted bell icon next to a subscribe button, or similar indicators of an active subscription). Respond with ONLY the single digit '1' if the user appears to be subscribed. Respond with ONLY the single digit '0' if the user appears to be *not* subscribed (e.g., button says 'Subscribe'). Do not provide any other text, explanation, or formatting."""
 
+# يُضاف قبل التعليمات عند إرسال أكثر من صورة (أو إطارات تسجيل شاشة) في طلب واحد
+MULTI_IMAGE_PROMPT_PREFIX = """You are given {count} images: screenshots, or frames sampled from one screen recording, that TOGETHER document a single user action (for example one image shows the post state and another shows the comments section).
+Evaluate them as one piece of evidence: the action counts as detected if the combined images clearly show it.
+Apply the following instructions to the whole set and respond with a single verdict.
+
+"""
+
+# يُضاف إلى كل طلب تحقق حتى يعيد النموذج درجة ثقة مع الحكم (تُستخدم لتوجيه سلسلة التحقق)
+CONFIDENCE_PROMPT_SUFFIX = """
+
+Output format override: respond with the single digit verdict ('1' or '0'), then a space, then your confidence that this verdict is correct as an integer from 0 to 100. Example: '1 93'. Do not provide any other text."""
+
 # --- Storage for Processed Image Hashes (In-Memory) ---
 # !!! هام: هذا الـ Set سيفقد محتوياته عند إعادة تشغيل السيرفر !!!
 # للحل الدائم، استخدم قاعدة بيانات. سيخزن الآن أزواجًا: (user_id, image_hash)
@@ -92,6 +135,109 @@ COIN_VALUES = {
     "subscribe": 12
 }
 POSSIBLE_ACTION_TYPES = set(COIN_VALUES.keys())
+# رموز أنواع الإجراءات في user_ad_action_archive: لا تُغيّر الأرقام الموجودة، أضف نوعًا جديدًا برقم جديد
+ACTION_TYPE_CODES = {"like": 1, "comment": 2, "share": 3, "subscribe": 4}
+ACTION_TYPES_BY_CODE = {code: action_type for action_type, code in ACTION_TYPE_CODES.items()}
+
+# --- سلسلة التحقق (verification cascade) لكل نوع في COIN_VALUES ---
+# النموذج السريع أولًا؛ إذا كانت ثقته أقل من العتبة يُصعَّد الطلب إلى النموذج الأقوى.
+# None = تجاوز المستوى السريع لهذا النوع والذهاب مباشرة للنموذج الأقوى.
+VERIFICATION_ESCALATE_BELOW = {
+    "like": 0.85,
+    "comment": 0.90, # مطابقة اسم المستخدم أصعب على النموذج الصغير
+    "share": 0.85,
+    "subscribe": 0.85
+}
+
+# --- مكافآت الإحالة حسب المستوى ---
+# المستوى 1 = المحيل المباشر (100 كما كان دائمًا). المستويات الأعلى اختيارية ومعطلة افتراضيًا:
+# REFERRAL_UPLINE_BONUSES="20,5" تمنح محيل المحيل 20 والمستوى الثالث 5.
+REFERRAL_BONUS_BY_LEVEL = [100] + [int(bonus) for bonus in os.environ.get('REFERRAL_UPLINE_BONUSES', '').split(',') if bonus.strip()]
+MAX_REFERRAL_DEPTH = 10 # الحد الأقصى لعمق استعلامات شجرة الإحالة
+
+# --- عجلة الحظ ---
+SPIN_COOLDOWN = timedelta(hours=24)
+# تُستخدم فقط عندما لا توجد جوائز نشطة في جدول spin_prize: (label, coins, weight)
+DEFAULT_SPIN_PRIZES = [("10 coins", 10, 50), ("20 coins", 20, 30), ("50 coins", 50, 15), ("100 coins", 100, 5)]
+SPIN_PRIZE_TABLE_TTL_SECONDS = 30 # عمال gunicorn الآخرون يلتقطون تعديلات المشرف خلال هذه المدة
+
+# --- العمليات الجماعية للمشرف ---
+BULK_CHUNK_SIZE = 500 # عدد العناصر في كل معاملة (أقل من حد متغيرات SQLite)
+BULK_MAX_ITEMS = 10000 # الحد الأقصى للعناصر في طلب واحد
+
+# --- المنظف الخلفي للإعلانات المحذوفة (حذف user_ad_action على دفعات صغيرة) ---
+AD_PURGER_ENABLED = os.environ.get('AD_PURGER_ENABLED', '1') != '0'
+PURGE_BATCH_SIZE = 2000 # حجم الدفعة الابتدائي؛ يتكيف ليبقى زمن كل معاملة قرب PURGE_BATCH_TARGET_SECONDS
+PURGE_MIN_BATCH_SIZE = 100
+PURGE_MAX_BATCH_SIZE = 20000
+PURGE_BATCH_TARGET_SECONDS = 0.05 # أقصى زمن مرغوب لحجز قفل الكتابة في كل دفعة
+PURGE_PAUSE_SECONDS = 0.02 # استراحة بين الدفعات لإتاحة الفرصة للكتّاب الآخرين
+PURGE_POLL_SECONDS = 30 # لالتقاط مهام أنشأها عمال آخرون
+PURGE_MAX_ATTEMPTS = 3
+PURGE_RETRY_BACKOFF = timedelta(minutes=1) # تتضاعف مع كل محاولة فاشلة
+PURGE_CLAIM_STALE = timedelta(minutes=2) # مهمة running بدون heartbeat لهذه المدة (عامل مات) يأخذها عامل آخر
+
+# --- أرشفة user_ad_action: الصفوف الأقدم من هذا العمر تُنقل إلى user_ad_action_archive ---
+ACTION_ARCHIVE_ENABLED = os.environ.get('ACTION_ARCHIVE_ENABLED', '1') != '0'
+ACTION_ARCHIVE_AGE = timedelta(days=int(os.environ.get('ACTION_ARCHIVE_AGE_DAYS', '90'))) # أكبر من AD_TOMBSTONE_RETENTION
+ACTION_ARCHIVE_BATCH = 2000 # صفوف في كل معاملة
+ACTION_ARCHIVE_SECONDS = 3600 # فترة تشغيل الأرشفة في الخلفية
+ACTION_ARCHIVE_LEASE = timedelta(seconds=ACTION_ARCHIVE_SECONDS * 2) # عامل واحد يؤرشف؛ عقد عامل متوقف ينتهي بعد هذه المدة
+
+# --- جدولة الإعلانات: خيط لكل عامل يقلب is_active عند starts_at/ends_at ---
+AD_SCHEDULE_ENABLED = os.environ.get('AD_SCHEDULE_ENABLED', '1') != '0'
+AD_SCHEDULE_HEAP_SIZE = 1000 # أقرب الانتقالات المحمّلة في الذاكرة من كل فهرس
+AD_SCHEDULE_POLL_SECONDS = 5 # أقصى نوم بين فحصين لـ catalog_version (جدولة من عامل آخر)
+
+# --- ضغط الاستجابات (gzip/br حسب Accept-Encoding) وبث قوائم JSON الكبيرة ---
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', '1') != '0'
+COMPRESSION_MIN_BYTES = 1024 # أصغر من ذلك: ترويسات الضغط وزمن المعالج لا يستحقان التوفير
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '5')) # 6+ يضاعف زمن المعالج تقريبًا مقابل 1-2% حجم على JSON
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '4')) # أصغر من gzip-5 وبزمن مقارب؛ 10-11 للملفات الثابتة فقط
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/plain', 'text/html', 'text/csv'} # text/event-stream مستثنى عمدًا
+STREAM_JSON_BATCH_ROWS = 500 # صفوف في كل استعلام أثناء بث القائمة (قفل القراءة لا يُحجز طوال البث)
+STREAM_JSON_CHUNK_BYTES = 16 * 1024 # حجم كل جزء يُرسل (ويُضغط ثم يُفرَّغ) أثناء البث
+
+# --- مخزن لقطات الشاشة (content-addressed) تحت UPLOAD_FOLDER ---
+SCREENSHOT_STORE_ENABLED = os.environ.get('SCREENSHOT_STORE_ENABLED', '1') != '0'
+SCREENSHOT_STORE_MAX_BYTES = int(os.environ.get('SCREENSHOT_STORE_MAX_MB', '5120')) * 1024 * 1024
+SCREENSHOT_STORE_MAX_AGE = timedelta(days=int(os.environ.get('SCREENSHOT_STORE_MAX_AGE_DAYS', '180')))
+SCREENSHOT_EVICTION_SECONDS = 3600 # فترة تشغيل الإخلاء في الخلفية
+SCREENSHOT_EVICTION_BATCH = 500
+
+# --- مفاتيح Idempotency-Key لمسارات التحليل والنقر ---
+IDEMPOTENCY_TTL = timedelta(hours=int(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))) # مدة الاحتفاظ بالاستجابة المحفوظة
+IDEMPOTENCY_LOCK_TIMEOUT = timedelta(seconds=120) # أقصى مدة متوقعة لطلب أصلي قيد التنفيذ
+IDEMPOTENCY_WAIT_SECONDS = 60 # مدة انتظار الطلب المكرر للطلب الأصلي قبل إرجاع 409 (asgi.py: الانتظار لا يحجز خيطًا)
+IDEMPOTENCY_SYNC_WAIT_SECONDS = 2 # عمال gunicorn المتزامنون: الانتظار يحجز العامل كله، فنعيد 409 + Retry-After سريعًا
+IDEMPOTENCY_RETRY_AFTER_SECONDS = 2
+IDEMPOTENCY_POLL_SECONDS = 0.25
+IDEMPOTENCY_CLEANUP_SECONDS = 300 # حذف السجلات المنتهية مرة كل هذه المدة على الأكثر لكل عامل
+
+# --- فهرس التفاعلات في الذاكرة (bitsets) ---
+INTERACTION_INDEX_SYNC_SECONDS = 1.0 # أقصى تأخر في رؤية كتابات العمال الآخرين
+INTERACTION_INDEX_SYNC_SLACK = timedelta(seconds=2) # تداخل نافذة updated_at لتفادي فقدان كتابات بنفس الطابع الزمني
+AD_CATALOG_CHECK_SECONDS = 1.0 # أقصى تأخر في رؤية رفع catalog_version أو النقرات من العمال الآخرين
+
+# --- المزامنة التزايدية لقوائم الإعلانات (?since=<watermark>) ---
+AD_SYNC_SLACK = INTERACTION_INDEX_SYNC_SLACK # العلامة المعادة تتأخر بهذا القدر عن الآن؛ التطبيق يدمج بالـ id لذا التكرار غير ضار
+AD_TOMBSTONE_RETENTION = timedelta(days=int(os.environ.get('AD_TOMBSTONE_RETENTION_DAYS', '30'))) # أقدم since مقبول
+
+# --- بث أحداث المستخدم (SSE على /users/<id>/events) ---
+EVENT_BUS_POLL_SECONDS = 0.5 # أقصى تأخر في رؤية أحداث نشرها عامل آخر
+EVENT_BUS_BATCH = 500
+EVENT_STREAM_HEARTBEAT_SECONDS = 15 # تعليق keepalive حتى لا تغلق الـ proxies الاتصال الخامل
+EVENT_STREAM_MAX_SECONDS = 300 # يُغلق البث بعدها ويعيد العميل الاتصال بـ Last-Event-ID (تحرير خيط العامل)
+EVENT_STREAM_RETRY_MS = 3000
+EVENT_REPLAY_LIMIT = 500 # أقصى أحداث تُعاد عند الاستئناف في اتصال واحد
+EVENT_SUBSCRIBER_QUEUE_SIZE = 256
+EVENT_RETENTION = timedelta(hours=int(os.environ.get('EVENT_RETENTION_HOURS', '24'))) # أقدم حدث يمكن الاستئناف منه
+
+# --- لوحة الصدارة (الرصيد الكلي وأرباح الأسبوع) ---
+LEADERBOARD_SIZE = 100 # أقصى limit في GET /leaderboard
+LEADERBOARD_BUFFER = 50 # صفوف إضافية تُحمّل حتى لا يترك تراجع مستخدم محليًا فراغًا في القائمة
+LEADERBOARD_REFRESH_SECONDS = 10 # أقصى تأخر في رؤية تغييرات العمال الآخرين والتعديلات الإدارية
+LEADERBOARD_MAX_LOCAL_MOVES = 1000 # بعدها يُعاد التحميل قبل انتهاء المدة
 
 # --- (أعلى الملف مع بقية تعريفات الموديلات) ---
 
@@ -123,6 +269,13 @@ class CoinPackage(db.Model):
     def __repr__(self):
         return f'<CoinPackage {self.id} - {self.name} ({self.amount} coins)>'
 
+# --- تطبيع حقول البحث عن المستخدمين (أعمدة search_* في User) ---
+def normalize_search_text(value):
+    return ' '.join((value or '').casefold().split())
+
+def normalize_phone(value):
+    return re.sub(r'\D', '', value or '')
+
 # --- (بعد تعريف الموديل، وقبل db.create_all() إذا كنت ستشغلها يدويًا) ---
 # --- تعريف موديل المستخدم (User Model) ---
 class User(db.Model):
@@ -130,16 +283,30 @@ class User(db.Model):
     name = db.Column(db.String(80), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False, index=True)
     phone_number = db.Column(db.String(20), nullable=False)
+    # نسخ مطبّعة لبحث المشرف (تُحدّث تلقائيًا عند تعيين name/email/phone_number)
+    search_name = db.Column(db.String(80), nullable=True, index=True)
+    search_email = db.Column(db.String(120), nullable=True, index=True)
+    search_phone = db.Column(db.String(20), nullable=True, index=True)
     password_hash = db.Column(db.String(128), nullable=False)
     interests = db.Column(db.Text, nullable=True)
     coins = db.Column(db.Integer, nullable=False, default=0)
     referrer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
     referred_by_me_ids = db.Column(db.Text, nullable=True)
     last_spin_time = db.Column(db.DateTime, nullable=True)
-    advertisements = db.relationship('Advertisement', backref='advertiser', lazy=True, order_by="Advertisement.created_at.desc()")
+    advertisements = db.relationship('Advertisement', backref='advertiser', lazy=True, order_by="Advertisement.created_at.desc()",
+                                     primaryjoin="and_(User.id == Advertisement.user_id, Advertisement.deleted_at.is_(None))")
+
+    __table_args__ = (db.Index('ix_user_coins', db.text('coins DESC'), 'id'),) # لوحة الصدارة والمدرج التكراري للترتيب
     # علاقة جديدة مع UserAdAction
     # ad_actions = db.relationship('UserAdAction', backref='user', lazy='dynamic') # تم تعريفها في UserAdAction
 
+    @db.validates('name', 'email', 'phone_number')
+    def _update_search_fields(self, key, value):
+        if key == 'name': self.search_name = normalize_search_text(value)
+        elif key == 'email': self.search_email = normalize_search_text(value)
+        else: self.search_phone = normalize_phone(value)
+        return value
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
@@ -218,10 +385,24 @@ class Advertisement(db.Model):
     category = db.Column(db.String(80), nullable=True, index=True)
     subcategory = db.Column(db.String(80), nullable=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     is_active = db.Column(db.Boolean, nullable=False, default=True)
     is_approved = db.Column(db.Boolean, nullable=False, default=False, index=True)
     clicked_by_user_ids = db.Column(db.Text, nullable=True) # مستخدمون نقروا على الرابط
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True) # حذف ناعم: يختفي فورًا ثم يحذفه المنظف في الخلفية
+    # جدولة اختيارية (UTC): ad_schedule_sweeper يقلب is_active عند starts_at و ends_at
+    starts_at = db.Column(db.DateTime, nullable=True)
+    ends_at = db.Column(db.DateTime, nullable=True)
+
+    # فهارس جزئية على الإعلانات الحية فقط (نفس شرط live_advertisements())؛ انظر HOT_QUERY_PLANS
+    __table_args__ = (
+        db.Index('ix_advertisement_live_approved_created', 'is_approved', 'created_at',
+                 sqlite_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_advertisement_live_user_created', 'user_id', 'created_at',
+                 sqlite_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_advertisement_starts_at', 'starts_at', sqlite_where=db.text('starts_at IS NOT NULL')),
+        db.Index('ix_advertisement_ends_at', 'ends_at', sqlite_where=db.text('ends_at IS NOT NULL')),
+    )
     # علاقة جديدة مع UserAdAction
     # user_actions = db.relationship('UserAdAction', backref='advertisement', lazy='dynamic') # تم تعريفها في UserAdAction
 
@@ -281,9 +462,14 @@ class Advertisement(db.Model):
             "updated_at": self.updated_at.isoformat() if self.updated_at else None,
             "is_active": self.is_active,
             "is_approved": self.is_approved,
-            "clicked_by_user_ids": self.get_clicked_by_user_ids()
+            "clicked_by_user_ids": self.get_clicked_by_user_ids(),
+            "starts_at": self.starts_at.isoformat() if self.starts_at else None,
+            "ends_at": self.ends_at.isoformat() if self.ends_at else None
         }
 
+    def in_schedule_window(self, now):
+        return (self.starts_at is None or self.starts_at <= now) and (self.ends_at is None or self.ends_at > now)
+
     def __repr__(self):
         return f'<Advertisement {self.id} - {self.title} by User {self.user_id}>'
 
@@ -298,7 +484,12 @@ class UserAdAction(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     # لضمان عدم تكرار نفس الإجراء من نفس المستخدم على نفس الإعلان
-    __table_args__ = (db.UniqueConstraint('user_id', 'advertisement_id', 'action_type', name='uq_user_ad_action'),)
+    # القيد الفريد يغطي أيضًا WHERE user_id = ? مع إسقاط advertisement_id, action_type
+    __table_args__ = (db.UniqueConstraint('user_id', 'advertisement_id', 'action_type', name='uq_user_ad_action'),
+                      db.Index('ix_user_ad_action_user_created', 'user_id', 'created_at', 'id', 'action_type', 'advertisement_id'),
+                      db.Index('ix_user_ad_action_created', 'created_at'), # مسح الأرشفة (created_at < cutoff)
+                      # AUTOINCREMENT: بعد نقل أحدث الصفوف للأرشيف أو حذفها لا يُعاد استخدام id (فهرس التفاعلات يقرأ id > watermark)
+                      {'sqlite_autoincrement': True})
 
     user = db.relationship('User', backref=db.backref('ad_actions', lazy='dynamic'))
     advertisement = db.relationship('Advertisement', backref=db.backref('user_actions', lazy='dynamic'))
@@ -307,21 +498,702 @@ class UserAdAction(db.Model):
         return f'<UserAdAction User {self.user_id} {self.action_type} Ad {self.advertisement_id}>'
 
 
+# --- موديل UserAdActionArchive: الأرشيف البارد لـ user_ad_action ---
+# جدول WITHOUT ROWID مفتاحه (user_id, advertisement_id, action_code): الصفوف مخزنة في كتل مرتبة بالمعرفات
+# داخل B-tree المفتاح نفسه (بدون rowid ولا فهرس فريد منفصل)، ونوع الإجراء رقم من ACTION_TYPE_CODES
+# و created_at ثوانٍ unix. المفتاح نفسه يضمن uq_user_ad_action للصفوف المؤرشفة.
+class UserAdActionArchive(db.Model):
+    __tablename__ = 'user_ad_action_archive'
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    advertisement_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    action_code = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    id = db.Column(db.Integer, nullable=False) # id الأصلي في user_ad_action
+    created_epoch = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (db.Index('ix_user_ad_action_archive_ad', 'advertisement_id'), {'sqlite_with_rowid': False})
+
+# --- موديل Referral: جدول حواف الإحالة (referrer -> referred) ---
+# مصدر الحقيقة لشجرة الإحالات. مفهرس على الطرفين حتى تكون استعلامات الشجرة
+# (للأسفل والأعلى) معتمدة على الفهرس بدلاً من فك JSON لكل مستخدم.
+class Referral(db.Model):
+    __tablename__ = 'referral'
+    id = db.Column(db.Integer, primary_key=True)
+    referrer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    referred_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True) # لكل مستخدم محيل واحد فقط
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            "referrer_id": self.referrer_id,
+            "referred_id": self.referred_id,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+        }
+
+    def __repr__(self):
+        return f'<Referral {self.referrer_id} -> {self.referred_id}>'
+
+
+# --- موديلات عجلة الحظ: جدول الجوائز (قابل للتعديل من المشرف) وسجل الدورات ---
+class SpinPrize(db.Model):
+    __tablename__ = 'spin_prize'
+    id = db.Column(db.Integer, primary_key=True)
+    label = db.Column(db.String(100), nullable=False)
+    coins = db.Column(db.Integer, nullable=False, default=0) # عدد العملات الممنوحة
+    weight = db.Column(db.Integer, nullable=False, default=1) # الوزن النسبي لاحتمال الجائزة
+    is_active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "label": self.label,
+            "coins": self.coins,
+            "weight": self.weight,
+            "is_active": self.is_active,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+    def __repr__(self):
+        return f'<SpinPrize {self.id} - {self.label} ({self.coins} coins, weight {self.weight})>'
+
+# --- موديل AdvertisementPurge: مهام الحذف التدريجي لإعلانات محذوفة حذفًا ناعمًا ---
+class AdvertisementPurge(db.Model):
+    __tablename__ = 'advertisement_purge'
+    id = db.Column(db.Integer, primary_key=True)
+    advertisement_id = db.Column(db.Integer, nullable=False, index=True) # بدون FK: صف الإعلان يُحذف في نهاية المهمة
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True) # pending | running | done | failed
+    actions_total = db.Column(db.Integer, nullable=True)
+    actions_deleted = db.Column(db.Integer, nullable=False, default=0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    owner = db.Column(db.String(80), nullable=True) # العامل الذي يملك المهمة (host:pid) أثناء running
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    next_attempt_at = db.Column(db.DateTime, nullable=True) # بعد فشل: لا تُعاد المحاولة قبل هذا الوقت
+    requested_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "advertisement_id": self.advertisement_id,
+            "status": self.status,
+            "actions_total": self.actions_total,
+            "actions_deleted": self.actions_deleted,
+            "progress": (min(1.0, self.actions_deleted / self.actions_total) if self.actions_total else (1.0 if self.status == 'done' else 0.0)),
+            "attempts": self.attempts,
+            "last_error": self.last_error,
+            "owner": self.owner,
+            "next_attempt_at": self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            "requested_at": self.requested_at.isoformat() if self.requested_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    def __repr__(self):
+        return f'<AdvertisementPurge Ad {self.advertisement_id} {self.status} ({self.actions_deleted}/{self.actions_total})>'
+
+# --- موديل WorkerLease: عقد باسم مهمة خلفية حتى يشغلها عامل واحد فقط بين كل العمليات ---
+class WorkerLease(db.Model):
+    __tablename__ = 'worker_lease'
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(80), nullable=False) # host:pid (background_worker_id)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<WorkerLease {self.name} {self.owner} until {self.expires_at}>'
+
+# --- موديل IdempotencyRecord: استجابات محفوظة لمفاتيح Idempotency-Key ---
+class IdempotencyRecord(db.Model):
+    __tablename__ = 'idempotency_record'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    idempotency_key = db.Column(db.String(255), nullable=False)
+    fingerprint = db.Column(db.String(64), nullable=False) # sha256 للطلب (المسار + الحقول + هاش الملفات)
+    status = db.Column(db.String(20), nullable=False, default='in_progress') # in_progress | completed
+    response_status = db.Column(db.Integer, nullable=True)
+    response_headers = db.Column(db.Text, nullable=True) # JSON: [[name, value], ...]
+    response_body = db.Column(db.LargeBinary, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime, nullable=True) # بعده يُعتبر الطلب الأصلي متوقفًا (عامل انهار) ويمكن إعادة تنفيذه
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (db.UniqueConstraint('user_id', 'idempotency_key', name='uq_idempotency_user_key'),)
+
+    def __repr__(self):
+        return f'<IdempotencyRecord User {self.user_id} {self.idempotency_key} {self.status}>'
+
+# --- موديلات مخزن لقطات الشاشة وسجل قرارات التحقق ---
+class ScreenshotBlob(db.Model):
+    """بيانات وصفية لملف في ScreenshotStore (الملف نفسه على القرص تحت UPLOAD_FOLDER)."""
+    __tablename__ = 'screenshot_blob'
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size_bytes = db.Column(db.Integer, nullable=False)
+    media_type = db.Column(db.String(100), nullable=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=1) # عدد الإرسالات (عبر المستخدمين والمهام) التي استخدمت الملف
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_referenced_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def to_dict(self):
+        return {
+            "sha256": self.sha256,
+            "size_bytes": self.size_bytes,
+            "media_type": self.media_type,
+            "ref_count": self.ref_count,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "last_referenced_at": self.last_referenced_at.isoformat() if self.last_referenced_at else None,
+        }
+
+class VerificationRecord(db.Model):
+    """قرار تحقق واحد (0/1) مع هاشات الملفات المرسلة، لإعادة التدقيق والنزاعات."""
+    __tablename__ = 'verification_record'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    advertisement_id = db.Column(db.Integer, nullable=False, index=True)
+    action_type = db.Column(db.String(50), nullable=False)
+    verdict = db.Column(db.Integer, nullable=False) # 1 = الإجراء مكتشف، 0 = غير مكتشف
+    confidence = db.Column(db.Float, nullable=True)
+    verified_by = db.Column(db.String(20), nullable=True) # fast | strong
+    model_name = db.Column(db.String(100), nullable=True)
+    image_hashes = db.Column(db.Text, nullable=False) # JSON list of sha256
+    prompt_params = db.Column(db.Text, nullable=True) # JSON (مثال: username لمهمة التعليق)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_verification_record_action_created', 'action_type', 'created_at'),)
+
+    def get_image_hashes(self):
+        try:
+            hashes = json.loads(self.image_hashes) if self.image_hashes else []
+            return hashes if isinstance(hashes, list) else []
+        except json.JSONDecodeError:
+            return []
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "advertisement_id": self.advertisement_id,
+            "action_type": self.action_type,
+            "verdict": self.verdict,
+            "confidence": self.confidence,
+            "verified_by": self.verified_by,
+            "model_name": self.model_name,
+            "image_hashes": self.get_image_hashes(),
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+        }
+
+class SpinHistory(db.Model):
+    __tablename__ = 'spin_history'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    prize_id = db.Column(db.Integer, nullable=True) # None = جائزة افتراضية (DEFAULT_SPIN_PRIZES)
+    coins = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_spin_history_user_created', 'user_id', 'created_at', 'id', 'coins'),)
+
+    def __repr__(self):
+        return f'<SpinHistory User {self.user_id} +{self.coins}>'
+
+# --- موديل AdvertisementTombstone: سجل الإعلانات المحذوفة للمزامنة التزايدية ---
+# يبقى بعد أن يحذف المنظف صف الإعلان، حتى تعرف التطبيقات (عبر ?since=) أن الإعلان حُذف.
+class AdvertisementTombstone(db.Model):
+    __tablename__ = 'advertisement_tombstone'
+    advertisement_id = db.Column(db.Integer, primary_key=True)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+# --- رقم إصدار كتالوج الإعلانات الموافق عليها (صف واحد id=1) ---
+# يُرفع في نفس معاملة أي كتابة إدارية تغير مجموعة الإعلانات (إضافة/موافقة/رفض/حذف)،
+# وكل عامل يعيد بناء نسخته من الكتالوج عندما يتغير.
+class CatalogVersion(db.Model):
+    __tablename__ = 'catalog_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+# --- موديل UserEvent: سجل الأحداث المنشورة (الوسيط بين عمال gunicorn ومصدر معرفات SSE) ---
+class UserEvent(db.Model):
+    __tablename__ = 'user_event'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=True) # None = حدث لكل المستخدمين
+    event_type = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    # AUTOINCREMENT: بعد أن يفرغ _prune_user_events الجدول لا يعيد SQLite استخدام id أقل من مؤشر الموزع أو Last-Event-ID
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def to_sse(self):
+        return f"id: {self.id}\nevent: {self.event_type}\ndata: {self.payload}\n\n"
+
+# --- موديل WeeklyEarnings: أرباح كل مستخدم لكل أسبوع (يبدأ الاثنين UTC) للوحة الصدارة الأسبوعية ---
+class WeeklyEarnings(db.Model):
+    __tablename__ = 'weekly_earnings'
+    week_start = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    coins = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (db.Index('ix_weekly_earnings_week_coins', 'week_start', db.text('coins DESC'), 'user_id'),)
+
+# --- موديل UserEarnings: ملخص أرباح كل مستخدم لكل مصدر (أنواع COIN_VALUES، spin، ad_click، referral) ---
+# يُحدّث في نفس معاملة منح العملات (record_earnings) بدل تجميعه عند القراءة.
+class UserEarnings(db.Model):
+    __tablename__ = 'user_earnings'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    source = db.Column(db.String(50), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    coins = db.Column(db.Integer, nullable=False, default=0)
+
+# --- موديل AdClick: سجل نقرات روابط الإعلانات (النقر نفسه ومكافأة المعلن) ---
+class AdClick(db.Model):
+    __tablename__ = 'ad_click'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) # من نقر
+    advertisement_id = db.Column(db.Integer, nullable=False) # بدون FK: السجل يبقى بعد أن يحذف المنظف الإعلان
+    advertiser_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    coins = db.Column(db.Integer, nullable=False, default=0) # الممنوحة للمعلن
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_ad_click_user_created', 'user_id', 'created_at', 'id', 'advertisement_id'),
+                      db.Index('ix_ad_click_advertiser_created', 'advertiser_id', 'created_at', 'id', 'advertisement_id', 'coins'))
+
+# --- موديل ImportJob: تقدم الاستيراد الجماعي (bulk_import.py) ---
+# records_done يُحدّث في نفس معاملة كل دفعة، فالاستئناف بعد أي انقطاع لا يكرر ولا يفقد سجلات.
+class ImportJob(db.Model):
+    __tablename__ = 'import_job'
+    name = db.Column(db.String(255), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False) # users | ads | actions
+    source = db.Column(db.Text, nullable=False)
+    records_done = db.Column(db.Integer, nullable=False, default=0) # سجلات المصدر المقروءة (المرفوضة ضمنها)
+    inserted = db.Column(db.Integer, nullable=False, default=0)
+    duplicates = db.Column(db.Integer, nullable=False, default=0)
+    rejected = db.Column(db.Integer, nullable=False, default=0)
+    deferred_ddl = db.Column(db.Text, nullable=True) # JSON: فهارس/triggers أُسقطت مؤقتًا (--defer-indexes)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# --- فهرس البحث النصي الكامل (SQLite FTS5) للإعلانات ---
+# جدول external-content فوق advertisement، تتم مزامنته عبر triggers عند الإضافة والحذف
+# وتعديل الحقول النصية فقط (الموافقة/النقرات لا تلمس الفهرس؛ حالة الموافقة تُقرأ من الجدول الأصلي عند البحث).
+ADVERTISEMENT_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS advertisement_fts USING fts5(
+        title, description, category, subcategory,
+        content='advertisement', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS advertisement_fts_ai AFTER INSERT ON advertisement BEGIN
+        INSERT INTO advertisement_fts(rowid, title, description, category, subcategory)
+        VALUES (new.id, new.title, new.description, new.category, new.subcategory);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS advertisement_fts_ad AFTER DELETE ON advertisement BEGIN
+        INSERT INTO advertisement_fts(advertisement_fts, rowid, title, description, category, subcategory)
+        VALUES ('delete', old.id, old.title, old.description, old.category, old.subcategory);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS advertisement_fts_au AFTER UPDATE OF title, description, category, subcategory ON advertisement BEGIN
+        INSERT INTO advertisement_fts(advertisement_fts, rowid, title, description, category, subcategory)
+        VALUES ('delete', old.id, old.title, old.description, old.category, old.subcategory);
+        INSERT INTO advertisement_fts(rowid, title, description, category, subcategory)
+        VALUES (new.id, new.title, new.description, new.category, new.subcategory);
+    END""",
+]
+
+# --- فهرس trigram (SQLite FTS5) لبحث المشرف عن المستخدمين بجزء من الاسم/البريد/الهاتف ---
+# فوق أعمدة search_* المطبّعة؛ المطابقة بالبادئة تستخدم فهارس B-tree العادية على نفس الأعمدة.
+USER_SEARCH_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS user_search_fts USING fts5(
+        search_name, search_email, search_phone,
+        content='user', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS user_search_fts_ai AFTER INSERT ON user BEGIN
+        INSERT INTO user_search_fts(rowid, search_name, search_email, search_phone)
+        VALUES (new.id, new.search_name, new.search_email, new.search_phone);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_search_fts_ad AFTER DELETE ON user BEGIN
+        INSERT INTO user_search_fts(user_search_fts, rowid, search_name, search_email, search_phone)
+        VALUES ('delete', old.id, old.search_name, old.search_email, old.search_phone);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS user_search_fts_au AFTER UPDATE OF search_name, search_email, search_phone ON user BEGIN
+        INSERT INTO user_search_fts(user_search_fts, rowid, search_name, search_email, search_phone)
+        VALUES ('delete', old.id, old.search_name, old.search_email, old.search_phone);
+        INSERT INTO user_search_fts(rowid, search_name, search_email, search_phone)
+        VALUES (new.id, new.search_name, new.search_email, new.search_phone);
+    END""",
+]
+
+# --- ترحيلات المخطط (schema migrations) عبر PRAGMA user_version ---
+# db.create_all() ينشئ الجداول الجديدة فقط ولا يضيف أعمدة لجداول موجودة؛
+# كل ترحيل هنا يجب أن يكون idempotent لأن قاعدة بيانات جديدة تحصل على الأعمدة من create_all مباشرة.
+def _add_column_if_missing(table, column, column_ddl):
+    existing = {row[1] for row in db.session.execute(db.text(f"PRAGMA table_info({table})")).all()}
+    if column not in existing:
+        db.session.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {column} {column_ddl}"))
+
+def _migration_1_advertisement_soft_delete():
+    _add_column_if_missing('advertisement', 'deleted_at', 'DATETIME')
+    db.session.execute(db.text("CREATE INDEX IF NOT EXISTS ix_advertisement_deleted_at ON advertisement (deleted_at)"))
+
+def _migration_2_advertisement_updated_at_index():
+    db.session.execute(db.text("CREATE INDEX IF NOT EXISTS ix_advertisement_updated_at ON advertisement (updated_at)"))
+
+def _migration_3_hot_query_indexes():
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_advertisement_live_approved_created "
+        "ON advertisement (is_approved, created_at) WHERE deleted_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_advertisement_live_user_created "
+        "ON advertisement (user_id, created_at) WHERE deleted_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS ix_user_ad_action_user_created "
+        "ON user_ad_action (user_id, created_at, action_type, advertisement_id)",
+        "CREATE INDEX IF NOT EXISTS ix_spin_history_user_created ON spin_history (user_id, created_at, coins)",
+    ):
+        db.session.execute(db.text(statement))
+
+def _migration_4_user_coins_index():
+    db.session.execute(db.text("CREATE INDEX IF NOT EXISTS ix_user_coins ON user (coins DESC, id)"))
+
+def _migration_5_user_search_columns():
+    for column, column_ddl in (('search_name', 'VARCHAR(80)'), ('search_email', 'VARCHAR(120)'), ('search_phone', 'VARCHAR(20)')):
+        _add_column_if_missing('user', column, column_ddl)
+        db.session.execute(db.text(f"CREATE INDEX IF NOT EXISTS ix_user_{column} ON user ({column})"))
+    # ملء الأعمدة للمستخدمين الحاليين على دفعات (التطبيع في Python حتى يطابق User._update_search_fields)
+    last_id = 0
+    while True:
+        rows = db.session.execute(db.text(
+            "SELECT id, name, email, phone_number FROM user WHERE id > :last_id ORDER BY id LIMIT 1000"
+        ), {"last_id": last_id}).all()
+        if not rows: break
+        db.session.execute(db.text(
+            "UPDATE user SET search_name = :search_name, search_email = :search_email, search_phone = :search_phone WHERE id = :id"
+        ), [{"id": uid, "search_name": normalize_search_text(name), "search_email": normalize_search_text(email),
+             "search_phone": normalize_phone(phone)} for uid, name, email, phone in rows])
+        last_id = rows[-1][0]
+
+def _migration_6_activity_indexes_and_earnings():
+    # id بعد created_at حتى يُقرأ سجل النشاط (created_at DESC, id DESC) من الفهرس بدون فرز
+    for index_name, table, columns in (
+        ("ix_user_ad_action_user_created", "user_ad_action", "user_id, created_at, id, action_type, advertisement_id"),
+        ("ix_spin_history_user_created", "spin_history", "user_id, created_at, id, coins"),
+    ):
+        db.session.execute(db.text(f"DROP INDEX IF EXISTS {index_name}"))
+        db.session.execute(db.text(f"CREATE INDEX {index_name} ON {table} ({columns})"))
+    # ملخص الأرباح من السجلات الموجودة؛ قيم COIN_VALUES و coin_per_click الحالية هي التقدير الوحيد المتاح للماضي
+    action_coins = ' '.join(f"WHEN '{action_type}' THEN {coins}" for action_type, coins in COIN_VALUES.items())
+    for statement in (
+        "INSERT OR IGNORE INTO user_earnings (user_id, source, count, coins) "
+        f"SELECT user_id, action_type, COUNT(*), SUM(CASE action_type {action_coins} ELSE 0 END) "
+        "FROM user_ad_action GROUP BY user_id, action_type",
+        "INSERT OR IGNORE INTO user_earnings (user_id, source, count, coins) "
+        "SELECT user_id, 'spin', COUNT(*), SUM(coins) FROM spin_history GROUP BY user_id",
+        "INSERT OR IGNORE INTO user_earnings (user_id, source, count, coins) "
+        "SELECT user_id, 'ad_click', SUM(number_of_clicks), SUM(number_of_clicks * coin_per_click) "
+        "FROM advertisement WHERE number_of_clicks > 0 GROUP BY user_id",
+    ):
+        db.session.execute(db.text(statement))
+
+def _migration_7_advertisement_schedule():
+    _add_column_if_missing('advertisement', 'starts_at', 'DATETIME')
+    _add_column_if_missing('advertisement', 'ends_at', 'DATETIME')
+    db.session.execute(db.text("CREATE INDEX IF NOT EXISTS ix_advertisement_starts_at ON advertisement (starts_at) WHERE starts_at IS NOT NULL"))
+    db.session.execute(db.text("CREATE INDEX IF NOT EXISTS ix_advertisement_ends_at ON advertisement (ends_at) WHERE ends_at IS NOT NULL"))
+
+def _migration_8_referral_edges_backfill():
+    # ملء جدول الإحالات من User.referrer_id للمستخدمين المسجلين قبل وجود الجدول (مرة واحدة بدل كل تشغيل)
+    backfilled = db.session.execute(db.text(
+        "INSERT OR IGNORE INTO referral (referrer_id, referred_id, created_at) "
+        "SELECT referrer_id, id, CURRENT_TIMESTAMP FROM user WHERE referrer_id IS NOT NULL"
+    )).rowcount
+    if backfilled:
+        print(f"Backfilled {backfilled} referral edges from user.referrer_id.")
+
+def _migration_9_advertisement_purge_claims():
+    for column, column_ddl in (('owner', 'VARCHAR(80)'), ('heartbeat_at', 'DATETIME'), ('next_attempt_at', 'DATETIME')):
+        _add_column_if_missing('advertisement_purge', column, column_ddl)
+
+def _migration_10_user_event_autoincrement():
+    # SQLite لا يضيف AUTOINCREMENT بـ ALTER: إعادة بناء الجدول بنفس الصفوف (sqlite_sequence يبدأ من أكبر id منسوخ)
+    table_sql = db.session.execute(db.text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'user_event'")).scalar()
+    if 'AUTOINCREMENT' in (table_sql or '').upper(): return
+    db.session.execute(db.text("ALTER TABLE user_event RENAME TO user_event_old"))
+    for index in UserEvent.__table__.indexes:
+        db.session.execute(db.text(f"DROP INDEX IF EXISTS {index.name}"))
+    connection = db.session.connection()
+    UserEvent.__table__.create(connection)
+    db.session.execute(db.text(
+        "INSERT INTO user_event (id, user_id, event_type, payload, created_at) "
+        "SELECT id, user_id, event_type, payload, created_at FROM user_event_old ORDER BY id"
+    ))
+    db.session.execute(db.text("DROP TABLE user_event_old"))
+
+def _migration_11_referral_earnings_backfill():
+    # مصدر 'referral' لم يُملأ في الترحيل 6: كل حافة في referral تمنح أسلافها حتى len(REFERRAL_BONUS_BY_LEVEL) مستوى
+    # مكافأة مستواهم. استبدال (لا INSERT OR IGNORE) لأن الجدول هو مصدر الحقيقة؛ الإعداد الحالي هو التقدير الوحيد للماضي.
+    bonus_values = ', '.join(f"({level}, {int(bonus)})" for level, bonus in enumerate(REFERRAL_BONUS_BY_LEVEL, start=1))
+    db.session.execute(db.text(f"""
+        WITH RECURSIVE upline(user_id, level) AS (
+            SELECT referrer_id, 1 FROM referral
+            UNION ALL
+            SELECT r.referrer_id, u.level + 1
+            FROM upline u JOIN referral r ON r.referred_id = u.user_id
+            WHERE u.level < :max_level
+        ),
+        bonus(level, coins) AS (VALUES {bonus_values})
+        INSERT INTO user_earnings (user_id, source, count, coins)
+        SELECT u.user_id, 'referral', COUNT(*), SUM(b.coins)
+        FROM upline u JOIN bonus b ON b.level = u.level
+        WHERE b.coins > 0
+        GROUP BY u.user_id
+        ON CONFLICT (user_id, source) DO UPDATE SET count = excluded.count, coins = excluded.coins
+    """), {"max_level": len(REFERRAL_BONUS_BY_LEVEL)})
+
+def _migration_12_user_ad_action_created_index():
+    # جدول worker_lease جديد فينشئه create_all
+    db.session.execute(db.text("CREATE INDEX IF NOT EXISTS ix_user_ad_action_created ON user_ad_action (created_at)"))
+
+def _migration_13_user_ad_action_autoincrement():
+    # مثل الترحيل 10؛ ثم sqlite_sequence من أكبر id في الجدولين (صفوف الأرشيف تحمل id الأصلي)
+    table_sql = db.session.execute(db.text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'user_ad_action'")).scalar()
+    if 'AUTOINCREMENT' not in (table_sql or '').upper():
+        db.session.execute(db.text("ALTER TABLE user_ad_action RENAME TO user_ad_action_old"))
+        for index in UserAdAction.__table__.indexes:
+            db.session.execute(db.text(f"DROP INDEX IF EXISTS {index.name}"))
+        connection = db.session.connection()
+        UserAdAction.__table__.create(connection)
+        db.session.execute(db.text(
+            "INSERT INTO user_ad_action (id, user_id, advertisement_id, action_type, created_at) "
+            "SELECT id, user_id, advertisement_id, action_type, created_at FROM user_ad_action_old ORDER BY id"
+        ))
+        db.session.execute(db.text("DROP TABLE user_ad_action_old"))
+    last_id = db.session.execute(db.text(
+        "SELECT MAX(id) FROM (SELECT MAX(id) AS id FROM user_ad_action UNION ALL SELECT MAX(id) FROM user_ad_action_archive "
+        "UNION ALL SELECT seq FROM sqlite_sequence WHERE name = 'user_ad_action')"
+    )).scalar()
+    if last_id is not None:
+        db.session.execute(db.text("DELETE FROM sqlite_sequence WHERE name = 'user_ad_action'"))
+        db.session.execute(db.text("INSERT INTO sqlite_sequence (name, seq) VALUES ('user_ad_action', :seq)"), {"seq": last_id})
+
+SCHEMA_MIGRATIONS = [
+    (1, _migration_1_advertisement_soft_delete),
+    (2, _migration_2_advertisement_updated_at_index),
+    (3, _migration_3_hot_query_indexes),
+    (4, _migration_4_user_coins_index),
+    (5, _migration_5_user_search_columns),
+    (6, _migration_6_activity_indexes_and_earnings),
+    (7, _migration_7_advertisement_schedule),
+    (8, _migration_8_referral_edges_backfill),
+    (9, _migration_9_advertisement_purge_claims),
+    (10, _migration_10_user_event_autoincrement),
+    (11, _migration_11_referral_earnings_backfill),
+    (12, _migration_12_user_ad_action_created_index),
+    (13, _migration_13_user_ad_action_autoincrement),
+]
+
+def _apply_schema_migrations():
+    current_version = db.session.execute(db.text("PRAGMA user_version")).scalar() or 0
+    for version, migration in SCHEMA_MIGRATIONS:
+        if version > current_version:
+            print(f"Applying schema migration {version}: {migration.__name__}...")
+            migration()
+            db.session.execute(db.text(f"PRAGMA user_version = {int(version)}"))
+            db.session.commit()
+
+# --- فحص خطط الاستعلامات الساخنة (EXPLAIN QUERY PLAN) ---
+# كل استعلام هنا يطابق شكل استعلام في مسار ساخن، مع الفهرس الذي يجب أن يستخدمه.
+# الفحص يفشل إذا لم يُستخدم الفهرس أو ظهر USE TEMP B-TREE (فرز مؤقت)، حتى لا يُكسر فهرس بتعديل لاحق للموديل.
+# يُشغَّل في tests/test_query_plans.py؛ أضف كل استعلام ساخن جديد هنا.
+HOT_QUERY_PLANS = [
+    ("ad_catalog_load", "ix_advertisement_live_approved_created",
+     lambda: db.select(Advertisement.id).where(Advertisement.is_approved == True, Advertisement.deleted_at.is_(None))
+                .order_by(Advertisement.created_at.desc(), Advertisement.id.desc())),
+    ("approved_active_ads", "ix_advertisement_live_approved_created",
+     lambda: db.select(Advertisement).where(Advertisement.deleted_at.is_(None), Advertisement.is_approved == True,
+                                            Advertisement.is_active == True).order_by(Advertisement.created_at.desc())),
+    ("user_advertisements", "ix_advertisement_live_user_created",
+     lambda: db.select(Advertisement).where(Advertisement.deleted_at.is_(None), Advertisement.user_id == 1)
+                .order_by(Advertisement.created_at.desc())),
+    ("profile_with_ads", "ix_advertisement_live_user_created",
+     lambda: db.select(User).options(db.joinedload(User.advertisements)).where(User.id == 1)),
+    ("user_actions_done", "COVERING INDEX",
+     lambda: db.select(UserAdAction.advertisement_id, UserAdAction.action_type).where(UserAdAction.user_id == 1)),
+    ("user_action_history", "COVERING INDEX ix_user_ad_action_user_created",
+     lambda: db.select(UserAdAction.advertisement_id, UserAdAction.action_type, UserAdAction.created_at)
+                .where(UserAdAction.user_id == 1).order_by(UserAdAction.created_at.desc())),
+    ("user_activity_actions", "COVERING INDEX ix_user_ad_action_user_created",
+     lambda: db.select(UserAdAction.id, UserAdAction.created_at, UserAdAction.advertisement_id, UserAdAction.action_type)
+                .where(UserAdAction.user_id == 1).order_by(UserAdAction.created_at.desc(), UserAdAction.id.desc()).limit(10)),
+    ("user_activity_clicks", "COVERING INDEX ix_ad_click_user_created",
+     lambda: db.select(AdClick.id, AdClick.created_at, AdClick.advertisement_id)
+                .where(AdClick.user_id == 1).order_by(AdClick.created_at.desc(), AdClick.id.desc()).limit(10)),
+    ("user_activity_ad_clicks", "COVERING INDEX ix_ad_click_advertiser_created",
+     lambda: db.select(AdClick.id, AdClick.created_at, AdClick.advertisement_id, AdClick.coins)
+                .where(AdClick.advertiser_id == 1).order_by(AdClick.created_at.desc(), AdClick.id.desc()).limit(10)),
+    ("user_activity_spins", "COVERING INDEX ix_spin_history_user_created",
+     lambda: db.select(SpinHistory.id, SpinHistory.created_at, SpinHistory.coins)
+                .where(SpinHistory.user_id == 1).order_by(SpinHistory.created_at.desc(), SpinHistory.id.desc()).limit(10)),
+    ("user_spin_history", "COVERING INDEX ix_spin_history_user_created",
+     lambda: db.select(SpinHistory.coins, SpinHistory.created_at).where(SpinHistory.user_id == 1)
+                .order_by(SpinHistory.created_at.desc())),
+    ("social_action_exists", "sqlite_autoindex_user_ad_action_1",
+     lambda: db.select(Advertisement.id, db.or_(db.exists().where(
+                UserAdAction.user_id == 1, UserAdAction.advertisement_id == Advertisement.id, UserAdAction.action_type == 'like'
+             ), db.exists().where(
+                UserAdActionArchive.user_id == 1, UserAdActionArchive.advertisement_id == Advertisement.id,
+                UserAdActionArchive.action_code == 1
+             ))).where(Advertisement.id == 1, Advertisement.deleted_at.is_(None))),
+    ("ads_changed_since", "ix_advertisement_updated_at",
+     lambda: db.select(Advertisement).where(Advertisement.updated_at > datetime(2000, 1, 1))),
+    ("ad_tombstones_since", "ix_advertisement_tombstone_deleted_at",
+     lambda: db.select(AdvertisementTombstone.advertisement_id, AdvertisementTombstone.deleted_at)
+                .where(AdvertisementTombstone.deleted_at > datetime(2000, 1, 1))),
+    ("leaderboard_top", "COVERING INDEX ix_user_coins",
+     lambda: db.select(User.coins, User.id).order_by(User.coins.desc(), User.id).limit(10)),
+    ("leaderboard_histogram", "COVERING INDEX ix_user_coins",
+     lambda: db.select(User.coins, db.func.count()).group_by(User.coins)),
+    ("weekly_leaderboard_top", "COVERING INDEX ix_weekly_earnings_week_coins",
+     lambda: db.select(WeeklyEarnings.coins, WeeklyEarnings.user_id).where(WeeklyEarnings.week_start == date(2000, 1, 3))
+                .order_by(WeeklyEarnings.coins.desc(), WeeklyEarnings.user_id).limit(10)),
+    ("weekly_leaderboard_histogram", "COVERING INDEX ix_weekly_earnings_week_coins",
+     lambda: db.select(WeeklyEarnings.coins, db.func.count()).where(WeeklyEarnings.week_start == date(2000, 1, 3))
+                .group_by(WeeklyEarnings.coins)),
+    ("ad_schedule_starts", "COVERING INDEX ix_advertisement_starts_at",
+     lambda: db.select(Advertisement.starts_at, Advertisement.id)
+                .where(Advertisement.starts_at > datetime(2000, 1, 1))
+                .order_by(Advertisement.starts_at, Advertisement.id).limit(10)),
+    ("ad_schedule_ends", "COVERING INDEX ix_advertisement_ends_at",
+     lambda: db.select(Advertisement.ends_at, Advertisement.id)
+                .where(Advertisement.ends_at > datetime(2000, 1, 1))
+                .order_by(Advertisement.ends_at, Advertisement.id).limit(10)),
+    ("ad_schedule_catch_up", "ix_advertisement_starts_at",
+     lambda: db.select(Advertisement.id).where(
+                db.or_(Advertisement.starts_at <= datetime(2000, 1, 1), Advertisement.ends_at <= datetime(2000, 1, 1)),
+                Advertisement.is_active != _ad_in_schedule_window(datetime(2000, 1, 1)))),
+]
+
+def check_hot_query_plans():
+    """يعيد [{name, ok, expected_index, plan}] لكل استعلام في HOT_QUERY_PLANS."""
+    results = []
+    for name, expected_index, build_statement in HOT_QUERY_PLANS:
+        compiled = build_statement().compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True})
+        plan = [row[3] for row in db.session.execute(db.text(f"EXPLAIN QUERY PLAN {compiled}")).all()]
+        ok = any(expected_index in step for step in plan) and not any('USE TEMP B-TREE' in step for step in plan)
+        results.append({"name": name, "ok": ok, "expected_index": expected_index, "plan": plan})
+    return results
+
 # --- تهيئة قاعدة البيانات ---
 try:
     with app.app_context():
         print(f"Initializing database tables at: {db_path}...")
         db.create_all()
         print("Database tables checked/created successfully.")
+        _apply_schema_migrations()
+        db.session.execute(db.text("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)"))
+        db.session.commit()
+        fts_existed = db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'advertisement_fts'"
+        )).first() is not None
+        for ddl in ADVERTISEMENT_FTS_DDL:
+            db.session.execute(db.text(ddl))
+        if not fts_existed:
+            # إعلانات أُنشئت قبل وجود الفهرس
+            db.session.execute(db.text("INSERT INTO advertisement_fts(advertisement_fts) VALUES ('rebuild')"))
+        db.session.commit()
+        print("Advertisement full-text index checked/created.")
+        user_fts_existed = db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'user_search_fts'"
+        )).first() is not None
+        for ddl in USER_SEARCH_FTS_DDL:
+            db.session.execute(db.text(ddl))
+        if not user_fts_existed:
+            db.session.execute(db.text("INSERT INTO user_search_fts(user_search_fts) VALUES ('rebuild')"))
+        db.session.commit()
+        print("User search trigram index checked/created.")
 except Exception as e:
     print(f"FATAL ERROR during initial db.create_all(): {e}")
     sys.exit(f"Database initialization failed: {e}")
 
 # --- دوال مساعدة وامتدادات مسموحة ---
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'mov', 'webm', 'mkv', '3gp', 'gif'}
+MAX_IMAGES_PER_SUBMISSION = 5 # الحد الأقصى للصور (أو الإطارات) المرسلة إلى Gemini في طلب واحد
+MAX_VIDEO_FRAMES = 4 # عدد الإطارات المأخوذة بالتساوي من تسجيل الشاشة
+MAX_VIDEO_BYTES = 30 * 1024 * 1024
+NORMALIZED_IMAGE_MAX_SIDE = 1600 # تصغير الصور الأكبر قبل الإرسال
+NEAR_DUPLICATE_MAX_DISTANCE = 4 # مسافة hamming القصوى بين average-hashes لاعتبار صورتين متطابقتين تقريبًا
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# --- START: Request-scoped entity loader ---
+class RequestLoader:
+    """
+    محمّل كيانات على مستوى الطلب (محفوظ في flask.g مع جلسة نفس الـ app context).
+    المعرفات المطلوبة لنفس النوع (عبر prime ثم get) تُجلب في استعلام واحد WHERE id IN (...)،
+    والكائنات الموجودة مسبقًا في خريطة الهوية للجلسة تُعاد بدون استعلام.
+    """
+
+    def __init__(self):
+        self._pending = {} # model -> set(ids)
+        self._loaded = {} # model -> {id: instance | None}
+
+    def prime(self, model, *ids):
+        loaded = self._loaded.get(model, {})
+        self._pending.setdefault(model, set()).update(ident for ident in ids if ident is not None and ident not in loaded)
+        return self
+
+    def get(self, model, ident):
+        loaded = self._loaded.setdefault(model, {})
+        if ident not in loaded:
+            self.prime(model, ident)
+            self._load(model)
+        return loaded.get(ident)
+
+    def get_many(self, model, ids):
+        self.prime(model, *ids)
+        self._load(model)
+        loaded = self._loaded[model]
+        return {ident: loaded.get(ident) for ident in ids}
+
+    def remember(self, instance):
+        if instance is not None: self._loaded.setdefault(type(instance), {})[instance.id] = instance
+        return instance
+
+    def _load(self, model):
+        loaded = self._loaded.setdefault(model, {})
+        to_query = []
+        for ident in self._pending.pop(model, ()):
+            instance = db.session.identity_map.get(identity_key(model, ident))
+            if instance is not None: loaded[ident] = instance
+            else: to_query.append(ident)
+        if not to_query: return
+        for instance in model.query.filter(model.id.in_(to_query)).all():
+            loaded[instance.id] = instance
+        for ident in to_query:
+            loaded.setdefault(ident, None)
+
+def request_loader():
+    if 'entity_loader' not in g:
+        g.entity_loader = RequestLoader()
+    return g.entity_loader
+
+def load_advertisement_with_user(ad_id, user_id):
+    """
+    الإعلان الحي مع صاحبه (joinedload) والمستخدم user_id في رحلة واحدة إلى SQLite.
+    يعيد (advertisement | None, user | None)؛ user يُحمّل فقط إذا وُجد الإعلان.
+    """
+    acting_user = db.aliased(User)
+    row = db.session.query(Advertisement, acting_user)\
+                    .options(db.joinedload(Advertisement.advertiser))\
+                    .outerjoin(acting_user, acting_user.id == user_id)\
+                    .filter(Advertisement.id == ad_id, Advertisement.deleted_at.is_(None))\
+                    .first()
+    if row is None: return None, None
+    loader = request_loader()
+    loader.remember(row[0])
+    loader.remember(row[0].advertiser)
+    loader.remember(row[1])
+    return row[0], row[1]
+# --- END: Request-scoped entity loader ---
+
 # --- START: Helper function to get user_id and validate user ---
 def get_validated_user_from_form(form_data):
     if 'user_id' not in form_data:
@@ -334,13 +1206,1522 @@ def get_validated_user_from_form(form_data):
         app.logger.warning(f"Invalid user_id format: {user_id_str}")
         return None, (jsonify({"error": "'user_id' must be a valid integer."}), 400)
 
-    user = User.query.get(user_id_val)
+    user = request_loader().get(User, user_id_val)
     if not user:
         app.logger.warning(f"User with ID {user_id_val} not found.")
         return None, (jsonify({"error": f"User with ID {user_id_val} not found."}), 404)
     return user, None
 # --- END: Helper function ---
 
+# --- START: Referral tree helpers (recursive CTEs over the referral table) ---
+REFERRAL_UPLINE_SQL = db.text("""
+    WITH RECURSIVE upline(user_id, level) AS (
+        SELECT :start_id, 1
+        UNION ALL
+        SELECT r.referrer_id, up.level + 1
+        FROM referral r JOIN upline up ON r.referred_id = up.user_id
+        WHERE up.level < :max_level
+    )
+    SELECT user_id, level FROM upline
+""")
+
+REFERRAL_DOWNLINE_SQL = db.text("""
+    WITH RECURSIVE downline(user_id, level, parent_id) AS (
+        SELECT referred_id, 1, referrer_id FROM referral WHERE referrer_id = :root_id
+        UNION ALL
+        SELECT r.referred_id, d.level + 1, r.referrer_id
+        FROM referral r JOIN downline d ON r.referrer_id = d.user_id
+        WHERE d.level < :max_depth
+    )
+    SELECT d.user_id, d.level, d.parent_id, u.name
+    FROM downline d JOIN user u ON u.id = d.user_id
+    ORDER BY d.level, d.user_id
+""")
+
+REFERRAL_LEVEL_COUNTS_SQL = db.text("""
+    WITH RECURSIVE downline(user_id, level) AS (
+        SELECT referred_id, 1 FROM referral WHERE referrer_id = :root_id
+        UNION ALL
+        SELECT r.referred_id, d.level + 1
+        FROM referral r JOIN downline d ON r.referrer_id = d.user_id
+        WHERE d.level < :max_depth
+    )
+    SELECT level, COUNT(*) FROM downline GROUP BY level ORDER BY level
+""")
+
+def _credit_referral_bonuses(direct_referrer_id):
+    """Credits REFERRAL_BONUS_BY_LEVEL up the referrer chain. Caller commits."""
+    if not REFERRAL_BONUS_BY_LEVEL:
+        return {}
+    upline = db.session.execute(REFERRAL_UPLINE_SQL, {
+        "start_id": direct_referrer_id, "max_level": len(REFERRAL_BONUS_BY_LEVEL)
+    }).all()
+    params = [{"uid": uid, "bonus": REFERRAL_BONUS_BY_LEVEL[level - 1]}
+              for uid, level in upline if REFERRAL_BONUS_BY_LEVEL[level - 1] > 0]
+    if params:
+        db.session.execute(db.text("UPDATE user SET coins = coins + :bonus WHERE id = :uid"), params)
+        week_start = current_week_start().isoformat()
+        db.session.execute(db.text(USER_EARNINGS_UPSERT_SQL), [
+            {"user_id": p["uid"], "source": "referral", "coins": p["bonus"]} for p in params])
+        db.session.execute(db.text(WEEKLY_EARNINGS_UPSERT_SQL), [ # تظهر في لوحة الصدارة عند إعادة التحميل التالية
+            {"week_start": week_start, "user_id": p["uid"], "coins": p["bonus"]} for p in params])
+    return {p["uid"]: p["bonus"] for p in params}
+
+def _parse_referral_depth(default=MAX_REFERRAL_DEPTH):
+    depth = request.args.get('max_depth', default, type=int)
+    if depth is None or depth < 1:
+        return None
+    return min(depth, MAX_REFERRAL_DEPTH)
+# --- END: Referral tree helpers ---
+
+# --- START: Weighted spin prize sampling (Vose alias method, O(1) per draw) ---
+class AliasSampler:
+    """Samples items with probability proportional to their integer weights in O(1)."""
+    __slots__ = ('items', 'prob', 'alias')
+
+    def __init__(self, items, weights):
+        n = len(items)
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights]
+        self.items = list(items)
+        self.prob = [0.0] * n
+        self.alias = [0] * n
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s_idx, l_idx = small.pop(), large.pop()
+            self.prob[s_idx] = scaled[s_idx]
+            self.alias[s_idx] = l_idx
+            scaled[l_idx] = scaled[l_idx] + scaled[s_idx] - 1.0
+            (small if scaled[l_idx] < 1.0 else large).append(l_idx)
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def sample(self, rng=random):
+        i = rng.randrange(len(self.items))
+        return self.items[i] if rng.random() < self.prob[i] else self.items[self.alias[i]]
+
+_spin_sampler_cache = {"sampler": None, "loaded_at": 0.0}
+
+def invalidate_spin_prize_table():
+    _spin_sampler_cache["sampler"] = None
+
+def get_spin_sampler():
+    """يعيد AliasSampler مبنيًا من الجوائز النشطة (مع تخزين مؤقت لكل عامل)."""
+    cached = _spin_sampler_cache["sampler"]
+    if cached is not None and time.monotonic() - _spin_sampler_cache["loaded_at"] < SPIN_PRIZE_TABLE_TTL_SECONDS:
+        return cached
+    prizes = [(p.id, p.label, p.coins, p.weight) for p in
+              SpinPrize.query.filter(SpinPrize.is_active == True, SpinPrize.weight > 0).order_by(SpinPrize.id).all()]
+    if not prizes:
+        prizes = [(None, label, coins, weight) for label, coins, weight in DEFAULT_SPIN_PRIZES]
+    sampler = AliasSampler(prizes, [p[3] for p in prizes])
+    _spin_sampler_cache["sampler"] = sampler
+    _spin_sampler_cache["loaded_at"] = time.monotonic()
+    return sampler
+# --- END: Weighted spin prize sampling ---
+
+# --- START: Content-addressed screenshot store ---
+SHA256_HEX_RE = re.compile(r'^[0-9a-f]{64}$')
+
+class ScreenshotStore:
+    """
+    مخزن ملفات معنون بالمحتوى: <root>/<sha[0:2]>/<sha[2:4]>/<sha256>.
+    الكتابة ذرية (ملف مؤقت في نفس المجلد ثم os.replace)، والملف المتطابق يُكتب مرة واحدة فقط.
+    القراءة عبر mmap بدون نسخ الملف كاملًا إلى الذاكرة.
+    lock(sha) قفل بين العمليات (flock على ملف لكل أول بايت من sha) يسلسل حذف المنظف مع تحقق الإرسال بعد الـ commit.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, sha256_hex):
+        return os.path.join(self.root, sha256_hex[:2], sha256_hex[2:4], sha256_hex)
+
+    def put(self, sha256_hex, data):
+        """يعيد True إذا كُتب ملف جديد، False إذا كان موجودًا مسبقًا."""
+        path = self.path_for(sha256_hex)
+        if os.path.exists(path): return False
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(data)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        return True
+
+    @contextlib.contextmanager
+    def lock(self, sha256_hex):
+        directory = os.path.join(self.root, sha256_hex[:2])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def open(self, sha256_hex):
+        """يعيد mmap للقراءة فقط (أو b'' لملف فارغ، أو None إذا لم يوجد). المستدعي يغلقه."""
+        try:
+            with open(self.path_for(sha256_hex), 'rb') as blob_file:
+                if os.fstat(blob_file.fileno()).st_size == 0: return b''
+                return mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def delete(self, sha256_hex):
+        try:
+            os.remove(self.path_for(sha256_hex))
+        except FileNotFoundError:
+            pass
+
+screenshot_store = ScreenshotStore(app.config['UPLOAD_FOLDER'])
+
+def _store_submission_files(ctx):
+    """يكتب ملفات الإرسال في المخزن ويحدّث بياناتها الوصفية (ضمن معاملة المستدعي)."""
+    if not SCREENSHOT_STORE_ENABLED: return
+    now = datetime.utcnow()
+    ctx["stored_files"] = []
+    for (kind, file_bytes), sha256_hex, media_type in zip(ctx["payloads"], ctx["img_hashes"], ctx["media_types"]):
+        try:
+            screenshot_store.put(sha256_hex, file_bytes)
+        except OSError as e:
+            app.logger.error(f"Screenshot store: failed to write {sha256_hex}: {e}", exc_info=True)
+            continue
+        ctx["stored_files"].append((sha256_hex, file_bytes))
+        db.session.execute(db.text(
+            "INSERT INTO screenshot_blob (sha256, size_bytes, media_type, ref_count, created_at, last_referenced_at) "
+            "VALUES (:sha, :size, :media_type, 1, :now, :now) "
+            "ON CONFLICT(sha256) DO UPDATE SET ref_count = ref_count + 1, last_referenced_at = excluded.last_referenced_at"
+        ), {"sha": sha256_hex, "size": len(file_bytes), "media_type": media_type, "now": now})
+
+def _confirm_submission_files(ctx):
+    """
+    بعد commit الإرسال: المنظف ربما حذف الملف بين put() (وجده موجودًا) وإعادة إنشاء الصف، فيُعاد كتابته.
+    تحت قفل الملف حتى لا يتداخل مع فحص المنظف (الصف غير موجود ثم unlink).
+    """
+    for sha256_hex, file_bytes in ctx.get("stored_files", ()):
+        try:
+            with screenshot_store.lock(sha256_hex):
+                if screenshot_store.put(sha256_hex, file_bytes):
+                    app.logger.warning(f"Screenshot store: rewrote {sha256_hex} evicted during a concurrent submission.")
+        except OSError as e:
+            app.logger.error(f"Screenshot store: failed to confirm {sha256_hex}: {e}", exc_info=True)
+
+def evict_screenshots():
+    """يحذف الملفات الأقدم من SCREENSHOT_STORE_MAX_AGE ثم الأقل استخدامًا حتى يعود الحجم تحت الحد."""
+    evicted = 0
+    cutoff = datetime.utcnow() - SCREENSHOT_STORE_MAX_AGE
+    while True:
+        expired = [row[0] for row in db.session.query(ScreenshotBlob.sha256)
+                   .filter(ScreenshotBlob.last_referenced_at < cutoff).limit(SCREENSHOT_EVICTION_BATCH).all()]
+        if not expired: break
+        evicted += _delete_screenshot_blobs(expired, cutoff)
+    total_bytes = db.session.query(db.func.coalesce(db.func.sum(ScreenshotBlob.size_bytes), 0)).scalar()
+    while total_bytes > SCREENSHOT_STORE_MAX_BYTES:
+        oldest = db.session.query(ScreenshotBlob.sha256, ScreenshotBlob.size_bytes, ScreenshotBlob.last_referenced_at)\
+                           .order_by(ScreenshotBlob.last_referenced_at).limit(SCREENSHOT_EVICTION_BATCH).all()
+        if not oldest: break
+        victims, referenced_before = [], None
+        for sha256_hex, size_bytes, last_referenced_at in oldest:
+            victims.append(sha256_hex)
+            referenced_before = last_referenced_at
+            total_bytes -= size_bytes
+            if total_bytes <= SCREENSHOT_STORE_MAX_BYTES: break
+        evicted += _delete_screenshot_blobs(victims, referenced_before + timedelta(microseconds=1))
+    return evicted
+
+def _delete_screenshot_blobs(sha_list, referenced_before):
+    """
+    يحذف صفوف sha_list التي لم يُشر إليها منذ referenced_before (إرسال متزامن حدّث last_referenced_at
+    يُبقي صفه وملفه)، ثم يحذف ملفات ما حُذف فعلًا فقط، كل ملف تحت قفله وبعد التأكد أن الصف لم يُعَد إنشاؤه.
+    """
+    deleted = db.session.execute(
+        db.delete(ScreenshotBlob)
+          .where(ScreenshotBlob.sha256.in_(sha_list), ScreenshotBlob.last_referenced_at < referenced_before)
+          .returning(ScreenshotBlob.sha256)
+    ).scalars().all()
+    db.session.commit()
+    for sha256_hex in deleted:
+        with screenshot_store.lock(sha256_hex):
+            if db.session.query(ScreenshotBlob.sha256).filter(ScreenshotBlob.sha256 == sha256_hex).first() is None:
+                screenshot_store.delete(sha256_hex)
+    return len(deleted)
+
+def _screenshot_evictor_loop():
+    while True:
+        try:
+            with app.app_context():
+                evicted = evict_screenshots()
+                if evicted: app.logger.info(f"Screenshot store: evicted {evicted} files.")
+        except Exception as e:
+            app.logger.error(f"Screenshot evictor error: {e}", exc_info=True)
+        time.sleep(SCREENSHOT_EVICTION_SECONDS)
+# --- END: Content-addressed screenshot store ---
+
+# --- START: Idempotency helpers ---
+_idempotency_last_cleanup = [0.0]
+
+def _idempotency_user_id(form_data, json_body):
+    raw = form_data.get('user_id') if form_data is not None else None
+    if raw is None and isinstance(json_body, dict): raw = json_body.get('user_id')
+    try:
+        return int(raw)
+    except (TypeError, ValueError):
+        return None
+
+def _request_fingerprint(method, path, form_data, files, json_body):
+    digest = hashlib.sha256(f"{method} {path}\n".encode())
+    if json_body is not None:
+        digest.update(json.dumps(json_body, sort_keys=True, separators=(',', ':')).encode())
+    for name in sorted(form_data.keys()):
+        for value in form_data.getlist(name):
+            digest.update(f"f:{name}={value}\n".encode())
+    for name in sorted(files.keys()):
+        for file in files.getlist(name):
+            digest.update(f"u:{name}:{file.filename}:".encode() + hashlib.sha256(file.read()).digest())
+            file.seek(0)
+    return digest.hexdigest()
+
+def _idempotency_begin(user_id, key, fingerprint):
+    """
+    يحاول حجز المفتاح. يعيد أحد:
+    ('run', record_id) | ('replay', (status, headers, body)) | ('conflict', None) | ('wait', None)
+    """
+    now = datetime.utcnow()
+    if time.monotonic() - _idempotency_last_cleanup[0] > IDEMPOTENCY_CLEANUP_SECONDS:
+        _idempotency_last_cleanup[0] = time.monotonic()
+        db.session.execute(db.delete(IdempotencyRecord).where(IdempotencyRecord.expires_at <= now))
+        db.session.commit()
+    for _ in range(3):
+        record = IdempotencyRecord(user_id=user_id, idempotency_key=key, fingerprint=fingerprint, status='in_progress',
+                                   created_at=now, locked_until=now + IDEMPOTENCY_LOCK_TIMEOUT, expires_at=now + IDEMPOTENCY_TTL)
+        db.session.add(record)
+        try:
+            db.session.commit()
+            return 'run', record.id
+        except IntegrityError:
+            db.session.rollback()
+        existing = IdempotencyRecord.query.filter_by(user_id=user_id, idempotency_key=key).first()
+        if existing is None: continue
+        if existing.expires_at <= now or (existing.status == 'in_progress' and existing.locked_until <= now):
+            db.session.delete(existing) # منتهي أو متوقف: نعيد التنفيذ
+            db.session.commit()
+            continue
+        if existing.fingerprint != fingerprint: return 'conflict', None
+        if existing.status == 'completed':
+            return 'replay', (existing.response_status, json.loads(existing.response_headers or '[]'), existing.response_body or b'')
+        return 'wait', None
+    return 'wait', None
+
+def _idempotency_complete(record_id, response):
+    """يحفظ الاستجابة (غير 5xx) لإعادتها كما هي؛ استجابات 5xx تحرر المفتاح حتى تُعاد المحاولة فعليًا."""
+    try:
+        if response.status_code >= 500:
+            db.session.execute(db.delete(IdempotencyRecord).where(IdempotencyRecord.id == record_id))
+        else:
+            headers = [[k, v] for k, v in response.headers.items() if k.lower() not in ('content-length', 'date')]
+            db.session.execute(
+                db.update(IdempotencyRecord).where(IdempotencyRecord.id == record_id)
+                  .values(status='completed', response_status=response.status_code,
+                          response_headers=json.dumps(headers), response_body=response.get_data(), locked_until=None)
+            )
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Idempotency: Failed to store response for record {record_id}: {e}", exc_info=True)
+
+def _idempotency_abort(record_id):
+    try:
+        db.session.rollback()
+        db.session.execute(db.delete(IdempotencyRecord).where(IdempotencyRecord.id == record_id))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Idempotency: Failed to release record {record_id}: {e}", exc_info=True)
+
+def _idempotency_replay_response(stored):
+    status, headers, body = stored
+    response = Response(body, status=status, headers=headers)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+IDEMPOTENCY_CONFLICT_ERROR = {"error": "Idempotency-Key was already used with a different request."}
+IDEMPOTENCY_IN_PROGRESS_ERROR = {"error": "A request with this Idempotency-Key is still being processed. Retry later."}
+
+def _idempotency_in_progress_response():
+    return jsonify(IDEMPOTENCY_IN_PROGRESS_ERROR), 409, {"Retry-After": str(IDEMPOTENCY_RETRY_AFTER_SECONDS)}
+
+def _run_idempotent(user_id, key, fingerprint, handler):
+    deadline = time.monotonic() + IDEMPOTENCY_SYNC_WAIT_SECONDS
+    while True:
+        outcome, payload = _idempotency_begin(user_id, key, fingerprint)
+        if outcome == 'run': break
+        if outcome == 'replay': return _idempotency_replay_response(payload)
+        if outcome == 'conflict': return jsonify(IDEMPOTENCY_CONFLICT_ERROR), 422
+        if time.monotonic() >= deadline: return _idempotency_in_progress_response()
+        time.sleep(IDEMPOTENCY_POLL_SECONDS) # الطلب الأصلي قيد التنفيذ: ننتظر نتيجته بدل استدعاء النموذج مرة ثانية
+    try:
+        response = app.make_response(handler())
+    except Exception:
+        _idempotency_abort(payload)
+        raise
+    _idempotency_complete(payload, response)
+    return response
+
+async def run_idempotent_async(user_id, key, fingerprint, handler, run_db):
+    """نسخة async من _run_idempotent (asgi.py). run_db ينفذ دالة في خيط قاعدة البيانات."""
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        outcome, payload = await run_db(_idempotency_begin, user_id, key, fingerprint)
+        if outcome == 'run': break
+        if outcome == 'replay': return _idempotency_replay_response(payload)
+        if outcome == 'conflict': return jsonify(IDEMPOTENCY_CONFLICT_ERROR), 422
+        if time.monotonic() >= deadline: return _idempotency_in_progress_response()
+        await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+    try:
+        response = app.make_response(await handler())
+    except Exception:
+        await run_db(_idempotency_abort, payload)
+        raise
+    await run_db(_idempotency_complete, payload, response)
+    return response
+
+def idempotent(view):
+    """يدعم ترويسة Idempotency-Key: أول استجابة تُحفظ وتُعاد كما هي عند إعادة المحاولة."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key: return view(*args, **kwargs)
+        if len(key) > 255: return jsonify({"error": "Idempotency-Key must be at most 255 characters."}), 400
+        json_body = request.get_json(silent=True) if request.is_json else None
+        user_id_val = _idempotency_user_id(request.form, json_body)
+        if user_id_val is None: return view(*args, **kwargs) # المعالج سيعيد خطأ التحقق المعتاد
+        fingerprint = _request_fingerprint(request.method, request.path, request.form, request.files, json_body)
+        return _run_idempotent(user_id_val, key, fingerprint, lambda: view(*args, **kwargs))
+    return wrapper
+# --- END: Idempotency helpers ---
+
+# --- START: Bulk admin helpers ---
+def _chunked(items, size=BULK_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _parse_bulk_id_list(data, key='ids'):
+    """يعيد (ids بدون تكرار مع الحفاظ على الترتيب, error_message)."""
+    ids = data.get(key) if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids:
+        return None, f"'{key}' must be a non-empty list of integers."
+    if len(ids) > BULK_MAX_ITEMS:
+        return None, f"Too many items in '{key}' (max {BULK_MAX_ITEMS})."
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return None, f"All items in '{key}' must be integers."
+    return list(dict.fromkeys(ids)), None
+# --- END: Bulk admin helpers ---
+
+# --- START: Soft delete helpers ---
+def live_advertisements():
+    """Advertisement.query بدون الإعلانات المحذوفة حذفًا ناعمًا."""
+    return Advertisement.query.filter(Advertisement.deleted_at.is_(None))
+
+def get_live_advertisement(ad_id):
+    advertisement = request_loader().get(Advertisement, ad_id)
+    return advertisement if advertisement is not None and advertisement.deleted_at is None else None
+
+def _soft_delete_advertisements(ad_ids):
+    """يخفي الإعلانات فورًا وينشئ مهام حذف للمنظف. Caller commits then calls _advertisements_deleted(ad_ids)."""
+    now = datetime.utcnow()
+    db.session.execute(
+        db.update(Advertisement)
+          .where(Advertisement.id.in_(ad_ids), Advertisement.deleted_at.is_(None))
+          .values(deleted_at=now, is_active=False, updated_at=now)
+    )
+    bump_catalog_version()
+    db.session.execute(db.text(
+        "INSERT OR REPLACE INTO advertisement_tombstone (advertisement_id, deleted_at) VALUES (:ad_id, :now)"
+    ), [{"ad_id": ad_id, "now": now} for ad_id in ad_ids])
+    db.session.add_all([AdvertisementPurge(advertisement_id=ad_id, requested_at=now) for ad_id in ad_ids])
+
+def _advertisements_deleted(ad_ids):
+    """بعد commit ناجح فقط: إذا فشل الـ commit تبقى ذاكرة العامل مطابقة لقاعدة البيانات."""
+    for ad_id in ad_ids:
+        interaction_index.retire_ad(ad_id)
+    _ad_purge_wakeup.set()
+    ad_catalog.invalidate()
+# --- END: Soft delete helpers ---
+
+# --- START: Background workers ---
+_background_threads = {}
+_background_threads_lock = threading.Lock()
+
+def _ensure_background_thread(name, target):
+    """يشغل خيطًا خلفيًا واحدًا لكل عملية (آمن مع fork في gunicorn)."""
+    key = (name, os.getpid())
+    if key in _background_threads: return
+    with _background_threads_lock:
+        if key in _background_threads: return
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        _background_threads[key] = thread
+        thread.start()
+
+_ad_purge_wakeup = threading.Event()
+
+# صفوف الإجراءات في الجدول الساخن ثم في الأرشيف (حتى لا يرث id يعيد SQLite استخدامه إجراءات قديمة)
+PURGE_ACTION_DELETE_SQL = [
+    "DELETE FROM user_ad_action WHERE id IN "
+    "(SELECT id FROM user_ad_action WHERE advertisement_id = :ad_id LIMIT :batch_size)",
+    "DELETE FROM user_ad_action_archive WHERE advertisement_id = :ad_id AND user_id IN "
+    "(SELECT user_id FROM user_ad_action_archive WHERE advertisement_id = :ad_id LIMIT :batch_size)",
+]
+
+def background_worker_id():
+    """معرّف هذه العملية في أعمدة owner (يُحسب عند الطلب لأن gunicorn يعمل fork بعد استيراد الوحدة)."""
+    return f"{os.uname().nodename}:{os.getpid()}"
+
+# عقد ذري: يأخذه العامل إذا لم يوجد أو انتهى أو كان له أصلًا (فيمدده). لا صف = عامل آخر يملكه.
+WORKER_LEASE_CLAIM_SQL = db.text("""
+    INSERT INTO worker_lease (name, owner, expires_at) VALUES (:name, :owner, :expires_at)
+    ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+    WHERE worker_lease.owner = excluded.owner OR worker_lease.expires_at < :now
+    RETURNING owner
+""")
+
+def claim_worker_lease(name, duration):
+    """يأخذ أو يمدد العقد name لهذه العملية ويثبّته (commit). False = يملكه عامل آخر لم ينتهِ عقده."""
+    now = datetime.utcnow()
+    claimed = db.session.execute(WORKER_LEASE_CLAIM_SQL, {
+        "name": name, "owner": background_worker_id(), "expires_at": now + duration, "now": now
+    }).first()
+    db.session.commit()
+    return claimed is not None
+
+# مطالبة ذرية: عبارة كتابة واحدة، فعاملان لا يأخذان نفس المهمة. مهمة running بلا heartbeat حديث تعود متاحة.
+PURGE_CLAIM_SQL = db.text("""
+    UPDATE advertisement_purge
+    SET status = 'running', owner = :owner, heartbeat_at = :now, updated_at = :now,
+        started_at = COALESCE(started_at, :now)
+    WHERE id = (
+        SELECT id FROM advertisement_purge
+        WHERE (status = 'pending' AND (next_attempt_at IS NULL OR next_attempt_at <= :now))
+           OR (status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < :stale_before))
+        ORDER BY id LIMIT 1
+    )
+    RETURNING id, advertisement_id, actions_total
+""")
+
+def _purge_heartbeat(job_id, owner, values):
+    """يحدّث المهمة فقط إذا كانت ما زالت ملك owner؛ False = أخذها عامل آخر (والمستدعي يتراجع)."""
+    return db.session.execute(
+        db.update(AdvertisementPurge)
+          .where(AdvertisementPurge.id == job_id, AdvertisementPurge.owner == owner, AdvertisementPurge.status == 'running')
+          .values(dict(values, heartbeat_at=datetime.utcnow(), updated_at=datetime.utcnow()))
+    ).rowcount == 1
+
+def _purge_next_advertisement():
+    """يطالب بمهمة حذف واحدة وينفذها حتى اكتمالها. يعيد False إذا لم توجد مهام متاحة لهذا العامل."""
+    owner, now = background_worker_id(), datetime.utcnow()
+    claimed = db.session.execute(PURGE_CLAIM_SQL, {"owner": owner, "now": now, "stale_before": now - PURGE_CLAIM_STALE}).first()
+    db.session.commit()
+    if claimed is None: return False
+    job_id, ad_id, actions_total = claimed
+    try:
+        if actions_total is None:
+            actions_total = db.session.query(db.func.count(UserAdAction.id))\
+                                      .filter(UserAdAction.advertisement_id == ad_id).scalar() \
+                          + db.session.query(db.func.count())\
+                                      .filter(UserAdActionArchive.advertisement_id == ad_id).scalar()
+            if not _purge_heartbeat(job_id, owner, {"actions_total": actions_total}):
+                db.session.rollback()
+                return True
+            db.session.commit()
+
+        for delete_statement in PURGE_ACTION_DELETE_SQL:
+            batch_size = PURGE_BATCH_SIZE
+            while True:
+                started = time.monotonic()
+                deleted = db.session.execute(db.text(delete_statement), {"ad_id": ad_id, "batch_size": batch_size}).rowcount
+                # التقدم والحذف في نفس المعاملة: إذا فقدنا المهمة يُلغى الحذف ولا يُحسب مرتين
+                if not _purge_heartbeat(job_id, owner, {"actions_deleted": AdvertisementPurge.actions_deleted + deleted}):
+                    db.session.rollback()
+                    app.logger.warning(f"Purger: job {job_id} (ad {ad_id}) was claimed by another worker; stopping.")
+                    return True
+                db.session.commit()
+                if deleted < batch_size: break
+                elapsed = time.monotonic() - started
+                if elapsed > PURGE_BATCH_TARGET_SECONDS:
+                    batch_size = max(PURGE_MIN_BATCH_SIZE, batch_size // 2)
+                elif elapsed < PURGE_BATCH_TARGET_SECONDS / 2:
+                    batch_size = min(PURGE_MAX_BATCH_SIZE, batch_size * 2)
+                time.sleep(PURGE_PAUSE_SECONDS)
+
+        db.session.execute(db.delete(Advertisement).where(Advertisement.id == ad_id, Advertisement.deleted_at.isnot(None)))
+        if not _purge_heartbeat(job_id, owner, {"status": 'done', "finished_at": datetime.utcnow(), "last_error": None, "owner": None}):
+            db.session.rollback()
+            return True
+        db.session.commit()
+        app.logger.info(f"Purger: Ad {ad_id} and its actions purged (job {job_id}).")
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Purger: Error purging ad {ad_id} (job {job_id}): {e}", exc_info=True)
+        job = AdvertisementPurge.query.get(job_id)
+        if job.owner == owner:
+            job.attempts += 1
+            job.last_error = str(e)
+            job.owner = None
+            if job.attempts >= PURGE_MAX_ATTEMPTS:
+                job.status = 'failed'
+            else:
+                job.status = 'pending'
+                job.next_attempt_at = datetime.utcnow() + PURGE_RETRY_BACKOFF * 2 ** (job.attempts - 1)
+            db.session.commit()
+    return True
+
+def _prune_ad_tombstones():
+    deleted = db.session.execute(db.delete(AdvertisementTombstone).where(
+        AdvertisementTombstone.deleted_at < datetime.utcnow() - AD_TOMBSTONE_RETENTION
+    )).rowcount
+    db.session.commit()
+    if deleted: app.logger.info(f"Purger: pruned {deleted} advertisement tombstones.")
+
+def _ad_purger_loop():
+    while True:
+        try:
+            with app.app_context():
+                while _purge_next_advertisement():
+                    pass
+                _prune_ad_tombstones()
+                _prune_user_events()
+        except Exception as e:
+            app.logger.error(f"Purger loop error: {e}", exc_info=True)
+        _ad_purge_wakeup.wait(PURGE_POLL_SECONDS)
+        _ad_purge_wakeup.clear()
+
+# --- START: user_ad_action hot/cold archive ---
+# user_ad_action يحمل الإجراءات الحديثة فقط؛ الأقدم من ACTION_ARCHIVE_AGE تُنقل إلى user_ad_action_archive.
+# كل قارئ يحتاج التاريخ الكامل (فحص التكرار، المهام المتبقية، فهرس التفاعلات، استعلامات المشرف) يقرأ الجدولين.
+ARCHIVE_ACTIONS_SQL = db.text(f"""
+    INSERT OR IGNORE INTO user_ad_action_archive (user_id, advertisement_id, action_code, id, created_epoch)
+    SELECT user_id, advertisement_id,
+           CASE action_type {' '.join(f"WHEN '{action_type}' THEN {code}" for action_type, code in ACTION_TYPE_CODES.items())} END,
+           id, CAST(strftime('%s', created_at) AS INTEGER)
+    FROM user_ad_action WHERE id IN :ids
+""").bindparams(db.bindparam('ids', expanding=True))
+
+# INDEXED BY: بدون ANALYZE يختار SQLite مسح الجدول كله بترتيب id؛ الفهرس يقرأ الصفوف القديمة فقط (ثم فرز صغير)
+ARCHIVE_CANDIDATES_SQL = db.text("""
+    SELECT id, action_type FROM user_ad_action INDEXED BY ix_user_ad_action_created
+    WHERE created_at < :cutoff AND id > :last_id
+    ORDER BY id LIMIT :batch_size
+""")
+
+def action_performed_clause(user_id, advertisement_id, action_type):
+    """EXISTS في user_ad_action أو في الأرشيف: uq_user_ad_action يبقى صحيحًا بعد نقل الصف."""
+    clause = db.exists().where(UserAdAction.user_id == user_id, UserAdAction.advertisement_id == advertisement_id,
+                               UserAdAction.action_type == action_type)
+    action_code = ACTION_TYPE_CODES.get(action_type)
+    if action_code is None: return clause
+    return db.or_(clause, db.exists().where(
+        UserAdActionArchive.user_id == user_id, UserAdActionArchive.advertisement_id == advertisement_id,
+        UserAdActionArchive.action_code == action_code))
+
+def user_actions_done(user_id):
+    """[(advertisement_id, action_type)] للمستخدم من الجدولين."""
+    rows = db.session.query(UserAdAction.advertisement_id, UserAdAction.action_type)\
+                     .filter(UserAdAction.user_id == user_id).all()
+    rows += [(ad_id, ACTION_TYPES_BY_CODE[code]) for ad_id, code in db.session.query(
+        UserAdActionArchive.advertisement_id, UserAdActionArchive.action_code).filter(UserAdActionArchive.user_id == user_id)]
+    return rows
+
+def archived_action_columns():
+    """(action_type, created_at) للأرشيف بنفس تمثيل user_ad_action (نص DateTime بستة أرقام للميكروثانية)."""
+    archived_type = db.case(*((UserAdActionArchive.action_code == code, action_type)
+                              for code, action_type in ACTION_TYPES_BY_CODE.items()))
+    archived_created = db.type_coerce(
+        db.func.datetime(UserAdActionArchive.created_epoch, 'unixepoch').concat('.000000'), db.DateTime)
+    return archived_type, archived_created
+
+def user_ad_actions_union():
+    """subquery بأعمدة user_ad_action (id, user_id, advertisement_id, action_type, created_at) فوق الجدولين."""
+    archived_type, archived_created = archived_action_columns()
+    return db.union_all(
+        db.select(UserAdAction.id, UserAdAction.user_id, UserAdAction.advertisement_id,
+                  UserAdAction.action_type, UserAdAction.created_at),
+        db.select(UserAdActionArchive.id, UserAdActionArchive.user_id, UserAdActionArchive.advertisement_id,
+                  archived_type.label('action_type'), archived_created.label('created_at')),
+    ).subquery('user_ad_actions')
+
+def archive_user_ad_actions(lease_name=None):
+    """
+    ينقل صفوف user_ad_action الأقدم من ACTION_ARCHIVE_AGE (created_at < cutoff عبر ix_user_ad_action_created،
+    بلا افتراض أن id يتبع created_at) على دفعات بترتيب id. أنواع غير موجودة في ACTION_TYPE_CODES تبقى في الجدول الساخن.
+    مع lease_name يُمدَّد العقد قبل كل دفعة ويتوقف النقل إذا أخذه عامل آخر.
+    """
+    cutoff = datetime.utcnow() - ACTION_ARCHIVE_AGE
+    moved, last_id = 0, 0
+    while True:
+        if lease_name and not claim_worker_lease(lease_name, ACTION_ARCHIVE_LEASE):
+            app.logger.warning(f"Archiver: lease '{lease_name}' was taken by another worker; stopping.")
+            break
+        rows = db.session.execute(ARCHIVE_CANDIDATES_SQL, {
+            "cutoff": cutoff, "last_id": last_id, "batch_size": ACTION_ARCHIVE_BATCH}).all()
+        ids = [action_id for action_id, action_type in rows if action_type in ACTION_TYPE_CODES]
+        if ids:
+            db.session.execute(ARCHIVE_ACTIONS_SQL, {"ids": ids})
+            db.session.execute(db.delete(UserAdAction).where(UserAdAction.id.in_(ids)))
+            db.session.commit()
+            moved += len(ids)
+        if len(rows) < ACTION_ARCHIVE_BATCH: break
+        last_id = rows[-1][0]
+        time.sleep(PURGE_PAUSE_SECONDS)
+    if moved: app.logger.info(f"Archiver: moved {moved} user_ad_action rows older than {cutoff.isoformat()} to the archive.")
+    return moved
+
+def _action_archiver_loop():
+    # كل عامل يشغّل الخيط، لكن العقد 'action-archiver' يجعل عاملًا واحدًا فقط يؤرشف (ويأخذه غيره إذا توقف)
+    while True:
+        try:
+            with app.app_context():
+                if claim_worker_lease('action-archiver', ACTION_ARCHIVE_LEASE):
+                    archive_user_ad_actions(lease_name='action-archiver')
+        except Exception as e:
+            app.logger.error(f"Archiver loop error: {e}", exc_info=True)
+        time.sleep(ACTION_ARCHIVE_SECONDS)
+# --- END: user_ad_action hot/cold archive ---
+
+# --- START: In-memory ad interaction bitmap index ---
+class AdInteractionIndex:
+    """
+    فهرس لكل عامل: كل إعلان يأخذ slot ثابتًا، ولكل مستخدم bitset (int) للإعلانات التي نقر رابطها
+    وآخر للإعلانات التي أنجز عليها مهمة سوشيال. الإعلانات المتاحة = active & ~(clicked | social).
+    يُبنى من قاعدة البيانات عند التشغيل، يُحدَّث فورًا من مسارات الكتابة في نفس العامل،
+    ويلتقط كتابات العمال الآخرين عبر sync() (advertisement.updated_at و user_ad_action.id كعلامات مائية).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.slot_by_ad = {}
+        self.created_by_ad = {}
+        self.ad_by_slot = []
+        self.active = 0
+        self.clicked = {}
+        self.social = {}
+        self.ads_watermark = None
+        self.actions_watermark = 0
+        self.last_sync = 0.0
+        self.built = False
+
+    def _slot(self, ad_id, created_at=None):
+        slot = self.slot_by_ad.get(ad_id)
+        if created_at is not None:
+            # id أعاد SQLite استخدامه بعد حذف الإعلان القديم: slot جديد حتى لا ترث البتات القديمة
+            if self.created_by_ad.get(ad_id, created_at) != created_at: slot = None
+            self.created_by_ad[ad_id] = created_at
+        if slot is None:
+            slot = len(self.ad_by_slot)
+            self.slot_by_ad[ad_id] = slot
+            self.ad_by_slot.append(ad_id)
+        return slot
+
+    def _load_ads(self, since=None):
+        query = db.session.query(Advertisement.id, Advertisement.is_approved, Advertisement.is_active,
+                                 Advertisement.deleted_at, Advertisement.clicked_by_user_ids, Advertisement.updated_at,
+                                 Advertisement.created_at)
+        if since is not None:
+            query = query.filter(Advertisement.updated_at >= since - INTERACTION_INDEX_SYNC_SLACK)
+        for ad_id, is_approved, is_active, deleted_at, clicked_json, updated_at, created_at in query.order_by(Advertisement.id).yield_per(5000):
+            if self.ads_watermark is None or updated_at > self.ads_watermark:
+                self.ads_watermark = updated_at
+            if deleted_at is not None:
+                self._retire(ad_id)
+                continue
+            bit = 1 << self._slot(ad_id, created_at)
+            if is_approved and is_active: self.active |= bit
+            else: self.active &= ~bit
+            try:
+                clicked_ids = json.loads(clicked_json) if clicked_json else []
+            except json.JSONDecodeError:
+                clicked_ids = []
+            for uid in clicked_ids if isinstance(clicked_ids, list) else []:
+                self.clicked[uid] = self.clicked.get(uid, 0) | bit
+
+    def _retire(self, ad_id):
+        # إعلان محذوف: يُفصل id عن الـ slot، فإذا أعاد SQLite استخدام الـ id لاحقًا أخذ slot نظيفًا
+        slot = self.slot_by_ad.pop(ad_id, None)
+        self.created_by_ad.pop(ad_id, None)
+        if slot is not None: self.active &= ~(1 << slot)
+
+    def _load_actions(self):
+        query = db.session.query(UserAdAction.id, UserAdAction.user_id, UserAdAction.advertisement_id)\
+                          .filter(UserAdAction.id > self.actions_watermark).order_by(UserAdAction.id)
+        for action_id, uid, ad_id in query.yield_per(10000):
+            self.social[uid] = self.social.get(uid, 0) | (1 << self._slot(ad_id))
+            self.actions_watermark = action_id
+
+    def _load_archived_actions(self):
+        query = db.session.query(UserAdActionArchive.user_id, UserAdActionArchive.advertisement_id)
+        for uid, ad_id in query.yield_per(10000):
+            self.social[uid] = self.social.get(uid, 0) | (1 << self._slot(ad_id))
+
+    def rebuild(self):
+        with self._lock:
+            self._reset()
+            self._load_ads()
+            self._load_actions()
+            self._load_archived_actions() # بعد الجدول الساخن: صف نُقل أثناء البناء يُرى في أحدهما
+            self.last_sync = time.monotonic()
+            self.built = True
+        app.logger.info(f"Interaction index built: {len(self.ad_by_slot)} ad slots, {bin(self.active).count('1')} active, "
+                        f"{len(self.clicked)} clickers, {len(self.social)} social users.")
+
+    def sync(self, force=False):
+        if not self.built:
+            self.rebuild()
+            return
+        if not force and time.monotonic() - self.last_sync < INTERACTION_INDEX_SYNC_SECONDS:
+            return
+        with self._lock:
+            self._load_ads(since=self.ads_watermark)
+            self._load_actions()
+            self.last_sync = time.monotonic()
+
+    def record_click(self, user_id, ad_id):
+        with self._lock:
+            if self.built: self.clicked[user_id] = self.clicked.get(user_id, 0) | (1 << self._slot(ad_id))
+
+    def record_social(self, user_id, ad_id):
+        with self._lock:
+            if self.built: self.social[user_id] = self.social.get(user_id, 0) | (1 << self._slot(ad_id))
+
+    def retire_ad(self, ad_id):
+        with self._lock:
+            if self.built: self._retire(ad_id)
+
+    def set_ad_live(self, ad_id, is_live):
+        with self._lock:
+            if not self.built: return
+            bit = 1 << self._slot(ad_id)
+            self.active = (self.active | bit) if is_live else (self.active & ~bit)
+
+    def available_ad_ids(self, user_id):
+        """معرفات الإعلانات النشطة التي لم ينقرها المستخدم ولم ينجز عليها أي مهمة."""
+        self.sync()
+        with self._lock:
+            bits = self.active & ~(self.clicked.get(user_id, 0) | self.social.get(user_id, 0))
+            ad_by_slot = self.ad_by_slot
+        ad_ids = []
+        while bits:
+            lowest = bits & -bits
+            ad_ids.append(ad_by_slot[lowest.bit_length() - 1])
+            bits ^= lowest
+        return ad_ids
+
+interaction_index = AdInteractionIndex()
+try:
+    with app.app_context():
+        interaction_index.rebuild()
+except Exception as e:
+    print(f"WARNING: Could not build interaction index at startup ({e}); it will be built on first use.")
+# --- END: In-memory ad interaction bitmap index ---
+
+# --- START: Approved ads catalog (per-worker snapshot) ---
+class CatalogAd:
+    """سجل مضغوط لإعلان موافق عليه؛ الاهتمامات والتواريخ مفكوكة مسبقًا. to_dict() = Advertisement.to_dict()."""
+    __slots__ = ('id', 'user_id', 'title', 'description', 'link', 'interests', 'number_of_clicks', 'coin_per_click',
+                 'category', 'subcategory', 'created_at', 'created_at_iso', 'updated_at_iso', 'is_active', 'clicked_by_user_ids',
+                 'starts_at_iso', 'ends_at_iso')
+
+    def __init__(self, row):
+        (self.id, self.user_id, self.title, self.description, self.link, interests_json, self.number_of_clicks,
+         self.coin_per_click, self.category, self.subcategory, self.created_at, updated_at, self.is_active, clicked_json,
+         starts_at, ends_at) = row
+        self.interests = tuple(_decode_json_list(interests_json))
+        self.clicked_by_user_ids = _decode_json_list(clicked_json)
+        self.created_at_iso = self.created_at.isoformat() if self.created_at else None
+        self.updated_at_iso = updated_at.isoformat() if updated_at else None
+        self.starts_at_iso = starts_at.isoformat() if starts_at else None
+        self.ends_at_iso = ends_at.isoformat() if ends_at else None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "title": self.title,
+            "description": self.description,
+            "link": self.link,
+            "interests": list(self.interests),
+            "number_of_clicks": self.number_of_clicks,
+            "coin_per_click": self.coin_per_click,
+            "category": self.category,
+            "subcategory": self.subcategory,
+            "created_at": self.created_at_iso,
+            "updated_at": self.updated_at_iso,
+            "is_active": self.is_active,
+            "is_approved": True,
+            "clicked_by_user_ids": list(self.clicked_by_user_ids),
+            "starts_at": self.starts_at_iso,
+            "ends_at": self.ends_at_iso
+        }
+
+def _decode_json_list(raw):
+    try:
+        value = json.loads(raw) if raw else []
+    except json.JSONDecodeError:
+        return []
+    return value if isinstance(value, list) else []
+
+class CatalogSnapshot:
+    """نسخة ثابتة من الإعلانات الموافق عليها وغير المحذوفة، مرتبة created_at تنازليًا."""
+    __slots__ = ('version', 'approved', 'active', 'by_id', 'watermark')
+
+    def __init__(self, version, ads, watermark):
+        self.version = version
+        self.watermark = watermark # كل كتابة بطابع زمني أقدم منه منعكسة في النسخة (يُعاد للتطبيق كـ since)
+        self.approved = tuple(ads)
+        self.active = tuple(ad for ad in ads if ad.is_active)
+        self.by_id = {ad.id: ad for ad in ads}
+
+class AdCatalog:
+    """
+    كتالوج الإعلانات الموافق عليها لكل عامل. القراءات لا تستعلم عن الإعلانات: تُعاد النسخة الحالية،
+    ومرة كل AD_CATALOG_CHECK_SECONDS يُقرأ catalog_version (وتُلتقط النقرات الجديدة عبر updated_at).
+    تغيّر الإصدار => تُبنى نسخة جديدة وتُستبدل ذريًا (إسناد مرجع واحد).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._stale = True
+
+    def invalidate(self):
+        """بعد commit لكتابة إدارية في هذا العامل: أعد البناء في القراءة التالية بدون انتظار."""
+        self._stale = True
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is not None and not self._stale and time.monotonic() - self._checked_at < AD_CATALOG_CHECK_SECONDS:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and not self._stale and time.monotonic() - self._checked_at < AD_CATALOG_CHECK_SECONDS:
+                return snapshot
+            self._stale = False
+            checked_at = datetime.utcnow() # قبل قراءة الإصدار: كل ما لم يظهر فيه سيكون أحدث من checked_at - AD_SYNC_SLACK
+            version = db.session.query(CatalogVersion.version).filter(CatalogVersion.id == 1).scalar() or 0
+            if snapshot is None or version != snapshot.version:
+                snapshot = self._load(version, checked_at)
+                self._snapshot = snapshot
+            else:
+                self._apply_recent_clicks(snapshot, checked_at)
+            self._checked_at = time.monotonic()
+        return snapshot
+
+    def _load(self, version, checked_at):
+        rows = db.session.query(
+            Advertisement.id, Advertisement.user_id, Advertisement.title, Advertisement.description, Advertisement.link,
+            Advertisement.interests, Advertisement.number_of_clicks, Advertisement.coin_per_click, Advertisement.category,
+            Advertisement.subcategory, Advertisement.created_at, Advertisement.updated_at, Advertisement.is_active,
+            Advertisement.clicked_by_user_ids, Advertisement.starts_at, Advertisement.ends_at
+        ).filter(Advertisement.is_approved == True, Advertisement.deleted_at.is_(None),
+                 db.or_(Advertisement.ends_at.is_(None), Advertisement.ends_at > checked_at))\
+         .order_by(Advertisement.created_at.desc(), Advertisement.id.desc()).all()
+        app.logger.info(f"Ad catalog v{version} loaded: {len(rows)} approved ads.")
+        return CatalogSnapshot(version, [CatalogAd(row) for row in rows], checked_at - AD_SYNC_SLACK)
+
+    def _apply_recent_clicks(self, snapshot, checked_at):
+        # النقرات لا ترفع الإصدار؛ تُنسخ هنا من الصفوف التي تغير updated_at لها
+        rows = db.session.query(Advertisement.id, Advertisement.number_of_clicks, Advertisement.clicked_by_user_ids,
+                                Advertisement.updated_at)\
+                         .filter(Advertisement.updated_at > snapshot.watermark).all()
+        for ad_id, number_of_clicks, clicked_json, updated_at in rows:
+            ad = snapshot.by_id.get(ad_id)
+            if ad is not None:
+                ad.number_of_clicks = number_of_clicks
+                ad.clicked_by_user_ids = _decode_json_list(clicked_json)
+                ad.updated_at_iso = updated_at.isoformat() if updated_at else None
+        snapshot.watermark = max(snapshot.watermark, checked_at - AD_SYNC_SLACK)
+
+    def record_click(self, ad_id, user_id, number_of_clicks, updated_at):
+        """نقرة نجحت في هذا العامل: حدّث السجل فورًا."""
+        snapshot = self._snapshot
+        ad = snapshot.by_id.get(ad_id) if snapshot is not None else None
+        if ad is None: return
+        with self._lock:
+            if user_id not in ad.clicked_by_user_ids:
+                ad.clicked_by_user_ids = ad.clicked_by_user_ids + [user_id]
+            ad.number_of_clicks = number_of_clicks
+            ad.updated_at_iso = updated_at.isoformat()
+
+def bump_catalog_version():
+    """ضمن معاملة المستدعي؛ بعد commit استدعِ ad_catalog.invalidate()."""
+    db.session.execute(db.text("UPDATE catalog_version SET version = version + 1 WHERE id = 1"))
+
+ad_catalog = AdCatalog()
+# --- END: Approved ads catalog (per-worker snapshot) ---
+
+# --- START: Incremental ad sync (?since=<watermark>) ---
+def parse_sync_since(raw_since):
+    """يعيد (datetime | None, error_response | None). since أقدم من AD_TOMBSTONE_RETENTION => 410 (أعد الجلب الكامل)."""
+    if not raw_since: return None, None
+    try:
+        since = datetime.fromisoformat(raw_since)
+    except ValueError:
+        return None, (jsonify({"error": "'since' must be an ISO-8601 watermark returned by a previous response."}), 400)
+    if since.tzinfo is not None:
+        since = (since - since.utcoffset()).replace(tzinfo=None)
+    if since < datetime.utcnow() - AD_TOMBSTONE_RETENTION:
+        return None, (jsonify({"error": "'since' is older than the sync retention window; fetch the full list again."}), 410)
+    return since, None
+
+def load_ad_changes(since):
+    """
+    الإعلانات التي تغير updated_at لها بعد since (عبر ix_advertisement_updated_at) ومعرفات الإعلانات المحذوفة.
+    يعيد (changed_ads, deleted_ids, watermark). العلامة الجديدة = الآن - AD_SYNC_SLACK (كتابات أقدم منها تمت بالتأكيد)،
+    لذا قد يتكرر في المزامنة التالية ما تغير خلال آخر AD_SYNC_SLACK فقط.
+    """
+    started = datetime.utcnow()
+    changed_ads = Advertisement.query.filter(Advertisement.updated_at > since).all()
+    changed_ads.sort(key=lambda ad: (ad.created_at, ad.id), reverse=True) # صفوف قليلة: الترتيب هنا بدل TEMP B-TREE
+    tombstones = db.session.query(AdvertisementTombstone.advertisement_id, AdvertisementTombstone.deleted_at)\
+                           .filter(AdvertisementTombstone.deleted_at > since).all()
+    return changed_ads, {ad_id for ad_id, _ in tombstones}, max(since, started - AD_SYNC_SLACK)
+
+def ad_sync_response(upserts, removed_ids, watermark):
+    return jsonify({
+        "advertisements": upserts,
+        "removed_ids": sorted(removed_ids),
+        "watermark": watermark.isoformat()
+    }), 200
+# --- END: Incremental ad sync ---
+
+# --- START: User event bus (SSE) ---
+# الناشر يكتب صف user_event ضمن معاملته (الحدث يُرى فقط إذا نجح الـ commit)، وفي كل عامل خيط واحد
+# يقرأ الصفوف الجديدة بالـ id ويوزعها على اشتراكات SSE في هذا العامل. استعلام واحد لكل عامل كل
+# EVENT_BUS_POLL_SECONDS بدل استعلام لكل عميل، ولا يعمل الخيط إذا لم يوجد مشتركون.
+# كل اتصال SSE يحجز خيطًا: شغّل gunicorn بـ -k gthread (أو asgi.py) وليس بعمال sync.
+def publish_event(user_id, event_type, data):
+    """ضمن معاملة المستدعي (user_id=None لكل المستخدمين)؛ بعد commit استدعِ event_bus.notify()."""
+    db.session.add(UserEvent(user_id=user_id, event_type=event_type, payload=json.dumps(data)))
+
+class EventSubscription:
+    __slots__ = ('user_id', 'queue', 'overflowed')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=EVENT_SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False # العميل البطيء يُغلق بثه ويستأنف من القاعدة بـ Last-Event-ID
+
+class EventBus:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {} # user_id -> set(EventSubscription)
+        self._cursor = None # آخر id وُزع؛ None عندما لا يوجد مشتركون
+        self._wakeup = threading.Event()
+
+    def notify(self):
+        """يوقظ الموزع في هذا العامل فورًا (العمال الآخرون يرون الحدث خلال EVENT_BUS_POLL_SECONDS)."""
+        self._wakeup.set()
+
+    def subscribe(self, user_id):
+        """يعيد (subscription, cursor): كل حدث id > cursor سيصل إلى الاشتراك."""
+        subscription = EventSubscription(user_id)
+        with self._lock:
+            if self._cursor is None:
+                self._cursor = db.session.query(db.func.coalesce(db.func.max(UserEvent.id), 0)).scalar()
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            cursor = self._cursor
+        _ensure_background_thread('event-bus', self._run)
+        return subscription, cursor
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers: del self._subscribers[subscription.user_id]
+            if not self._subscribers: self._cursor = None
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def _dispatch(self, cursor, events):
+        with self._lock:
+            if self._cursor != cursor: return # تغير المشتركون أثناء القراءة؛ الدورة التالية تبدأ من المؤشر الجديد
+            for event_id, user_id, message in events:
+                targets = (s for subs in self._subscribers.values() for s in subs) if user_id is None \
+                          else self._subscribers.get(user_id, ())
+                for subscription in targets:
+                    try:
+                        subscription.queue.put_nowait((event_id, message))
+                    except queue.Full:
+                        subscription.overflowed = True
+            self._cursor = events[-1][0]
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(EVENT_BUS_POLL_SECONDS)
+            self._wakeup.clear()
+            with self._lock:
+                cursor = self._cursor
+            if cursor is None: continue
+            try:
+                with app.app_context():
+                    rows = UserEvent.query.filter(UserEvent.id > cursor).order_by(UserEvent.id).limit(EVENT_BUS_BATCH).all()
+                    events = [(row.id, row.user_id, row.to_sse()) for row in rows]
+            except Exception as e:
+                app.logger.error(f"Event bus poll error: {e}", exc_info=True)
+                continue
+            if events:
+                self._dispatch(cursor, events)
+                if len(events) == EVENT_BUS_BATCH: self._wakeup.set()
+
+event_bus = EventBus()
+
+def _prune_user_events():
+    deleted = db.session.execute(db.delete(UserEvent).where(
+        UserEvent.created_at < datetime.utcnow() - EVENT_RETENTION
+    )).rowcount
+    db.session.commit()
+    if deleted: app.logger.info(f"Purger: pruned {deleted} user events.")
+# --- END: User event bus (SSE) ---
+
+# --- START: Coins leaderboard ---
+# كل عامل يحمل أعلى LEADERBOARD_SIZE + LEADERBOARD_BUFFER صفًا من ix_user_coins و ix_weekly_earnings_week_coins،
+# ومدرجًا تكراريًا (قيمة الرصيد -> عدد المستخدمين) من نفس الفهرسين. الترتيب = 1 + عدد من يملك رصيدًا أكبر،
+# ويُحسب بـ bisect على المدرج (O(log عدد القيم المختلفة)) بدل COUNT على الصفوف. تغييرات هذا العامل تُطبق فورًا
+# على القائمة والمدرج؛ تغييرات العمال الآخرين والتعديلات الإدارية تظهر عند إعادة التحميل كل LEADERBOARD_REFRESH_SECONDS.
+WEEKLY_EARNINGS_UPSERT_SQL = """
+    INSERT INTO weekly_earnings (week_start, user_id, coins) VALUES (:week_start, :user_id, :coins)
+    ON CONFLICT (week_start, user_id) DO UPDATE SET coins = coins + excluded.coins
+"""
+USER_EARNINGS_UPSERT_SQL = """
+    INSERT INTO user_earnings (user_id, source, count, coins) VALUES (:user_id, :source, 1, :coins)
+    ON CONFLICT (user_id, source) DO UPDATE SET count = count + 1, coins = coins + excluded.coins
+"""
+
+def current_week_start(now=None):
+    now = now or datetime.utcnow()
+    return (now - timedelta(days=now.weekday())).date()
+
+def record_earnings(user_id, coins, source):
+    """
+    ضمن معاملة المستدعي: يحدّث ملخص user_earnings للمصدر وأرباح الأسبوع.
+    يعيد أرباح المستخدم هذا الأسبوع بعد الإضافة (None إذا coins <= 0). بعد commit استدعِ leaderboard.record().
+    """
+    db.session.execute(db.text(USER_EARNINGS_UPSERT_SQL), {"user_id": user_id, "source": source, "coins": coins})
+    if coins <= 0: return None
+    return db.session.execute(db.text(WEEKLY_EARNINGS_UPSERT_SQL + " RETURNING coins"), {
+        "week_start": current_week_start().isoformat(), "user_id": user_id, "coins": coins
+    }).scalar()
+
+class RankedBoard:
+    """أعلى الصفوف [(-coins, user_id)] بترتيب تصاعدي، والمدرج التكراري للقيم مع تغييرات محلية منذ التحميل."""
+    __slots__ = ('top', 'values', 'at_or_above', 'moves')
+
+    def __init__(self, top_rows, histogram_rows):
+        self.top = [(-coins, user_id) for coins, user_id in top_rows]
+        histogram = sorted(histogram_rows)
+        self.values = [coins for coins, _ in histogram]
+        self.at_or_above = [0] * (len(histogram) + 1)
+        for i in range(len(histogram) - 1, -1, -1):
+            self.at_or_above[i] = self.at_or_above[i + 1] + histogram[i][1]
+        self.moves = [] # (old_coins | None, new_coins)
+
+    def users_above(self, coins):
+        above = self.at_or_above[bisect.bisect_right(self.values, coins)]
+        for old, new in self.moves:
+            above += (new > coins) - (old is not None and old > coins)
+        return above
+
+    def rank(self, coins):
+        return 1 + self.users_above(coins)
+
+    def apply(self, user_id, old, new):
+        self.moves.append((old, new))
+        capacity = LEADERBOARD_SIZE + LEADERBOARD_BUFFER
+        entry = (-new, user_id)
+        top = [e for e in self.top if e[1] != user_id]
+        # قائمة ممتلئة: من يتراجع تحت آخر صف محمّل يخرج منها (من يليه غير معروف حتى إعادة التحميل)
+        if len(self.top) < capacity or (top and entry < top[-1]):
+            bisect.insort(top, entry)
+        self.top = top[:capacity]
+
+class Leaderboard:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._boards = None # {"all": RankedBoard, "week": RankedBoard}
+        self._week_start = None
+        self._loaded_at = 0.0
+        self._refreshing = False
+
+    def boards(self):
+        """
+        يعيد (boards, week_start). عند انتهاء المدة يُعاد التحميل (مسح المدرجين) في خيط خلفي وتُخدم اللوحات
+        الحالية حتى ينتهي؛ التحميل داخل الطلب فقط أول مرة وعند بداية أسبوع جديد.
+        """
+        week_start = current_week_start()
+        with self._lock:
+            if self._boards is not None and self._week_start == week_start:
+                stale = (time.monotonic() - self._loaded_at >= LEADERBOARD_REFRESH_SECONDS
+                         or len(self._boards["all"].moves) >= LEADERBOARD_MAX_LOCAL_MOVES)
+                if stale and not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh, args=(week_start,), name='leaderboard-refresh', daemon=True).start()
+                return self._boards, week_start
+        boards = self._load(week_start)
+        self._store(boards, week_start)
+        return boards, week_start
+
+    def _store(self, boards, week_start):
+        with self._lock:
+            if self._week_start is not None and week_start < self._week_start: return # تحميل متأخر لأسبوع سابق
+            self._boards, self._week_start, self._loaded_at = boards, week_start, time.monotonic()
+
+    def _refresh(self, week_start):
+        try:
+            with app.app_context():
+                self._store(self._load(week_start), week_start)
+        except Exception as e:
+            app.logger.error(f"Leaderboard refresh error: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _load(self, week_start):
+        limit = LEADERBOARD_SIZE + LEADERBOARD_BUFFER
+        top_all = db.session.query(User.coins, User.id).order_by(User.coins.desc(), User.id).limit(limit).all()
+        histogram_all = db.session.query(User.coins, db.func.count()).group_by(User.coins).all()
+        week_filter = WeeklyEarnings.week_start == week_start
+        top_week = db.session.query(WeeklyEarnings.coins, WeeklyEarnings.user_id).filter(week_filter)\
+                             .order_by(WeeklyEarnings.coins.desc(), WeeklyEarnings.user_id).limit(limit).all()
+        histogram_week = db.session.query(WeeklyEarnings.coins, db.func.count()).filter(week_filter)\
+                                   .group_by(WeeklyEarnings.coins).all()
+        return {"all": RankedBoard(top_all, histogram_all), "week": RankedBoard(top_week, histogram_week)}
+
+    def record(self, user_id, balance, earned, weekly_total):
+        """بعد commit: balance و weekly_total هما القيمتان الجديدتان بعد إضافة earned."""
+        with self._lock:
+            if self._boards is None: return
+            self._boards["all"].apply(user_id, balance - earned, balance)
+            if weekly_total is not None and self._week_start == current_week_start():
+                previous = weekly_total - earned
+                self._boards["week"].apply(user_id, previous if previous > 0 else None, weekly_total)
+
+leaderboard = Leaderboard()
+# --- END: Coins leaderboard ---
+
+# --- START: Ad scheduling (starts_at / ends_at) ---
+def parse_ad_schedule(data, current_starts=None, current_ends=None):
+    """يعيد (starts_at, ends_at, error). القيم ISO-8601 (بدون منطقة زمنية = UTC)، null يلغي الحد، والحقل الغائب يبقى كما هو."""
+    values = {'starts_at': current_starts, 'ends_at': current_ends}
+    for field in values:
+        if field not in data: continue
+        raw = data[field]
+        if raw is None:
+            values[field] = None
+            continue
+        try:
+            value = datetime.fromisoformat(raw) if isinstance(raw, str) else None
+        except ValueError:
+            value = None
+        if value is None: return None, None, f"'{field}' must be an ISO-8601 datetime or null."
+        if value.tzinfo is not None:
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+        values[field] = value
+    starts_at, ends_at = values['starts_at'], values['ends_at']
+    if starts_at is not None and ends_at is not None and ends_at <= starts_at:
+        return None, None, "'ends_at' must be after 'starts_at'."
+    return starts_at, ends_at, None
+
+def _ad_in_schedule_window(now):
+    return db.and_(db.or_(Advertisement.starts_at.is_(None), Advertisement.starts_at <= now),
+                   db.or_(Advertisement.ends_at.is_(None), Advertisement.ends_at > now))
+
+def apply_ad_schedule(ad_ids, now):
+    """
+    يضبط is_active = (now داخل [starts_at, ends_at)) للإعلانات المعطاة ويكتب فقط ما تغير فعلًا
+    (UPDATE مشروط: تكرار التطبيق من عدة عمال لا يغير شيئًا). يعيد عدد الإعلانات التي تغيرت.
+    """
+    in_window = _ad_in_schedule_window(now)
+    rows = db.session.execute(
+        db.update(Advertisement)
+          .where(Advertisement.id.in_(ad_ids), Advertisement.deleted_at.is_(None), Advertisement.is_active != in_window)
+          .values(is_active=in_window, updated_at=now)
+          .returning(Advertisement.id, Advertisement.is_active, Advertisement.is_approved)
+          .execution_options(synchronize_session=False)
+    ).all()
+    if not rows:
+        db.session.rollback()
+        return 0
+    bump_catalog_version()
+    started = sorted(ad_id for ad_id, is_active, is_approved in rows if is_active and is_approved)
+    if started: publish_event(None, "ads_available", {"advertisement_ids": started})
+    db.session.commit()
+    event_bus.notify()
+    ad_catalog.invalidate()
+    for ad_id, is_active, is_approved in rows:
+        interaction_index.set_ad_live(ad_id, is_active and is_approved)
+    app.logger.info(f"Ad schedule: {len(started)} started, {len(rows) - len(started)} changed otherwise at {now.isoformat()}.")
+    return len(rows)
+
+def catch_up_ad_schedules(now):
+    """
+    عند بدء العامل: كل إعلان بدأ أو انتهى موعده (starts_at <= now أو ends_at <= now، عبر الفهرسين الجزئيين)
+    و is_active لا يطابق نافذته، مهما كان عمر الانتقال الفائت. يعيد عدد الإعلانات التي تغيرت.
+    """
+    ad_ids = db.session.scalars(db.select(Advertisement.id).where(
+        db.or_(Advertisement.starts_at <= now, Advertisement.ends_at <= now),
+        Advertisement.is_active != _ad_in_schedule_window(now))).all() # المحذوفة يتجاهلها apply_ad_schedule
+    db.session.rollback()
+    return sum(apply_ad_schedule(ad_ids[i:i + AD_SCHEDULE_HEAP_SIZE], now)
+               for i in range(0, len(ad_ids), AD_SCHEDULE_HEAP_SIZE))
+
+class AdScheduleSweeper:
+    """
+    min-heap لكل عامل من الانتقالات القادمة (due_at, ad_id)، يُملأ بأقرب AD_SCHEDULE_HEAP_SIZE قيمة من
+    ix_advertisement_starts_at و ix_advertisement_ends_at (مسح نطاق بالفهرس، لا مسح للجدول). الإعلانات المحذوفة
+    حذفًا ناعمًا تبقى في الفهرس حتى يحذفها المنظف، و apply_ad_schedule يتجاهلها.
+    الخيط ينام حتى أقرب انتقال، ويعيد ملء الكومة فقط عندما يتغير catalog_version أو يتجاوز الوقت أفق الكومة.
+    الانتقالات المتساوية مع آخر صف محمّل تُحمّل كلها، فالأفق يتقدم دائمًا ولو شارك أكثر من AD_SCHEDULE_HEAP_SIZE
+    إعلانًا نفس الوقت. أول tick يشغّل catch_up_ad_schedules لكل ما فات قبل بدء العامل.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._horizon = None # انتقالات بعد الأفق لم تُحمّل بعد (None = كل الانتقالات محمّلة)
+        self._version = None
+        self._swept_until = None # كل انتقال حتى هذا الوقت طُبق
+        self._wakeup = threading.Event()
+
+    def notify(self):
+        """بعد commit لجدولة في هذا العامل: أعد تحميل الكومة الآن بدل انتظار AD_SCHEDULE_POLL_SECONDS."""
+        self._version = None
+        self._wakeup.set()
+
+    def _reload(self, version):
+        heap, horizon = [], None
+        for column in (Advertisement.starts_at, Advertisement.ends_at):
+            rows = db.session.query(column, Advertisement.id)\
+                             .filter(column > self._swept_until)\
+                             .order_by(column, Advertisement.id).limit(AD_SCHEDULE_HEAP_SIZE).all()
+            if len(rows) == AD_SCHEDULE_HEAP_SIZE:
+                last_due, last_id = rows[-1]
+                rows += db.session.query(column, Advertisement.id)\
+                                  .filter(column == last_due, Advertisement.id > last_id).all()
+                horizon = last_due if horizon is None else min(horizon, last_due)
+            heap.extend((due_at, ad_id) for due_at, ad_id in rows)
+        if horizon is not None:
+            heap = [item for item in heap if item[0] <= horizon]
+        heapq.heapify(heap)
+        self._heap, self._horizon, self._version = heap, horizon, version
+
+    def tick(self):
+        """يطبق الانتقالات المستحقة ويعيد الثواني حتى الفحص التالي."""
+        now = datetime.utcnow()
+        if self._swept_until is None:
+            catch_up_ad_schedules(now)
+            self._swept_until = now
+        version = db.session.query(CatalogVersion.version).filter(CatalogVersion.id == 1).scalar() or 0
+        db.session.rollback()
+        if version != self._version or (self._horizon is not None and self._horizon < now):
+            self._reload(version)
+            db.session.rollback()
+        due_ids, last_due = set(), None
+        while self._heap and self._heap[0][0] <= now:
+            last_due, ad_id = heapq.heappop(self._heap)
+            due_ids.add(ad_id)
+        if due_ids: apply_ad_schedule(sorted(due_ids), now)
+        if self._horizon is not None and self._horizon < now:
+            # أكثر من AD_SCHEDULE_HEAP_SIZE انتقالًا فائتًا: تابع من آخر ما طُبق (>= الأفق) مباشرة
+            self._swept_until = last_due or self._swept_until
+            self._version = None
+            return 0
+        self._swept_until = now
+        next_due = min(filter(None, (self._heap[0][0] if self._heap else None, self._horizon)), default=None)
+        if next_due is None: return AD_SCHEDULE_POLL_SECONDS
+        return min(max((next_due - datetime.utcnow()).total_seconds(), 0), AD_SCHEDULE_POLL_SECONDS)
+
+    def run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = AD_SCHEDULE_POLL_SECONDS
+            try:
+                with app.app_context():
+                    timeout = self.tick()
+            except Exception as e:
+                app.logger.error(f"Ad schedule sweeper error: {e}", exc_info=True)
+            if timeout > 0:
+                self._wakeup.wait(timeout)
+
+ad_schedule_sweeper = AdScheduleSweeper()
+# --- END: Ad scheduling ---
+
+@app.before_request
+def _start_background_workers():
+    if AD_PURGER_ENABLED:
+        _ensure_background_thread('ad-purger', _ad_purger_loop)
+    if SCREENSHOT_STORE_ENABLED:
+        _ensure_background_thread('screenshot-evictor', _screenshot_evictor_loop)
+    if ACTION_ARCHIVE_ENABLED:
+        _ensure_background_thread('action-archiver', _action_archiver_loop)
+    if AD_SCHEDULE_ENABLED:
+        _ensure_background_thread('ad-schedule-sweeper', ad_schedule_sweeper.run)
+# --- END: Background workers ---
+
+# --- START: Response compression ---
+# ترميز الاستجابة يُختار من Accept-Encoding (br إن كانت مكتبة brotli مثبتة، وإلا gzip). الأجسام العادية
+# تُضغط دفعة واحدة إذا تجاوزت COMPRESSION_MIN_BYTES؛ الأجسام المبثوثة (stream_json_response) تُضغط جزءًا
+# جزءًا مع تفريغ بعد كل جزء، فلا يُبنى الجسم كاملًا في الذاكرة لا قبل الضغط ولا بعده.
+compression_stats = {} # route -> counters (لكل عامل)
+_compression_stats_lock = threading.Lock()
+
+def _compression_counters(route):
+    return compression_stats.setdefault(route, {"compressed": 0, "skipped_small": 0, "raw_bytes": 0,
+                                                "compressed_bytes": 0, "cpu_seconds": 0.0, "by_encoding": {}})
+
+class ResponseCompressor:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # 16+: غلاف gzip
+        self.raw_bytes = self.compressed_bytes = 0
+        self.cpu_seconds = 0.0
+
+    def compress(self, chunk, flush=True):
+        """flush=True يُخرج كل ما ضُغط حتى الآن ليصل الجزء للعميل فورًا (على حساب بضعة بايتات)."""
+        started = time.thread_time()
+        if self.encoding == 'br':
+            out = self._compressor.process(chunk) + (self._compressor.flush() if flush else b'')
+        else:
+            out = self._compressor.compress(chunk) + (self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else b'')
+        self.cpu_seconds += time.thread_time() - started
+        self.raw_bytes += len(chunk)
+        self.compressed_bytes += len(out)
+        return out
+
+    def finish(self):
+        started = time.thread_time()
+        out = self._compressor.finish() if self.encoding == 'br' else self._compressor.flush()
+        self.cpu_seconds += time.thread_time() - started
+        self.compressed_bytes += len(out)
+        return out
+
+    def record(self, route):
+        with _compression_stats_lock:
+            counters = _compression_counters(route)
+            counters["compressed"] += 1
+            counters["raw_bytes"] += self.raw_bytes
+            counters["compressed_bytes"] += self.compressed_bytes
+            counters["cpu_seconds"] += self.cpu_seconds
+            counters["by_encoding"][self.encoding] = counters["by_encoding"].get(self.encoding, 0) + 1
+
+def _compress_stream(compressor, chunks, original, route):
+    try:
+        for chunk in chunks:
+            out = compressor.compress(chunk)
+            if out: yield out
+        yield compressor.finish()
+    finally:
+        if hasattr(original, 'close'): original.close() # ينهي stream_with_context ويحرر سياق الطلب
+        compressor.record(route)
+
+@app.after_request
+def _compress_response(response):
+    if not COMPRESSION_ENABLED or response.mimetype not in COMPRESSIBLE_MIMETYPES: return response
+    response.vary.add('Accept-Encoding')
+    if (request.method == 'HEAD' or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or 'no-transform' in response.headers.get('Cache-Control', '')):
+        return response
+    encoding = request.accept_encodings.best_match(('br', 'gzip') if brotli is not None else ('gzip',))
+    if encoding is None: return response
+    route = request.url_rule.rule if request.url_rule else request.path
+    compressor = ResponseCompressor(encoding)
+    if response.is_streamed:
+        # stream_json_response لا يبث إلا جسمًا تجاوز COMPRESSION_MIN_BYTES
+        response.response = _compress_stream(compressor, response.iter_encoded(), response.response, route)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_BYTES:
+            with _compression_stats_lock: _compression_counters(route)["skipped_small"] += 1
+            return response
+        response.set_data(compressor.compress(data, flush=False) + compressor.finish())
+        compressor.record(route)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def _json_chunks(items, prefix, suffix):
+    """يسلسل items إلى نص JSON بأجزاء من STREAM_JSON_CHUNK_BYTES تقريبًا: prefix + [item,...] + suffix."""
+    buffer, size, separator = [prefix + '['], 0, ''
+    try:
+        for item in items:
+            encoded = app.json.dumps(item, separators=(',', ':'))
+            buffer.append(separator + encoded)
+            separator = ','
+            size += len(encoded)
+            if size >= STREAM_JSON_CHUNK_BYTES:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+    except Exception as e:
+        app.logger.error(f"Error while streaming JSON response for {request.path}: {e}", exc_info=True)
+        raise
+    buffer.append(']' + suffix)
+    yield ''.join(buffer)
+
+def stream_json_response(items, status=200, headers=None, envelope=None, list_key=None):
+    """
+    بديل jsonify لقوائم كبيرة: يبث مصفوفة items (أو كائن envelope مع القائمة تحت list_key) دون بناء
+    الجسم كاملًا في الذاكرة. أول STREAM_JSON_BATCH_ROWS عنصرًا (أول دفعة من iter_rows_by_ids) تُقرأ هنا،
+    ثم الأجزاء الأولى حتى COMPRESSION_MIN_BYTES: جسم أصغر يُعاد كاستجابة عادية، وإلا يستمر البث بسياق
+    الطلب (items قد تقرأ من قاعدة البيانات أثناء البث). خطأ حتى هذه النقطة يصل للمستدعي (فيعيد 500)؛
+    بعدها تكون الحالة 200 قد أُرسلت، فالخطأ يُسجل في السجل وينتهي الجسم مقطوعًا (JSON غير صالح) بدل 500.
+    """
+    prefix, suffix = '', '\n'
+    if envelope is not None:
+        prefix = '{' + app.json.dumps(list_key) + ':'
+        suffix = (',' + app.json.dumps(envelope, separators=(',', ':'))[1:] if envelope else '}') + '\n'
+    items = iter(items)
+    first_batch = list(itertools.islice(items, STREAM_JSON_BATCH_ROWS))
+    chunks = _json_chunks(itertools.chain(first_batch, items), prefix, suffix)
+    head, size = [], 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= COMPRESSION_MIN_BYTES: break
+    else:
+        return Response(''.join(head), status=status, headers=headers, mimetype=app.json.mimetype)
+
+    def resume():
+        yield from head
+        yield from chunks
+    return Response(stream_with_context(resume()), status=status, headers=headers, mimetype=app.json.mimetype)
+
+def iter_rows_by_ids(model, ids):
+    """صفوف model بترتيب ids، باستعلام قصير لكل STREAM_JSON_BATCH_ROWS (لا يُحجز قفل القراءة طوال البث)."""
+    for start in range(0, len(ids), STREAM_JSON_BATCH_ROWS):
+        batch_ids = ids[start:start + STREAM_JSON_BATCH_ROWS]
+        rows = {row.id: row for row in model.query.filter(model.id.in_(batch_ids))}
+        for row_id in batch_ids:
+            if row_id in rows: yield rows[row_id]
+# --- END: Response compression ---
+
 # --- نقاط النهاية (API Endpoints) ---
 
 @app.route('/register', methods=['POST'])
@@ -379,20 +2760,18 @@ def register():
 
     try:
         db.session.add(new_user)
+        db.session.flush() # للحصول على new_user.id داخل نفس المعاملة
+        if referrer:
+            # حافة الإحالة + قائمة JSON القديمة + المكافآت كلها في نفس المعاملة
+            db.session.add(Referral(referrer_id=referrer.id, referred_id=new_user.id))
+            referred_ids = referrer.get_referred_by_me_ids()
+            if new_user.id not in referred_ids:
+                referred_ids.append(new_user.id)
+                referrer.set_referred_by_me_ids(referred_ids)
+            awarded = _credit_referral_bonuses(referrer.id)
+            app.logger.info(f"Referral bonuses for new user {new_user.id}: {awarded}")
         db.session.commit()
         app.logger.info(f"New user created with ID: {new_user.id}")
-        if referrer:
-            try:
-                referred_ids = referrer.get_referred_by_me_ids()
-                if new_user.id not in referred_ids:
-                    referred_ids.append(new_user.id)
-                    referrer.set_referred_by_me_ids(referred_ids)
-                referrer.coins += 100 # Award coins to referrer
-                app.logger.info(f"Awarding 100 coins to referrer {referrer.id}. New balance: {referrer.coins}")
-                db.session.commit()
-            except Exception as e_ref:
-                db.session.rollback()
-                app.logger.error(f"ERROR updating referrer {referrer.id} for new user {new_user.id}: {e_ref}", exc_info=True)
         return jsonify({"message": "User registered successfully!", "user": new_user.to_dict()}), 201
     except Exception as e_reg:
         db.session.rollback()
@@ -411,56 +2790,149 @@ def login():
     return jsonify({"message": "Login successful!", "user": user.to_dict()}), 200
 
 @app.route('/users/<int:user_id_param>/spin_wheel', methods=['POST'])
-def spin_wheel(user_id_param): 
-    user = User.query.get(user_id_param)
-    if user is None: return jsonify({"error": f"User with ID {user_id_param} not found"}), 404
+def spin_wheel(user_id_param):
     now = datetime.utcnow()
-    cooldown_period = timedelta(hours=24)
-    can_spin = False
-    remaining_time_str = ""
-    remaining_seconds = 0
-
-    if user.last_spin_time is None or (now - user.last_spin_time) >= cooldown_period:
-        can_spin = True
-    else:
-        remaining_time = cooldown_period - (now - user.last_spin_time)
-        remaining_seconds = int(remaining_time.total_seconds())
-        hours, remainder = divmod(remaining_seconds, 3600)
-        minutes, seconds_val = divmod(remainder, 60)
-        remaining_time_str = f"{hours}h {minutes}m {seconds_val}s"
-
-    if can_spin:
-        try:
-            # prize_coins = random.randint(10, 50) # Example: Implement actual prize logic
-            # user.coins += prize_coins
-            user.last_spin_time = now
+    try:
+        prize_id, prize_label, prize_coins, _ = get_spin_sampler().sample() # قد يعيد تحميل جدول الجوائز من قاعدة البيانات
+        # المطالبة بالدورة ومنح الجائزة في عبارة UPDATE شرطية واحدة:
+        # طلبان متزامنان لا يمكن أن ينجحا معًا بدون أقفال صفوف
+        claimed_balance = db.session.execute(
+            db.update(User)
+              .where(User.id == user_id_param,
+                     db.or_(User.last_spin_time.is_(None), User.last_spin_time <= now - SPIN_COOLDOWN))
+              .values(last_spin_time=now, coins=User.coins + prize_coins)
+              .returning(User.coins)
+        ).scalar()
+        if claimed_balance is not None:
+            db.session.add(SpinHistory(user_id=user_id_param, prize_id=prize_id, coins=prize_coins, created_at=now))
+            weekly_total = record_earnings(user_id_param, prize_coins, 'spin')
+            publish_event(user_id_param, "coins", {"coins": claimed_balance, "delta": prize_coins, "reason": "spin"})
             db.session.commit()
-            app.logger.info(f"User {user_id_param} spin successful. Last spin time updated.")
+            event_bus.notify()
+            leaderboard.record(user_id_param, claimed_balance, prize_coins, weekly_total)
+            app.logger.info(f"User {user_id_param} spin successful. Prize '{prize_label}' (+{prize_coins} coins). New balance: {claimed_balance}")
             return jsonify({
                 "status": 1,
                 "message": "Spin successful! You can spin again in 24 hours.",
-                "new_coins_balance": user.coins # Ensure this reflects any prize coins awarded
+                "prize": {"id": prize_id, "label": prize_label, "coins": prize_coins},
+                "new_coins_balance": claimed_balance
             }), 200
-        except Exception as e:
-            db.session.rollback()
-            app.logger.error(f"Error during spin for user {user_id_param}: {e}", exc_info=True)
-            return jsonify({"error": "Internal server error processing spin"}), 500
-    else:
-        return jsonify({
-            "status": 0,
-            "message": f"Please wait. Time remaining: {remaining_time_str}",
-            "remaining_seconds": remaining_seconds
-        }), 200
+        db.session.rollback()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error during spin for user {user_id_param}: {e}", exc_info=True)
+        return jsonify({"error": "Internal server error processing spin"}), 500
+
+    user = User.query.get(user_id_param)
+    if user is None: return jsonify({"error": f"User with ID {user_id_param} not found"}), 404
+    remaining_seconds = max(0, int((SPIN_COOLDOWN - (now - user.last_spin_time)).total_seconds())) if user.last_spin_time else 0
+    hours, remainder = divmod(remaining_seconds, 3600)
+    minutes, seconds_val = divmod(remainder, 60)
+    return jsonify({
+        "status": 0,
+        "message": f"Please wait. Time remaining: {hours}h {minutes}m {seconds_val}s",
+        "remaining_seconds": remaining_seconds
+    }), 200
 
 @app.route('/users', methods=['GET'])
 def get_all_users():
     try:
-        all_users = User.query.all()
-        return jsonify([user.to_dict(include_ads=False) for user in all_users]), 200
+        user_ids = db.session.execute(db.select(User.id).order_by(User.id)).scalars().all()
+        return stream_json_response(user.to_dict(include_ads=False) for user in iter_rows_by_ids(User, user_ids))
     except Exception as e:
         app.logger.error(f"Error fetching all users: {e}", exc_info=True)
         return jsonify({"error": "Internal Server Error fetching users"}), 500
 
+# --- بحث المشرف عن المستخدمين ---
+USER_SEARCH_MAX_CANDIDATES = 1000 # لكل فرع مطابقة؛ فرع بلغ الحد يجعل الاستجابة truncated: true (يجب تضييق الاستعلام)
+USER_SEARCH_MATCH_LABELS = {0: "exact", 1: "email_prefix", 2: "phone_prefix", 3: "name_prefix", 4: "substring"}
+PHONE_QUERY_RE = re.compile(r'^[\d\s+\-().]+$')
+
+def _build_user_search_sql(use_phone, use_fts):
+    """
+    مرشحون من فروع بادئة (B-tree) وجزء من النص (trigram)، ثم درجة: تطابق تام < بادئة < جزء.
+    يعيد (match_cte, truncated_sql)؛ الثاني 1 إذا بلغ أي فرع USER_SEARCH_MAX_CANDIDATES (مرشحون أُسقطوا).
+    """
+    branches = ["SELECT id FROM (SELECT id FROM user WHERE search_email >= :prefix AND search_email < :prefix_end LIMIT :cap)",
+                "SELECT id FROM (SELECT id FROM user WHERE search_name >= :prefix AND search_name < :prefix_end LIMIT :cap)"]
+    exact = "u.search_email = :q OR u.search_name = :q"
+    phone_prefix = ""
+    if use_phone:
+        branches.append("SELECT id FROM (SELECT id FROM user WHERE search_phone >= :digits AND search_phone < :digits_end LIMIT :cap)")
+        exact += " OR u.search_phone = :digits"
+        phone_prefix = "WHEN u.search_phone >= :digits AND u.search_phone < :digits_end THEN 2"
+    if use_fts:
+        branches.append("SELECT id FROM (SELECT rowid AS id FROM user_search_fts WHERE user_search_fts MATCH :fts_query LIMIT :cap)")
+    truncated_sql = "SELECT MAX(n >= :cap) FROM (" + " UNION ALL ".join(f"SELECT COUNT(*) AS n FROM ({branch})" for branch in branches) + ")"
+    return f"""
+    WITH candidates AS ({' UNION '.join(branches)}),
+    matches AS (
+        SELECT u.id AS id, CASE
+            WHEN {exact} THEN 0
+            WHEN u.search_email >= :prefix AND u.search_email < :prefix_end THEN 1
+            {phone_prefix}
+            WHEN u.search_name >= :prefix AND u.search_name < :prefix_end THEN 3
+            ELSE 4 END AS score
+        FROM candidates JOIN user u ON u.id = candidates.id
+    )
+    """, truncated_sql
+
+@app.route('/admin/users/search', methods=['GET'])
+def search_users_admin():
+    """
+    بحث غير حساس لحالة الأحرف في name/email/phone_number بالبادئة أو بجزء من النص (3 أحرف على الأقل).
+    البارامترات: q (مطلوب)، limit، cursor (من next_cursor). الترتيب: تطابق تام، بادئة البريد، بادئة الهاتف،
+    بادئة الاسم، ثم جزء من النص؛ وداخل كل درجة حسب id.
+    truncated: true يعني أن فرعًا بلغ USER_SEARCH_MAX_CANDIDATES: النتائج (وكل الصفحات) ناقصة، ضيّق q.
+    """
+    # !!! هام: يجب إضافة آلية تحقق من هوية المشرف هنا !!!
+    raw_query = request.args.get('q') or ''
+    q = normalize_search_text(raw_query)
+    if not q: return jsonify({"error": "Missing or empty search query 'q'"}), 400
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    digits = normalize_phone(raw_query) if PHONE_QUERY_RE.match(raw_query) else ''
+
+    fts_terms = []
+    if len(q) >= 3: fts_terms.append('{search_name search_email} : "%s"' % q.replace('"', '""'))
+    if len(digits) >= 3: fts_terms.append(f'search_phone : "{digits}"')
+    params = {"q": q, "prefix": q, "prefix_end": q + '\U0010ffff', "cap": USER_SEARCH_MAX_CANDIDATES, "limit": limit + 1}
+    if digits: params.update(digits=digits, digits_end=digits + '\U0010ffff')
+    if fts_terms: params["fts_query"] = ' OR '.join(fts_terms)
+    match_cte, truncated_sql = _build_user_search_sql(bool(digits), bool(fts_terms))
+
+    page_filter = ""
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            last_score_str, last_id_str = cursor.split(':', 1)
+            params["last_score"], params["last_id"] = int(last_score_str), int(last_id_str)
+        except ValueError:
+            return jsonify({"error": "Invalid 'cursor'"}), 400
+        page_filter = "WHERE score > :last_score OR (score = :last_score AND id > :last_id)"
+
+    try:
+        rows = db.session.execute(db.text(
+            f"{match_cte} SELECT id, score FROM matches {page_filter} ORDER BY score, id LIMIT :limit"
+        ), params).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        truncated = bool(db.session.execute(db.text(truncated_sql), params).scalar())
+        users = request_loader().get_many(User, [user_id for user_id, _ in rows])
+        results = []
+        for user_id, score in rows:
+            if users[user_id] is None: continue
+            user_data = users[user_id].to_dict(include_ads=False)
+            user_data['match'] = USER_SEARCH_MATCH_LABELS[score]
+            results.append(user_data)
+        return jsonify({
+            "results": results,
+            "next_cursor": f"{rows[-1][1]}:{rows[-1][0]}" if has_more else None,
+            "truncated": truncated
+        }), 200
+    except Exception as e:
+        app.logger.error(f"Error searching users (q={raw_query!r}): {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error"}), 500
+
 @app.route('/users/<int:user_id>', methods=['GET'])
 def get_user_by_id(user_id):
     user = User.query.get(user_id)
@@ -469,7 +2941,7 @@ def get_user_by_id(user_id):
 
 @app.route('/profile/<int:user_id>', methods=['GET'])
 def get_user_profile(user_id):
-    user = User.query.get(user_id)
+    user = User.query.options(db.joinedload(User.advertisements)).get(user_id)
     if user is None: return jsonify({"error": f"User with ID {user_id} not found"}), 404
     try:
         return jsonify(user.to_dict(include_ads=True)), 200
@@ -477,6 +2949,258 @@ def get_user_profile(user_id):
         app.logger.error(f"Error generating profile for user {user_id}: {e}", exc_info=True)
         return jsonify({"error": "Internal Server Error generating profile"}), 500
 
+@app.route('/leaderboard', methods=['GET'])
+def get_leaderboard():
+    """?period=all (الرصيد الحالي، الافتراضي) أو week (أرباح الأسبوع الحالي)، ?limit= حتى LEADERBOARD_SIZE."""
+    period = request.args.get('period', 'all')
+    if period not in ('all', 'week'): return jsonify({"error": "'period' must be 'all' or 'week'"}), 400
+    limit = request.args.get('limit', 50, type=int)
+    if limit is None or limit < 1: return jsonify({"error": "'limit' must be a positive integer"}), 400
+    limit = min(limit, LEADERBOARD_SIZE)
+    try:
+        boards, week_start = leaderboard.boards()
+        board = boards[period]
+        entries = board.top[:limit]
+        users = request_loader().get_many(User, [user_id for _, user_id in entries])
+        return jsonify({
+            "period": period,
+            "week_start": week_start.isoformat() if period == 'week' else None,
+            "entries": [{
+                "rank": board.rank(-negative_coins),
+                "user_id": user_id,
+                "name": users[user_id].name if users[user_id] is not None else None,
+                "coins": -negative_coins
+            } for negative_coins, user_id in entries]
+        }), 200
+    except Exception as e:
+        app.logger.error(f"Error building {period} leaderboard: {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error fetching leaderboard"}), 500
+
+@app.route('/users/<int:user_id>/rank', methods=['GET'])
+def get_user_rank(user_id):
+    user = User.query.get(user_id)
+    if user is None: return jsonify({"error": f"User with ID {user_id} not found"}), 404
+    try:
+        boards, week_start = leaderboard.boards()
+        weekly = WeeklyEarnings.query.get((week_start, user_id))
+        return jsonify({
+            "user_id": user_id,
+            "coins": user.coins,
+            "rank": boards["all"].rank(user.coins),
+            "week_start": week_start.isoformat(),
+            "weekly_earnings": weekly.coins if weekly else 0,
+            "weekly_rank": boards["week"].rank(weekly.coins) if weekly else None
+        }), 200
+    except Exception as e:
+        app.logger.error(f"Error computing rank for user {user_id}: {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error computing rank"}), 500
+
+# --- سجل نشاط المستخدم (/users/<id>/activity) ---
+# كل نوع فرع مرتب بفهرس (user_id, created_at)؛ الترتيب الكلي (created_at, kind, id) تنازليًا
+# و cursor = "<created_at>|<kind>|<id>" لآخر عنصر في الصفحة.
+ACTIVITY_KINDS = ["action", "click", "ad_click", "spin"] # ترتيب كسر التعادل عند تساوي created_at
+
+def _activity_branch(kind, query, created_col, id_col, user_id, cursor, limit):
+    """فرع واحد بعد cursor؛ شرط created_at يبقى مدى على الفهرس لأن رتبة النوع ثابتة داخل الفرع."""
+    query = query.where(user_id)
+    if cursor is not None:
+        last_created, last_rank, last_id = cursor
+        rank = ACTIVITY_KINDS.index(kind)
+        if rank < last_rank: query = query.where(created_col <= last_created)
+        elif rank > last_rank: query = query.where(created_col < last_created)
+        else: query = query.where(db.or_(created_col < last_created, db.and_(created_col == last_created, id_col < last_id)))
+    return db.select(query.order_by(created_col.desc(), id_col.desc()).limit(limit).subquery())
+
+def _parse_activity_cursor(raw_cursor):
+    last_created, kind, last_id = raw_cursor.split('|')
+    return datetime.fromisoformat(last_created), ACTIVITY_KINDS.index(kind), int(last_id)
+
+@app.route('/users/<int:user_id>/activity', methods=['GET'])
+def get_user_activity(user_id):
+    """
+    نشاط المستخدم بترتيب زمني تنازلي: إجراءات السوشيال ميديا، نقراته على روابط الإعلانات، النقرات على إعلاناته
+    (أرباح المعلن) ودورات العجلة. البارامترات: limit، cursor (من next_cursor). الملخص من user_earnings.
+    """
+    if User.query.get(user_id) is None: return jsonify({"error": f"User with ID {user_id} not found"}), 404
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    cursor = None
+    if request.args.get('cursor'):
+        try:
+            cursor = _parse_activity_cursor(request.args.get('cursor'))
+        except ValueError:
+            return jsonify({"error": "Invalid 'cursor'"}), 400
+
+    null_int, null_str = db.literal(None, db.Integer), db.literal(None, db.String)
+    archived_type, archived_created = archived_action_columns()
+    branches = [
+        _activity_branch("action", db.select(
+            db.literal("action").label("kind"), UserAdAction.id.label("id"), UserAdAction.created_at.label("created_at"),
+            UserAdAction.advertisement_id.label("advertisement_id"), UserAdAction.action_type.label("action_type"),
+            null_int.label("coins")), UserAdAction.created_at, UserAdAction.id, UserAdAction.user_id == user_id, cursor, limit + 1),
+        _activity_branch("action", db.select( # إجراءات مؤرشفة: صفوف المستخدم في الأرشيف تُفرز (عددها محدود لكل مستخدم)
+            db.literal("action").label("kind"), UserAdActionArchive.id.label("id"), archived_created.label("created_at"),
+            UserAdActionArchive.advertisement_id.label("advertisement_id"), archived_type.label("action_type"),
+            null_int.label("coins")), archived_created, UserAdActionArchive.id, UserAdActionArchive.user_id == user_id, cursor, limit + 1),
+        _activity_branch("click", db.select(
+            db.literal("click").label("kind"), AdClick.id.label("id"), AdClick.created_at.label("created_at"),
+            AdClick.advertisement_id.label("advertisement_id"), null_str.label("action_type"),
+            db.literal(0).label("coins")), AdClick.created_at, AdClick.id, AdClick.user_id == user_id, cursor, limit + 1),
+        _activity_branch("ad_click", db.select(
+            db.literal("ad_click").label("kind"), AdClick.id.label("id"), AdClick.created_at.label("created_at"),
+            AdClick.advertisement_id.label("advertisement_id"), null_str.label("action_type"),
+            AdClick.coins.label("coins")), AdClick.created_at, AdClick.id, AdClick.advertiser_id == user_id, cursor, limit + 1),
+        _activity_branch("spin", db.select(
+            db.literal("spin").label("kind"), SpinHistory.id.label("id"), SpinHistory.created_at.label("created_at"),
+            null_int.label("advertisement_id"), null_str.label("action_type"),
+            SpinHistory.coins.label("coins")), SpinHistory.created_at, SpinHistory.id, SpinHistory.user_id == user_id, cursor, limit + 1),
+    ]
+    try:
+        rows = db.session.execute(db.union_all(*branches)).all()
+        rows.sort(key=lambda row: (row.created_at, ACTIVITY_KINDS.index(row.kind), row.id), reverse=True)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        items = [{
+            "kind": row.kind,
+            "id": row.id,
+            "created_at": row.created_at.isoformat(),
+            "advertisement_id": row.advertisement_id,
+            "action_type": row.action_type,
+            "coins": COIN_VALUES.get(row.action_type, 0) if row.kind == "action" else row.coins
+        } for row in rows]
+
+        earnings = {source: {"count": 0, "coins": 0} for source in COIN_VALUES}
+        for source, count, coins in db.session.query(UserEarnings.source, UserEarnings.count, UserEarnings.coins)\
+                                               .filter(UserEarnings.user_id == user_id).all():
+            earnings[source] = {"count": count, "coins": coins}
+        return jsonify({
+            "items": items,
+            "next_cursor": f"{rows[-1].created_at.isoformat()}|{rows[-1].kind}|{rows[-1].id}" if has_more else None,
+            "earnings": {"by_source": earnings, "total_coins": sum(e["coins"] for e in earnings.values())}
+        }), 200
+    except Exception as e:
+        app.logger.error(f"Error fetching activity for user {user_id}: {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error fetching activity"}), 500
+
+@app.route('/users/<int:user_id>/events', methods=['GET'])
+def stream_user_events(user_id):
+    """
+    بث SSE لأحداث المستخدم: coins, verification, ad_approved, ads_available (الأخير لكل المستخدمين).
+    الاستئناف بترويسة Last-Event-ID (أو ?last_event_id=). إذا حُذف جزء مما فات (أقدم من EVENT_RETENTION)
+    يُرسل حدث resync أولًا ليعيد العميل جلب /users/<id>.
+    """
+    if User.query.get(user_id) is None: return jsonify({"error": f"User with ID {user_id} not found"}), 404
+    raw_last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    last_event_id = None
+    if raw_last_id:
+        try:
+            last_event_id = int(raw_last_id)
+        except ValueError:
+            return jsonify({"error": "Last-Event-ID must be an integer event id."}), 400
+
+    subscription, cursor = event_bus.subscribe(user_id)
+    try:
+        start_id = cursor if last_event_id is None else min(last_event_id, cursor)
+        backlog, resync = [], False
+        if start_id < cursor:
+            oldest_id = db.session.query(db.func.min(UserEvent.id)).scalar()
+            resync = oldest_id is None or oldest_id > start_id + 1
+            backlog = [(row.id, row.to_sse()) for row in UserEvent.query.filter(
+                UserEvent.id > start_id, db.or_(UserEvent.user_id == user_id, UserEvent.user_id.is_(None))
+            ).order_by(UserEvent.id).limit(EVENT_REPLAY_LIMIT)]
+    except Exception as e:
+        event_bus.unsubscribe(subscription)
+        app.logger.error(f"Error preparing event stream for user {user_id}: {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error opening event stream"}), 500
+
+    def generate():
+        sent_id = start_id
+        try:
+            yield f"retry: {EVENT_STREAM_RETRY_MS}\n\n"
+            if resync: yield "event: resync\ndata: {}\n\n"
+            for event_id, message in backlog:
+                sent_id = event_id
+                yield message
+            if len(backlog) == EVENT_REPLAY_LIMIT: return # يعيد العميل الاتصال ويكمل من آخر id
+            deadline = time.monotonic() + EVENT_STREAM_MAX_SECONDS
+            while time.monotonic() < deadline:
+                try:
+                    event_id, message = subscription.queue.get(timeout=EVENT_STREAM_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    if subscription.overflowed: return
+                    yield ": heartbeat\n\n"
+                    continue
+                if event_id <= sent_id: continue # وصل أيضًا ضمن الإعادة
+                sent_id = event_id
+                yield message
+                if subscription.overflowed and subscription.queue.empty(): return
+        finally:
+            event_bus.unsubscribe(subscription)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- Referral Endpoints ---
+
+@app.route('/users/<int:user_id>/referrals', methods=['GET'])
+def get_direct_referrals(user_id):
+    """الإحالات المباشرة للمستخدم مع ترقيم بالمؤشر (after_id) على فهرس referrer_id."""
+    if User.query.get(user_id) is None: return jsonify({"error": f"User with ID {user_id} not found"}), 404
+    after_id = request.args.get('after_id', 0, type=int)
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    try:
+        rows = db.session.query(Referral, User.name)\
+                         .join(User, User.id == Referral.referred_id)\
+                         .filter(Referral.referrer_id == user_id, Referral.referred_id > after_id)\
+                         .order_by(Referral.referred_id)\
+                         .limit(limit).all()
+        referrals = [dict(ref.to_dict(), name=name) for ref, name in rows]
+        return jsonify({
+            "referrals": referrals,
+            "next_after_id": referrals[-1]["referred_id"] if len(referrals) == limit else None
+        }), 200
+    except Exception as e:
+        app.logger.error(f"Error fetching referrals for user {user_id}: {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error"}), 500
+
+@app.route('/users/<int:user_id>/referrals/count', methods=['GET'])
+def get_referral_counts(user_id):
+    if User.query.get(user_id) is None: return jsonify({"error": f"User with ID {user_id} not found"}), 404
+    max_depth = _parse_referral_depth()
+    if max_depth is None: return jsonify({"error": "'max_depth' must be a positive integer"}), 400
+    try:
+        per_level = db.session.execute(REFERRAL_LEVEL_COUNTS_SQL, {"root_id": user_id, "max_depth": max_depth}).all()
+        by_level = {level: count for level, count in per_level}
+        return jsonify({
+            "user_id": user_id,
+            "direct": by_level.get(1, 0),
+            "total": sum(by_level.values()),
+            "by_level": {str(level): count for level, count in by_level.items()},
+            "max_depth": max_depth
+        }), 200
+    except Exception as e:
+        app.logger.error(f"Error counting referrals for user {user_id}: {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error"}), 500
+
+@app.route('/users/<int:user_id>/referrals/tree', methods=['GET'])
+def get_referral_tree(user_id):
+    """شجرة الإحالات متعددة المستويات (downline) حتى max_depth."""
+    if User.query.get(user_id) is None: return jsonify({"error": f"User with ID {user_id} not found"}), 404
+    max_depth = _parse_referral_depth(default=3)
+    if max_depth is None: return jsonify({"error": "'max_depth' must be a positive integer"}), 400
+    try:
+        rows = db.session.execute(REFERRAL_DOWNLINE_SQL, {"root_id": user_id, "max_depth": max_depth}).all()
+        return jsonify({
+            "user_id": user_id,
+            "max_depth": max_depth,
+            "downline": [
+                {"user_id": uid, "level": level, "referrer_id": parent_id, "name": name}
+                for uid, level, parent_id, name in rows
+            ]
+        }), 200
+    except Exception as e:
+        app.logger.error(f"Error fetching referral tree for user {user_id}: {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error"}), 500
+
 @app.route('/users/<int:user_id_param>/interests', methods=['PUT'])
 def update_user_interests(user_id_param):
     if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
@@ -521,10 +3245,19 @@ def add_advertisement():
          return jsonify({"error": "Missing required fields: title, link, coin_per_click"}), 400
     if not isinstance(new_ad.coin_per_click, int) or new_ad.coin_per_click < 0:
          return jsonify({"error": "'coin_per_click' must be a non-negative integer"}), 400
+    new_ad.starts_at, new_ad.ends_at, schedule_error = parse_ad_schedule(data)
+    if schedule_error: return jsonify({"error": schedule_error}), 400
+    new_ad.is_active = new_ad.in_schedule_window(datetime.utcnow())
     
     try:
         db.session.add(new_ad)
+        db.session.flush()
+        # SQLite قد يعيد استخدام id إعلان حذفه المنظف؛ الإعلان الجديد يلغي شاهد الحذف القديم
+        db.session.execute(db.delete(AdvertisementTombstone).where(AdvertisementTombstone.advertisement_id == new_ad.id))
+        bump_catalog_version()
         db.session.commit()
+        ad_catalog.invalidate()
+        if new_ad.starts_at or new_ad.ends_at: ad_schedule_sweeper.notify()
         return jsonify({"message": "Advertisement submitted", "advertisement": new_ad.to_dict()}), 201
     except Exception as e:
         db.session.rollback()
@@ -534,33 +3267,70 @@ def add_advertisement():
 @app.route('/admin/advertisements/<int:ad_id>/approve', methods=['PUT'])
 def approve_advertisement(ad_id):
     # !! Add Admin Auth Check Here !!
-    advertisement = Advertisement.query.get(ad_id)
+    advertisement = get_live_advertisement(ad_id)
     if advertisement is None: return jsonify({"error": "Ad not found"}), 404
     if advertisement.is_approved: return jsonify({"message": "Already approved"}), 200
     try:
         advertisement.is_approved = True
         advertisement.updated_at = datetime.utcnow()
+        bump_catalog_version()
+        publish_event(advertisement.user_id, "ad_approved", {"advertisement_id": ad_id})
+        if advertisement.is_active: publish_event(None, "ads_available", {"advertisement_ids": [ad_id]})
         db.session.commit()
+        event_bus.notify()
+        ad_catalog.invalidate()
+        interaction_index.set_ad_live(ad_id, advertisement.is_active)
         return jsonify({"message": "Advertisement approved", "advertisement": advertisement.to_dict()}), 200
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Error approving ad {ad_id}: {e}", exc_info=True)
         return jsonify({"error": "Internal Server Error"}), 500
 
+@app.route('/admin/advertisements/<int:ad_id>/schedule', methods=['PUT'])
+def schedule_advertisement(ad_id):
+    """يضبط starts_at/ends_at (ISO-8601، null يلغي الحد)؛ is_active يتبع النافذة ويقلبه ad_schedule_sweeper لاحقًا."""
+    # !!! هام: يجب إضافة آلية تحقق من هوية المشرف هنا !!!
+    if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
+    data = request.get_json()
+    if not isinstance(data, dict): return jsonify({"error": "Request body must be a JSON object"}), 400
+    advertisement = get_live_advertisement(ad_id)
+    if advertisement is None: return jsonify({"error": "Ad not found"}), 404
+    starts_at, ends_at, schedule_error = parse_ad_schedule(data, advertisement.starts_at, advertisement.ends_at)
+    if schedule_error: return jsonify({"error": schedule_error}), 400
+    try:
+        now = datetime.utcnow()
+        was_live = advertisement.is_approved and advertisement.is_active
+        advertisement.starts_at, advertisement.ends_at = starts_at, ends_at
+        advertisement.is_active = advertisement.in_schedule_window(now)
+        advertisement.updated_at = now
+        is_live = advertisement.is_approved and advertisement.is_active
+        bump_catalog_version()
+        if is_live and not was_live: publish_event(None, "ads_available", {"advertisement_ids": [ad_id]})
+        db.session.commit()
+        event_bus.notify()
+        ad_catalog.invalidate()
+        interaction_index.set_ad_live(ad_id, is_live)
+        ad_schedule_sweeper.notify()
+        return jsonify({"message": "Advertisement schedule updated", "advertisement": advertisement.to_dict()}), 200
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error scheduling ad {ad_id}: {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error"}), 500
+
 @app.route('/admin/advertisements/<int:ad_id>/reject', methods=['DELETE'])
 def reject_and_delete_advertisement(ad_id):
     # !! Add Admin Auth Check Here !!
     app.logger.warning(f"Admin attempt: Reject/DELETE ad {ad_id}.")
-    advertisement = Advertisement.query.get(ad_id)
+    advertisement = get_live_advertisement(ad_id)
     if advertisement is None:
         return jsonify({"error": f"Ad ID {ad_id} not found"}), 404
     try:
-        # قبل الحذف، قد ترغب في حذف الإجراءات المرتبطة به من UserAdAction
-        UserAdAction.query.filter_by(advertisement_id=ad_id).delete()
-        db.session.delete(advertisement)
+        # حذف ناعم فوري؛ الإجراءات المرتبطة وصف الإعلان يحذفها المنظف في الخلفية
+        _soft_delete_advertisements([ad_id])
         db.session.commit()
-        app.logger.info(f"Admin: Ad {ad_id} and its actions rejected and deleted.")
-        return jsonify({"message": f"Advertisement {ad_id} rejected and deleted."}), 200
+        _advertisements_deleted([ad_id])
+        app.logger.info(f"Admin: Ad {ad_id} rejected and marked deleted. Purge queued.")
+        return jsonify({"message": f"Advertisement {ad_id} rejected and deleted.", "purge_status_url": f"/admin/advertisements/{ad_id}/purge_status"}), 200
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Error rejecting ad {ad_id}: {e}", exc_info=True)
@@ -570,25 +3340,171 @@ def reject_and_delete_advertisement(ad_id):
 def force_delete_advertisement(ad_id):
     # !! Add Admin Auth Check Here !!
     app.logger.warning(f"Executing FORCE DELETE for advertisement ID: {ad_id}. This is a high-privilege operation.")
-    advertisement = Advertisement.query.get(ad_id)
+    advertisement = get_live_advertisement(ad_id)
     if advertisement is None:
         app.logger.warning(f"FORCE DELETE failed: Advertisement with ID {ad_id} not found.")
         return jsonify({"error": f"Advertisement with ID {ad_id} not found"}), 404
     try:
-        UserAdAction.query.filter_by(advertisement_id=ad_id).delete() # حذف الإجراءات المرتبطة
-        db.session.delete(advertisement)
+        _soft_delete_advertisements([ad_id])
         db.session.commit()
-        app.logger.info(f"Advertisement {ad_id} and its actions were FORCE DELETED successfully.")
-        return jsonify({"message": f"Advertisement {ad_id} force deleted successfully"}), 200
+        _advertisements_deleted([ad_id])
+        app.logger.info(f"Advertisement {ad_id} was FORCE DELETED (soft). Purge of its actions queued.")
+        return jsonify({"message": f"Advertisement {ad_id} force deleted successfully", "purge_status_url": f"/admin/advertisements/{ad_id}/purge_status"}), 200
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Error during FORCE DELETE of advertisement {ad_id}: {e}", exc_info=True)
         return jsonify({"error": "Internal Server Error during force deletion"}), 500
 
+@app.route('/admin/advertisements/<int:ad_id>/purge_status', methods=['GET'])
+def get_advertisement_purge_status(ad_id):
+    # !! Add Admin Auth Check Here !!
+    job = AdvertisementPurge.query.filter_by(advertisement_id=ad_id).order_by(AdvertisementPurge.id.desc()).first()
+    if job is None: return jsonify({"error": f"No purge job found for advertisement {ad_id}"}), 404
+    return jsonify(job.to_dict()), 200
+
+@app.route('/admin/advertisements/purges', methods=['GET'])
+def get_advertisement_purges():
+    # !! Add Admin Auth Check Here !!
+    status_filter = request.args.get('status')
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    query = AdvertisementPurge.query
+    if status_filter: query = query.filter(AdvertisementPurge.status == status_filter)
+    jobs = query.order_by(AdvertisementPurge.id.desc()).limit(limit).all()
+    return jsonify({
+        "purges": [job.to_dict() for job in jobs],
+        "pending": AdvertisementPurge.query.filter(AdvertisementPurge.status.in_(('pending', 'running'))).count()
+    }), 200
+
+# --- Bulk Admin Endpoints ---
+
+@app.route('/admin/advertisements/bulk_approve', methods=['POST'])
+def bulk_approve_advertisements():
+    # !! Add Admin Auth Check Here !!
+    if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
+    ad_ids, error = _parse_bulk_id_list(request.get_json())
+    if error: return jsonify({"error": error}), 400
+
+    results = {}
+    for chunk in _chunked(ad_ids):
+        try:
+            rows = db.session.query(Advertisement.id, Advertisement.is_approved, Advertisement.user_id, Advertisement.is_active)\
+                             .filter(Advertisement.id.in_(chunk), Advertisement.deleted_at.is_(None)).all()
+            existing = {ad_id: is_approved for ad_id, is_approved, _, _ in rows}
+            to_approve = [ad_id for ad_id in chunk if existing.get(ad_id) is False]
+            if to_approve:
+                db.session.execute(
+                    db.update(Advertisement)
+                      .where(Advertisement.id.in_(to_approve), Advertisement.is_approved == False)
+                      .values(is_approved=True, updated_at=datetime.utcnow())
+                )
+                bump_catalog_version()
+                for ad_id, is_approved, owner_id, _ in rows:
+                    if not is_approved: publish_event(owner_id, "ad_approved", {"advertisement_id": ad_id})
+                newly_available = [ad_id for ad_id, is_approved, _, is_active in rows if not is_approved and is_active]
+                if newly_available: publish_event(None, "ads_available", {"advertisement_ids": sorted(newly_available)})
+            db.session.commit()
+            if to_approve:
+                event_bus.notify()
+                ad_catalog.invalidate()
+            active_by_ad = {ad_id: is_active for ad_id, _, _, is_active in rows}
+            for ad_id in to_approve: interaction_index.set_ad_live(ad_id, active_by_ad[ad_id])
+            for ad_id in chunk:
+                if ad_id not in existing: results[ad_id] = "not_found"
+                elif existing[ad_id]: results[ad_id] = "already_approved"
+                else: results[ad_id] = "approved"
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error bulk approving ads chunk starting at {chunk[0]}: {e}", exc_info=True)
+            for ad_id in chunk: results[ad_id] = "error"
+
+    app.logger.info(f"Admin: Bulk approve processed {len(ad_ids)} ads.")
+    return jsonify({
+        "results": [{"id": ad_id, "status": results[ad_id]} for ad_id in ad_ids],
+        "approved": sum(1 for v in results.values() if v == "approved")
+    }), 200
+
+@app.route('/admin/advertisements/bulk_reject', methods=['POST'])
+def bulk_reject_advertisements():
+    # !! Add Admin Auth Check Here !!
+    if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
+    ad_ids, error = _parse_bulk_id_list(request.get_json())
+    if error: return jsonify({"error": error}), 400
+    app.logger.warning(f"Admin attempt: Bulk reject/DELETE of {len(ad_ids)} ads.")
+
+    results = {}
+    for chunk in _chunked(ad_ids):
+        try:
+            existing = {row[0] for row in db.session.query(Advertisement.id)
+                                                   .filter(Advertisement.id.in_(chunk), Advertisement.deleted_at.is_(None)).all()}
+            to_delete = [ad_id for ad_id in chunk if ad_id in existing]
+            if to_delete:
+                _soft_delete_advertisements(to_delete)
+            db.session.commit()
+            if to_delete:
+                _advertisements_deleted(to_delete)
+            for ad_id in chunk: results[ad_id] = "deleted" if ad_id in existing else "not_found"
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error bulk rejecting ads chunk starting at {chunk[0]}: {e}", exc_info=True)
+            for ad_id in chunk: results[ad_id] = "error"
+
+    app.logger.info(f"Admin: Bulk reject processed {len(ad_ids)} ads.")
+    return jsonify({
+        "results": [{"id": ad_id, "status": results[ad_id]} for ad_id in ad_ids],
+        "deleted": sum(1 for v in results.values() if v == "deleted")
+    }), 200
+
+@app.route('/admin/users/bulk_coins', methods=['POST'])
+def bulk_adjust_user_coins():
+    """
+    body: {"adjustments": [{"user_id": 1, "delta": 50}, {"user_id": 2, "delta": -20}, ...]}
+    الرصيد لا ينزل تحت الصفر (مثل subtract_coins في PATCH /users/<id>).
+    """
+    # !! Add Admin Auth Check Here !!
+    if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
+    adjustments = (request.get_json() or {}).get('adjustments')
+    if not isinstance(adjustments, list) or not adjustments:
+        return jsonify({"error": "'adjustments' must be a non-empty list of {user_id, delta} objects."}), 400
+    if len(adjustments) > BULK_MAX_ITEMS:
+        return jsonify({"error": f"Too many adjustments (max {BULK_MAX_ITEMS})."}), 400
+
+    results = [None] * len(adjustments)
+    valid = [] # (index, user_id, delta)
+    for index, item in enumerate(adjustments):
+        user_id_val = item.get('user_id') if isinstance(item, dict) else None
+        delta = item.get('delta') if isinstance(item, dict) else None
+        if not isinstance(user_id_val, int) or not isinstance(delta, int) or isinstance(delta, bool):
+            results[index] = {"index": index, "user_id": user_id_val, "status": "invalid"}
+        else:
+            valid.append((index, user_id_val, delta))
+
+    for chunk in _chunked(valid):
+        try:
+            chunk_user_ids = {user_id_val for _, user_id_val, _ in chunk}
+            existing = {row[0] for row in db.session.query(User.id).filter(User.id.in_(chunk_user_ids)).all()}
+            params = [{"uid": user_id_val, "delta": delta} for _, user_id_val, delta in chunk if user_id_val in existing]
+            if params:
+                db.session.execute(db.text("UPDATE user SET coins = MAX(0, coins + :delta) WHERE id = :uid"), params)
+            db.session.commit()
+            for index, user_id_val, delta in chunk:
+                status = "applied" if user_id_val in existing else "not_found"
+                results[index] = {"index": index, "user_id": user_id_val, "delta": delta, "status": status}
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Error applying bulk coin adjustments chunk: {e}", exc_info=True)
+            for index, user_id_val, delta in chunk:
+                results[index] = {"index": index, "user_id": user_id_val, "delta": delta, "status": "error"}
+
+    app.logger.info(f"Admin: Bulk coin adjustment processed {len(adjustments)} items.")
+    return jsonify({
+        "results": results,
+        "applied": sum(1 for r in results if r["status"] == "applied")
+    }), 200
+
 @app.route('/advertisements', methods=['GET'])
 def get_advertisements_filtered(): # نقطة نهاية عامة لفلترة الإعلانات (يمكن استخدامها من قبل المشرفين مثلاً)
     try:
-        query = Advertisement.query
+        query = live_advertisements()
         if request.args.get('user_id'): query = query.filter(Advertisement.user_id == int(request.args.get('user_id')))
         if request.args.get('category'): query = query.filter(Advertisement.category == request.args.get('category'))
         if request.args.get('is_approved'):
@@ -596,20 +3512,110 @@ def get_advertisements_filtered(): # نقطة نهاية عامة لفلترة 
             if is_approved_filter == 'true': query = query.filter(Advertisement.is_approved == True)
             elif is_approved_filter == 'false': query = query.filter(Advertisement.is_approved == False)
         
-        filtered_ads = query.order_by(Advertisement.created_at.desc()).all()
-        return jsonify([ad.to_dict() for ad in filtered_ads]), 200
+        ad_ids = [ad_id for (ad_id,) in query.with_entities(Advertisement.id).order_by(Advertisement.created_at.desc())]
+        return stream_json_response(ad.to_dict() for ad in iter_rows_by_ids(Advertisement, ad_ids))
     except ValueError as ve:
         return jsonify({"error": f"Invalid parameter value: {ve}"}), 400
     except Exception as e:
         app.logger.error(f"Error fetching/filtering ads: {e}", exc_info=True)
         return jsonify({"error": "Internal Server Error"}), 500
 
+# --- البحث النصي الكامل في الإعلانات ---
+AD_SEARCH_MATCH_CTE = """
+    WITH matches AS (
+        SELECT a.id AS id, a.category AS category, a.subcategory AS subcategory,
+               bm25(advertisement_fts, 10.0, 3.0, 2.0, 2.0) AS score
+        FROM advertisement_fts JOIN advertisement a ON a.id = advertisement_fts.rowid
+        WHERE advertisement_fts MATCH :fts_query AND a.deleted_at IS NULL {approval_filter}
+    )
+"""
+
+def _build_fts_query(raw_query):
+    """يحوّل نص المستخدم إلى استعلام FTS5 آمن: كل كلمة بين علامتي تنصيص مع مطابقة البادئة."""
+    terms = re.findall(r'\w+', raw_query or '', re.UNICODE)
+    return ' '.join(f'"{term}"*' for term in terms[:10])
+
+@app.route('/advertisements/search', methods=['GET'])
+def search_advertisements():
+    """
+    بحث مرتب حسب الصلة (bm25) في title/description/category/subcategory.
+    البارامترات: q (مطلوب)، category، subcategory، is_approved (true افتراضيًا | false | any)،
+    limit، cursor (من next_cursor في الاستجابة السابقة).
+    عدادات facets تُرجع في الصفحة الأولى فقط (بدون cursor).
+    """
+    fts_query = _build_fts_query(request.args.get('q'))
+    if not fts_query: return jsonify({"error": "Missing or empty search query 'q'"}), 400
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+
+    is_approved_filter = (request.args.get('is_approved') or 'true').lower()
+    if is_approved_filter == 'true': approval_filter = "AND a.is_approved = 1 AND a.is_active = 1"
+    elif is_approved_filter == 'false': approval_filter = "AND a.is_approved = 0"
+    elif is_approved_filter == 'any': approval_filter = ""
+    else: return jsonify({"error": "'is_approved' must be one of: true, false, any"}), 400
+    match_cte = AD_SEARCH_MATCH_CTE.format(approval_filter=approval_filter)
+
+    params = {"fts_query": fts_query, "limit": limit + 1}
+    page_filters = []
+    if request.args.get('category'):
+        page_filters.append("category = :category")
+        params["category"] = request.args.get('category')
+    if request.args.get('subcategory'):
+        page_filters.append("subcategory = :subcategory")
+        params["subcategory"] = request.args.get('subcategory')
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            last_score_str, last_id_str = cursor.rsplit(':', 1)
+            params["last_score"], params["last_id"] = float(last_score_str), int(last_id_str)
+        except ValueError:
+            return jsonify({"error": "Invalid 'cursor'"}), 400
+        page_filters.append("(score > :last_score OR (score = :last_score AND id > :last_id))")
+    where_clause = f"WHERE {' AND '.join(page_filters)}" if page_filters else ""
+
+    try:
+        rows = db.session.execute(db.text(
+            f"{match_cte} SELECT id, score FROM matches {where_clause} ORDER BY score, id LIMIT :limit"
+        ), params).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        ads_by_id = {ad.id: ad for ad in Advertisement.query.filter(Advertisement.id.in_([r[0] for r in rows])).all()} if rows else {}
+        results = []
+        for ad_id_val, score in rows:
+            ad = ads_by_id.get(ad_id_val)
+            if ad is None: continue
+            ad_data = ad.to_dict()
+            ad_data['score'] = -score # bm25 أصغر = أفضل؛ نعرضه موجبًا
+            results.append(ad_data)
+
+        response = {
+            "results": results,
+            "next_cursor": f"{rows[-1][1]!r}:{rows[-1][0]}" if has_more else None
+        }
+        if not cursor:
+            facet_rows = db.session.execute(db.text(
+                f"{match_cte} SELECT category, subcategory, COUNT(*) FROM matches GROUP BY category, subcategory"
+            ), {"fts_query": fts_query}).all()
+            categories, subcategories = {}, {}
+            for category, subcategory, count in facet_rows:
+                categories[category] = categories.get(category, 0) + count
+                if subcategory is not None:
+                    subcategories[subcategory] = subcategories.get(subcategory, 0) + count
+            response["facets"] = {
+                "total": sum(categories.values()),
+                "category": [{"value": k, "count": v} for k, v in sorted(categories.items(), key=lambda kv: -kv[1])],
+                "subcategory": [{"value": k, "count": v} for k, v in sorted(subcategories.items(), key=lambda kv: -kv[1])],
+            }
+        return jsonify(response), 200
+    except Exception as e:
+        app.logger.error(f"Error searching advertisements (q={request.args.get('q')!r}): {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error"}), 500
+
 @app.route('/users/<int:user_id_param>/advertisements', methods=['GET'])
 def get_user_advertisements(user_id_param): # إعلانات أنشأها المستخدم
     user = User.query.get(user_id_param)
     if user is None: return jsonify({"error": f"User ID {user_id_param} not found"}), 404
     try:
-        user_ads = Advertisement.query.filter_by(user_id=user_id_param)\
+        user_ads = live_advertisements().filter_by(user_id=user_id_param)\
                                      .order_by(Advertisement.created_at.desc()).all()
         return jsonify([ad.to_dict() for ad in user_ads]), 200
     except Exception as e:
@@ -620,17 +3626,15 @@ def get_user_advertisements(user_id_param): # إعلانات أنشأها الم
 # --- نقطة نهاية جديدة لجلب الإعلانات المتاحة للمستخدم مع المهام ---
 @app.route('/advertisements/available_for_user/<int:requesting_user_id>', methods=['GET'])
 def get_available_ads_for_user(requesting_user_id):
+    """?since=<watermark> يعيد الإعلانات المتغيرة فقط، مع removed_ids للإعلانات التي لم تعد متاحة للمستخدم."""
     user = User.query.get(requesting_user_id)
     if not user:
         return jsonify({"error": f"User with ID {requesting_user_id} not found."}), 404
+    since, error_response = parse_sync_since(request.args.get('since'))
+    if error_response: return error_response
 
     try:
-        actions_done_by_user_raw = db.session.query(
-                                        UserAdAction.advertisement_id, 
-                                        UserAdAction.action_type
-                                     )\
-                                     .filter(UserAdAction.user_id == requesting_user_id)\
-                                     .all()
+        actions_done_by_user_raw = user_actions_done(requesting_user_id)
         
         interacted_ads_actions = {}
         for ad_id_val, action_type_val in actions_done_by_user_raw:
@@ -640,30 +3644,21 @@ def get_available_ads_for_user(requesting_user_id):
 
         app.logger.debug(f"User {requesting_user_id} has interacted with ads and actions: {interacted_ads_actions}")
 
-        query = Advertisement.query.filter(
-            Advertisement.is_approved == True,
-            Advertisement.is_active == True
-        )
+        if since is not None:
+            return _available_ads_delta(requesting_user_id, since, interacted_ads_actions)
+
+        # الإعلانات الموافق عليها والنشطة من كتالوج العامل (بدون استعلام)، مرتبة created_at تنازليًا
+        snapshot = ad_catalog.snapshot()
+        all_potential_ads = snapshot.active
         
         # فلترة بالاهتمامات (مثال بسيط)
         user_interests = user.get_interests()
-        if user_interests:
-            # هذا يتطلب أن يكون Advertisement.interests هو JSON array of strings
-            # وقد يكون أبطأ مع SQLite لقواعد البيانات الكبيرة
-            # for interest in user_interests:
-            # query = query.filter(Advertisement.interests.contains(interest)) # Requires specific DB setup for JSON search
-            # حل أبسط: الفلترة بعد الجلب إذا كانت القائمة ليست ضخمة جدًا
-            pass
-
 
-        all_potential_ads = query.order_by(Advertisement.created_at.desc()).all()
-        
         available_ads_with_tasks = []
 
         for ad in all_potential_ads:
-            # فلترة بالاهتمامات (بعد الجلب) - إذا لم يتم تطبيقها في الاستعلام
-            # ad_interests = ad.get_interests()
-            # if user_interests and ad_interests and not any(i in ad_interests for i in user_interests):
+            # فلترة بالاهتمامات - ad.interests مفكوكة مسبقًا في الكتالوج
+            # if user_interests and ad.interests and not any(i in ad.interests for i in user_interests):
             # continue # تخطي الإعلان إذا لم يكن هناك اهتمامات مشتركة
 
             remaining_tasks_for_ad = list(POSSIBLE_ACTION_TYPES - interacted_ads_actions.get(ad.id, set()))
@@ -674,150 +3669,544 @@ def get_available_ads_for_user(requesting_user_id):
                 available_ads_with_tasks.append(ad_data)
         
         app.logger.info(f"Found {len(available_ads_with_tasks)} ads with available tasks for user {requesting_user_id} after filtering.")
-        return jsonify(available_ads_with_tasks), 200
+        return jsonify(available_ads_with_tasks), 200, {"X-Sync-Watermark": snapshot.watermark.isoformat()}
 
     except Exception as e:
         app.logger.error(f"Error fetching available ads for user {requesting_user_id}: {e}", exc_info=True)
         return jsonify({"error": "Internal Server Error"}), 500
 
 
+def _available_ads_delta(requesting_user_id, since, interacted_ads_actions):
+    changed_ads, removed_ids, watermark = load_ad_changes(since)
+    # مهام أنجزها المستخدم بعد since (من جهاز آخر مثلًا) لا تغير updated_at للإعلان
+    acted_ad_ids = {row[0] for row in db.session.query(UserAdAction.advertisement_id).filter(
+        UserAdAction.user_id == requesting_user_id, UserAdAction.created_at > since
+    ).all()}
+    changed_by_id = {ad.id: ad for ad in changed_ads}
+    missing_ids = list(acted_ad_ids - set(changed_by_id))
+    if missing_ids:
+        changed_by_id.update({ad.id: ad for ad in Advertisement.query.filter(Advertisement.id.in_(missing_ids)).all()})
+    removed_ids.update(ad_id for ad_id in missing_ids if ad_id not in changed_by_id)
+
+    upserts = []
+    for ad in sorted(changed_by_id.values(), key=lambda ad: (ad.created_at, ad.id), reverse=True):
+        remaining_tasks_for_ad = POSSIBLE_ACTION_TYPES - interacted_ads_actions.get(ad.id, set())
+        is_live = ad.deleted_at is None and ad.is_approved and ad.is_active
+        if not is_live or not remaining_tasks_for_ad:
+            removed_ids.add(ad.id)
+            continue
+        ad_data = ad.to_dict()
+        ad_data['available_tasks'] = sorted(remaining_tasks_for_ad)
+        upserts.append(ad_data)
+    app.logger.info(f"Available ads delta for user {requesting_user_id} since {since.isoformat()}: {len(upserts)} changed, {len(removed_ids)} removed.")
+    return ad_sync_response(upserts, removed_ids, watermark)
+
 # --- Image Analysis Endpoints (MODIFIED) ---
+# خط التحليل مقسم إلى مراحل صغيرة حتى يشترك فيه المسار المتزامن (Flask/gunicorn)
+# والمسار غير المتزامن (asgi.py) الذي يستخدم generate_content_async.
+# كل مرحلة تعيد (value, None) أو (None, error_response).
 
-def _analyze_social_action(action_type_constant, specific_prompt, request_data, request_files):
-    """Helper function to reduce redundancy in analysis endpoints."""
+def _validate_social_action_request(action_type_constant, request_data):
     if not gemini_model:
         app.logger.warning(f"Gemini model N/A for {action_type_constant} analysis.")
-        return jsonify({"error": "Image analysis service unavailable."}), 503
+        return None, (jsonify({"error": "Image analysis service unavailable."}), 503)
 
     user, error_response = get_validated_user_from_form(request_data)
-    if error_response: return error_response
+    if error_response: return None, error_response
     user_id_val = user.id
 
     if 'advertisement_id' not in request_data:
         app.logger.warning(f"User {user_id_val}: Missing 'advertisement_id' in form for {action_type_constant} analysis.")
-        return jsonify({"error": "Missing 'advertisement_id' form field."}), 400
+        return None, (jsonify({"error": "Missing 'advertisement_id' form field."}), 400)
     try:
         advertisement_id_val = int(request_data.get('advertisement_id'))
     except (ValueError, TypeError):
         app.logger.warning(f"User {user_id_val}: Invalid advertisement_id format: {request_data.get('advertisement_id')}")
-        return jsonify({"error": "'advertisement_id' must be a valid integer."}), 400
+        return None, (jsonify({"error": "'advertisement_id' must be a valid integer."}), 400)
 
-    advertisement = Advertisement.query.get(advertisement_id_val)
-    if not advertisement:
+    # الإعلان وفحص الإجراء السابق (UserAdAction أو الأرشيف) في استعلام واحد
+    already_performed = action_performed_clause(user_id_val, Advertisement.id, action_type_constant)
+    row = db.session.query(Advertisement, already_performed)\
+                    .filter(Advertisement.id == advertisement_id_val, Advertisement.deleted_at.is_(None)).first()
+    if not row:
         app.logger.warning(f"User {user_id_val}: Advertisement with ID {advertisement_id_val} not found for {action_type_constant} analysis.")
-        return jsonify({"error": f"Advertisement with ID {advertisement_id_val} not found."}), 404
+        return None, (jsonify({"error": f"Advertisement with ID {advertisement_id_val} not found."}), 404)
+    request_loader().remember(row[0])
 
-    if 'image' not in request_files: return jsonify({"error": "Missing 'image' file part."}), 400
-    file = request_files['image']
-    if file.filename == '': return jsonify({"error": "No file selected."}), 400
+    return {"action_type": action_type_constant, "user_id": user_id_val, "advertisement_id": advertisement_id_val,
+            "already_performed": bool(row[1])}, None
 
+def _read_and_hash_image(ctx, request_files):
+    """
+    يقرأ الصور من الحقول 'image' و 'images' (عدة ملفات) أو تسجيل شاشة من الحقل 'video'.
+    يعيد قائمة (kind, bytes) بدون تكرار بالهاش؛ ctx["img_hashes"] يحمل هاش كل ملف.
+    """
+    uploads = [('image', f) for f in request_files.getlist('image') + request_files.getlist('images')]
+    uploads += [('video', f) for f in request_files.getlist('video')]
+    if not uploads: return None, (jsonify({"error": "Missing 'image' file part."}), 400)
+    if any(f.filename == '' for _, f in uploads): return None, (jsonify({"error": "No file selected."}), 400)
+    if sum(1 for kind, _ in uploads if kind == 'image') > MAX_IMAGES_PER_SUBMISSION:
+        return None, (jsonify({"error": f"Too many images (max {MAX_IMAGES_PER_SUBMISSION})."}), 400)
+    if sum(1 for kind, _ in uploads if kind == 'video') > 1:
+        return None, (jsonify({"error": "Only one screen recording per submission is allowed."}), 400)
+
+    payloads, hashes, media_types = [], [], []
     try:
-        img_bytes = file.read()
-        if not img_bytes: return jsonify({"error": "Empty image file."}), 400
-        img_hash = hashlib.sha256(img_bytes).hexdigest()
+        for kind, file in uploads:
+            file_bytes = file.read(MAX_VIDEO_BYTES + 1) if kind == 'video' else file.read()
+            if not file_bytes: return None, (jsonify({"error": "Empty image file."}), 400)
+            if kind == 'video':
+                if len(file_bytes) > MAX_VIDEO_BYTES: return None, (jsonify({"error": "Screen recording is too large."}), 400)
+                extension = file.filename.rsplit('.', 1)[-1].lower() if '.' in file.filename else ''
+                if extension not in ALLOWED_VIDEO_EXTENSIONS:
+                    return None, (jsonify({"error": f"Unsupported screen recording format. Allowed: {', '.join(sorted(ALLOWED_VIDEO_EXTENSIONS))}"}), 400)
+                if extension != 'gif' and cv2 is None:
+                    return None, (jsonify({"error": "Screen recording analysis is not available on this server."}), 415)
+                kind = f"video:{extension}"
+            file_hash = hashlib.sha256(file_bytes).hexdigest()
+            if file_hash in hashes: continue # نفس الملف مرتين في نفس الطلب
+            hashes.append(file_hash)
+            payloads.append((kind, file_bytes))
+            media_types.append(f"video/{kind.split(':', 1)[1]}" if kind.startswith('video:') else (file.mimetype or None))
     except Exception as e:
-        app.logger.error(f"User {user_id_val}: Img hash error ({action_type_constant}): {e}", exc_info=True)
-        return jsonify({"error": "Could not process image file."}), 400
-
-    image_user_pair = (user_id_val, img_hash)
-    if image_user_pair in processed_image_hashes:
-        app.logger.warning(f"User {user_id_val}: Duplicate img for {action_type_constant} (hash {img_hash}) Ad {advertisement_id_val}")
-        return jsonify({"status": -1, "message": "Image already processed by you for a task."}), 200
-
-    existing_action = UserAdAction.query.filter_by(
-        user_id=user_id_val,
-        advertisement_id=advertisement_id_val,
-        action_type=action_type_constant
-    ).first()
-    if existing_action:
+        app.logger.error(f"User {ctx['user_id']}: Img hash error ({ctx['action_type']}): {e}", exc_info=True)
+        return None, (jsonify({"error": "Could not process image file."}), 400)
+
+    ctx["img_hashes"] = hashes
+    ctx["payloads"] = payloads
+    ctx["media_types"] = media_types
+    ctx["img_hash"] = hashes[0] if len(hashes) == 1 else '+'.join(h[:12] for h in hashes) # للسجلات
+    return payloads, None
+
+def _check_social_action_duplicates(ctx):
+    user_id_val, advertisement_id_val, action_type_constant = ctx["user_id"], ctx["advertisement_id"], ctx["action_type"]
+    if any((user_id_val, img_hash) in processed_image_hashes for img_hash in ctx["img_hashes"]):
+        app.logger.warning(f"User {user_id_val}: Duplicate img for {action_type_constant} (hash {ctx['img_hash']}) Ad {advertisement_id_val}")
+        return (jsonify({"status": -1, "message": "Image already processed by you for a task."}), 200)
+
+    if ctx["already_performed"]: # محسوب مع جلب الإعلان في _validate_social_action_request
         app.logger.warning(f"User {user_id_val} already performed '{action_type_constant}' on Ad {advertisement_id_val}.")
-        return jsonify({"status": -2, "message": f"You have already performed this '{action_type_constant}' action on this advertisement."}), 200
-
+        return (jsonify({"status": -2, "message": f"You have already performed this '{action_type_constant}' action on this advertisement."}), 200)
+    return None
+
+def _normalize_image(img):
+    img = img.convert('RGB')
+    if max(img.size) > NORMALIZED_IMAGE_MAX_SIDE:
+        img.thumbnail((NORMALIZED_IMAGE_MAX_SIDE, NORMALIZED_IMAGE_MAX_SIDE))
+    return img
+
+def _average_hash(img):
+    small = img.convert('L').resize((8, 8))
+    pixels = list(small.getdata())
+    mean = sum(pixels) / len(pixels)
+    return sum(1 << i for i, p in enumerate(pixels) if p > mean)
+
+def _sample_frame_indices(frame_count, wanted=MAX_VIDEO_FRAMES):
+    if frame_count <= wanted: return list(range(frame_count))
+    # إطارات موزعة بالتساوي مع تجنب الإطار الأول والأخير (غالبًا انتقال/شاشة سوداء)
+    step = frame_count / (wanted + 1)
+    return [int(step * (i + 1)) for i in range(wanted)]
+
+def _extract_video_frames(video_bytes, extension):
+    if extension == 'gif':
+        gif = Image.open(io.BytesIO(video_bytes))
+        indices = set(_sample_frame_indices(getattr(gif, 'n_frames', 1)))
+        return [frame.copy() for i, frame in enumerate(ImageSequence.Iterator(gif)) if i in indices]
+
+    with tempfile.NamedTemporaryFile(suffix=f'.{extension}') as tmp:
+        tmp.write(video_bytes)
+        tmp.flush()
+        capture = cv2.VideoCapture(tmp.name)
+        try:
+            frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+            frames = []
+            for index in _sample_frame_indices(frame_count):
+                capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+                ok, frame = capture.read()
+                if ok: frames.append(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+            return frames
+        finally:
+            capture.release()
+
+def _decode_image(ctx, payloads):
+    """يفك الصور/الإطارات، يوحد صيغتها وحجمها ويحذف المتطابقة تقريبًا. يعيد قائمة صور PIL."""
+    images, seen_hashes = [], []
     try:
-        img = Image.open(io.BytesIO(img_bytes))
-        img.verify()
-        img = Image.open(io.BytesIO(img_bytes))
+        for kind, payload in payloads:
+            if kind == 'image':
+                img = Image.open(io.BytesIO(payload))
+                img.verify()
+                decoded = [Image.open(io.BytesIO(payload))]
+            else:
+                decoded = _extract_video_frames(payload, kind.split(':', 1)[1])
+                if not decoded: raise ValueError("no frames could be decoded from the screen recording")
+            for img in decoded:
+                img = _normalize_image(img) # فك الترميز هنا (وليس داخل استدعاء Gemini) حتى يجري في خيط المعالجة
+                fingerprint = _average_hash(img)
+                if any(bin(fingerprint ^ other).count('1') <= NEAR_DUPLICATE_MAX_DISTANCE for other in seen_hashes):
+                    continue
+                seen_hashes.append(fingerprint)
+                images.append(img)
+    except Exception as e:
+        app.logger.error(f"User {ctx['user_id']}: Invalid img ({ctx['action_type']}, hash {ctx['img_hash']}) Ad {ctx['advertisement_id']}: {e}", exc_info=True)
+        return None, (jsonify({"error": "Invalid or corrupted image."}), 400)
+    if len(images) > MAX_IMAGES_PER_SUBMISSION:
+        images = images[:MAX_IMAGES_PER_SUBMISSION]
+    return images, None
+
+def _build_model_request(final_prompt, images):
+    """طلب Gemini واحد متعدد الأجزاء لكل الصور."""
+    if len(images) > 1:
+        final_prompt = MULTI_IMAGE_PROMPT_PREFIX.format(count=len(images)) + final_prompt
+    return [final_prompt, *images]
+
+def _build_social_action_prompt(ctx, specific_prompt, request_data):
+    if ctx["action_type"] != "comment": # خاص بالتعليق، يحتاج لاسم المستخدم
+        return specific_prompt, None
+    if 'username' not in request_data:
+        app.logger.warning(f"User {ctx['user_id']}: Missing 'username' for comment analysis, Ad {ctx['advertisement_id']}.")
+        return None, (jsonify({"error": "Missing 'username' form field for comment analysis."}), 400)
+    username = request_data['username']
+    if not username:
+        app.logger.warning(f"User {ctx['user_id']}: Empty 'username' for comment analysis, Ad {ctx['advertisement_id']}.")
+        return None, (jsonify({"error": "'username' cannot be empty for comment analysis."}), 400)
+    app.logger.info(f"User {ctx['user_id']}: Using comment prompt for user '{username}'")
+    ctx["prompt_params"] = {"username": username}
+    return specific_prompt.format(username=username), None
+
+MODEL_VERDICT_RE = re.compile(r"^['\"]?([01])['\"]?(?:\s+(\d{1,3})\s*%?)?\s*$")
+
+def _parse_model_response(ctx, response):
+    """يعيد ('1' | '0', None) أو (None, error_response). الثقة (إن وُجدت) تُحفظ في ctx['confidence']."""
+    ctx["confidence"] = None
+    if response.parts:
+        raw_result = response.text.strip()
+        app.logger.info(f"User {ctx['user_id']}: Gemini {ctx['action_type']} raw_result for {ctx['img_hash']} Ad {ctx['advertisement_id']}: '{raw_result}'")
+        match = MODEL_VERDICT_RE.match(raw_result)
+        if match:
+            if match.group(2): ctx["confidence"] = min(int(match.group(2)), 100) / 100.0
+            return match.group(1), None
+        app.logger.error(f"User {ctx['user_id']}: Unexpected Gemini ({ctx['action_type']}) for {ctx['img_hash']} Ad {ctx['advertisement_id']}: '{raw_result}'")
+        return None, (jsonify({"error": f"Unexpected analysis result: '{raw_result}'"}), 500)
+    feedback = response.prompt_feedback if hasattr(response, 'prompt_feedback') else 'N/A'
+    app.logger.error(f"User {ctx['user_id']}: Gemini no content ({ctx['action_type']}) for {ctx['img_hash']} Ad {ctx['advertisement_id']}. Feedback: {feedback}")
+    # إذا كان هناك حظر محتوى، قد لا نرغب في إضافة الهاش
+    return None, (jsonify({"error": "Analysis failed or content blocked by safety filters."}), 500)
+
+def _add_verification_record(ctx, raw_result):
+    """يسجل القرار ويحفظ الملفات في المخزن (ضمن معاملة المستدعي). لا يُفشل الطلب أبدًا."""
+    try:
+        _store_submission_files(ctx)
+        db.session.add(VerificationRecord(
+            user_id=ctx["user_id"], advertisement_id=ctx["advertisement_id"], action_type=ctx["action_type"],
+            verdict=int(raw_result), confidence=ctx.get("confidence"), verified_by=ctx.get("verified_by"),
+            model_name=ctx.get("model_name"), image_hashes=json.dumps(ctx["img_hashes"]),
+            prompt_params=json.dumps(ctx["prompt_params"]) if ctx.get("prompt_params") else None
+        ))
     except Exception as e:
-        app.logger.error(f"User {user_id_val}: Invalid img ({action_type_constant}, hash {img_hash}) Ad {advertisement_id_val}: {e}", exc_info=True)
-        return jsonify({"error": "Invalid or corrupted image."}), 400
+        app.logger.error(f"User {ctx['user_id']}: Failed to store verification record for {ctx['action_type']} Ad {ctx['advertisement_id']}: {e}", exc_info=True)
+
+def _record_social_action_result(ctx, raw_result):
+    user_id_val, advertisement_id_val, action_type_constant = ctx["user_id"], ctx["advertisement_id"], ctx["action_type"]
+    if raw_result == "0":
+        _add_verification_record(ctx, raw_result)
+        publish_event(user_id_val, "verification", {
+            "advertisement_id": advertisement_id_val, "action_type": action_type_constant, "status": 0, "coins_awarded": 0})
+        try:
+            db.session.commit()
+            event_bus.notify()
+            _confirm_submission_files(ctx)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"User {user_id_val}: Failed to commit negative verification record for {action_type_constant} Ad {advertisement_id_val}: {e}", exc_info=True)
+        return (jsonify({"status": 0, "message": f"{action_type_constant.capitalize()} analysis complete. Action not detected."}), 200)
+
+    image_user_pairs = [(user_id_val, img_hash) for img_hash in ctx["img_hashes"]]
+    processed_image_hashes.update(image_user_pairs)
+    app.logger.info(f"User {user_id_val}: Pairs {image_user_pairs} added for {action_type_constant}. Set size: {len(processed_image_hashes)}")
 
+    coins_to_award = COIN_VALUES.get(action_type_constant, 0)
     try:
-        app.logger.info(f"User {user_id_val}: Sending img {img_hash} to Gemini ({action_type_constant}) for Ad {advertisement_id_val}...")
-        final_prompt = specific_prompt
-        if action_type_constant == "comment": # خاص بالتعليق، يحتاج لاسم المستخدم
-            if 'username' not in request_data:
-                 app.logger.warning(f"User {user_id_val}: Missing 'username' for comment analysis, Ad {advertisement_id_val}.")
-                 return jsonify({"error": "Missing 'username' form field for comment analysis."}), 400
-            username = request_data['username']
-            if not username:
-                app.logger.warning(f"User {user_id_val}: Empty 'username' for comment analysis, Ad {advertisement_id_val}.")
-                return jsonify({"error": "'username' cannot be empty for comment analysis."}), 400
-            final_prompt = specific_prompt.format(username=username)
-            app.logger.info(f"User {user_id_val}: Using comment prompt for user '{username}'")
-
-
-        response = gemini_model.generate_content([final_prompt, img])
-        if response.parts:
-            raw_result = response.text.strip()
-            app.logger.info(f"User {user_id_val}: Gemini {action_type_constant} raw_result for {img_hash} Ad {advertisement_id_val}: '{raw_result}'")
-            if raw_result == "1":
-                processed_image_hashes.add(image_user_pair)
-                app.logger.info(f"User {user_id_val}: Pair {image_user_pair} added for {action_type_constant}. Set size: {len(processed_image_hashes)}")
-                
-                new_action_obj = UserAdAction(
-                    user_id=user_id_val,
-                    advertisement_id=advertisement_id_val,
-                    action_type=action_type_constant
-                )
-                db.session.add(new_action_obj)
-                
-                coins_to_award = COIN_VALUES.get(action_type_constant, 0)
-                user.coins += coins_to_award
-                app.logger.info(f"User {user_id_val} awarded {coins_to_award} coins for {action_type_constant} on Ad {advertisement_id_val}. Action prepared. New balance: {user.coins}")
+        _add_verification_record(ctx, raw_result)
+        db.session.add(UserAdAction(
+            user_id=user_id_val,
+            advertisement_id=advertisement_id_val,
+            action_type=action_type_constant
+        ))
+        new_balance = db.session.execute(
+            db.update(User).where(User.id == user_id_val)
+              .values(coins=User.coins + coins_to_award)
+              .returning(User.coins)
+        ).scalar()
+        weekly_total = record_earnings(user_id_val, coins_to_award, action_type_constant)
+        publish_event(user_id_val, "verification", {
+            "advertisement_id": advertisement_id_val, "action_type": action_type_constant, "status": 1, "coins_awarded": coins_to_award})
+        publish_event(user_id_val, "coins", {"coins": new_balance, "delta": coins_to_award, "reason": action_type_constant})
+        db.session.commit()
+        event_bus.notify()
+        _confirm_submission_files(ctx)
+        leaderboard.record(user_id_val, new_balance, coins_to_award, weekly_total)
+        interaction_index.record_social(user_id_val, advertisement_id_val)
+        app.logger.info(f"User {user_id_val} awarded {coins_to_award} coins for {action_type_constant} on Ad {advertisement_id_val}. Action committed. New balance: {new_balance}")
+    except IntegrityError:
+        # طلب متزامن لنفس المستخدم والإعلان والنوع سبق إلى uq_user_ad_action: نفس رد الفحص المسبق
+        db.session.rollback()
+        processed_image_hashes.difference_update(image_user_pairs)
+        app.logger.warning(f"User {user_id_val} already performed '{action_type_constant}' on Ad {advertisement_id_val} (concurrent request).")
+        return (jsonify({"status": -2, "message": f"You have already performed this '{action_type_constant}' action on this advertisement."}), 200)
+    except Exception as commit_ex:
+        db.session.rollback()
+        app.logger.error(f"User {user_id_val}: CRITICAL: Commit failed for {action_type_constant} Ad {advertisement_id_val} after Gemini success: {commit_ex}", exc_info=True)
+        processed_image_hashes.difference_update(image_user_pairs) # محاولة التراجع عن إضافة الهاش إذا فشل الـ commit
+        return (jsonify({"error": "Failed to record action due to a server error. Please try again."}), 500)
+
+    return (jsonify({"status": 1, "message": f"{action_type_constant.capitalize()} analysis complete. Action logged and {coins_to_award} coins awarded."}), 200)
+
+# --- START: Verification cascade ---
+verification_stats = {} # action_type -> tier -> counters (لكل عامل)
+_verification_stats_lock = threading.Lock()
+
+def _record_verification_stat(action_type, tier_name, outcome, latency_seconds):
+    with _verification_stats_lock:
+        counters = verification_stats.setdefault(action_type, {}).setdefault(
+            tier_name, {"calls": 0, "resolved": 0, "escalated": 0, "errors": 0, "latency_ms_total": 0.0})
+        counters["calls"] += 1
+        counters[outcome] += 1
+        counters["latency_ms_total"] += latency_seconds * 1000.0
+
+def _verification_tiers(action_type):
+    """[(tier_name, model, escalate_below)]؛ escalate_below=None للمستوى الأخير."""
+    threshold = VERIFICATION_ESCALATE_BELOW.get(action_type)
+    tiers = []
+    if gemini_fast_model is not None and threshold is not None:
+        tiers.append(("fast", gemini_fast_model, threshold))
+    tiers.append(("strong", gemini_model, None))
+    return tiers
+
+def _cascade_step(ctx, tier, response, started):
+    """يعيد (raw_result, error_response, escalate)."""
+    tier_name, _, threshold = tier
+    raw_result, error_response = _parse_model_response(ctx, response)
+    latency = time.monotonic() - started
+    if threshold is not None and (error_response or ctx["confidence"] is None or ctx["confidence"] < threshold):
+        app.logger.info(f"User {ctx['user_id']}: {tier_name} tier not confident ({ctx['confidence']}) for {ctx['action_type']} Ad {ctx['advertisement_id']}; escalating.")
+        _record_verification_stat(ctx["action_type"], tier_name, "escalated", latency)
+        return None, None, True
+    _record_verification_stat(ctx["action_type"], tier_name, "errors" if error_response else "resolved", latency)
+    ctx["verified_by"] = tier_name
+    ctx["model_name"] = getattr(tier[1], 'model_name', None)
+    return raw_result, error_response, False
+
+def _cascade_tier_failed(ctx, tier, exc, started):
+    """استثناء من نموذج: يُصعَّد من المستوى السريع، ويُعاد رفعه من المستوى الأخير."""
+    tier_name, _, threshold = tier
+    _record_verification_stat(ctx["action_type"], tier_name, "errors", time.monotonic() - started)
+    if threshold is None: raise exc
+    app.logger.warning(f"User {ctx['user_id']}: {tier_name} tier error for {ctx['action_type']} Ad {ctx['advertisement_id']}: {exc}; escalating.")
+
+def _verify_with_cascade(ctx, final_prompt, images):
+    request_parts = _build_model_request(final_prompt + CONFIDENCE_PROMPT_SUFFIX, images)
+    for tier in _verification_tiers(ctx["action_type"]):
+        started = time.monotonic()
+        try:
+            response = tier[1].generate_content(request_parts)
+        except Exception as e:
+            _cascade_tier_failed(ctx, tier, e, started)
+            continue
+        raw_result, error_response, escalate = _cascade_step(ctx, tier, response, started)
+        if not escalate: return raw_result, error_response
+
+async def _verify_with_cascade_async(ctx, final_prompt, images):
+    request_parts = _build_model_request(final_prompt + CONFIDENCE_PROMPT_SUFFIX, images)
+    for tier in _verification_tiers(ctx["action_type"]):
+        started = time.monotonic()
+        try:
+            response = await tier[1].generate_content_async(request_parts)
+        except Exception as e:
+            _cascade_tier_failed(ctx, tier, e, started)
+            continue
+        raw_result, error_response, escalate = _cascade_step(ctx, tier, response, started)
+        if not escalate: return raw_result, error_response
+# --- END: Verification cascade ---
 
-                try:
-                    db.session.commit()
-                    app.logger.info(f"User {user_id_val}: Action '{action_type_constant}' for Ad {advertisement_id_val} and coin update committed.")
-                except Exception as commit_ex:
-                    db.session.rollback()
-                    app.logger.error(f"User {user_id_val}: CRITICAL: Commit failed for {action_type_constant} Ad {advertisement_id_val} after Gemini success: {commit_ex}", exc_info=True)
-                    processed_image_hashes.discard(image_user_pair) # محاولة التراجع عن إضافة الهاش إذا فشل الـ commit
-                    return jsonify({"error": "Failed to record action due to a server error. Please try again."}), 500
+def _analyze_social_action(action_type_constant, specific_prompt, request_data, request_files):
+    """Helper function to reduce redundancy in analysis endpoints."""
+    ctx, error_response = _validate_social_action_request(action_type_constant, request_data)
+    if error_response: return error_response
+    payloads, error_response = _read_and_hash_image(ctx, request_files)
+    if error_response: return error_response
+    error_response = _check_social_action_duplicates(ctx)
+    if error_response: return error_response
+    images, error_response = _decode_image(ctx, payloads)
+    if error_response: return error_response
 
-                return jsonify({"status": int(raw_result), "message": f"{action_type_constant.capitalize()} analysis complete. Action logged and {coins_to_award} coins awarded."}), 200
-            elif raw_result == "0":
-                 return jsonify({"status": int(raw_result), "message": f"{action_type_constant.capitalize()} analysis complete. Action not detected."}), 200
-            else:
-                app.logger.error(f"User {user_id_val}: Unexpected Gemini ({action_type_constant}) for {img_hash} Ad {advertisement_id_val}: '{raw_result}'")
-                return jsonify({"error": f"Unexpected analysis result: '{raw_result}'"}), 500
-        else:
-            feedback = response.prompt_feedback if hasattr(response, 'prompt_feedback') else 'N/A'
-            app.logger.error(f"User {user_id_val}: Gemini no content ({action_type_constant}) for {img_hash} Ad {advertisement_id_val}. Feedback: {feedback}")
-            # إذا كان هناك حظر محتوى، قد لا نرغب في إضافة الهاش
-            # processed_image_hashes.add(image_user_pair) # فكر في هذا السطر
-            return jsonify({"error": "Analysis failed or content blocked by safety filters."}), 500
+    try:
+        final_prompt, error_response = _build_social_action_prompt(ctx, specific_prompt, request_data)
+        if error_response: return error_response
+        app.logger.info(f"User {ctx['user_id']}: Sending {len(images)} img(s) {ctx['img_hash']} to Gemini ({action_type_constant}) for Ad {ctx['advertisement_id']}...")
+        raw_result, error_response = _verify_with_cascade(ctx, final_prompt, images)
+        if error_response: return error_response
     except Exception as e:
-        app.logger.error(f"User {user_id_val}: Gemini API error ({action_type_constant}) for {img_hash} Ad {advertisement_id_val}: {e}", exc_info=True)
+        app.logger.error(f"User {ctx['user_id']}: Gemini API error ({action_type_constant}) for {ctx['img_hash']} Ad {ctx['advertisement_id']}: {e}", exc_info=True)
         return jsonify({"error": f"Image analysis error: {str(e)}"}), 500
+    return _record_social_action_result(ctx, raw_result)
+
+# --- المسار غير المتزامن (يُستخدم من asgi.py) ---
+# الانتظار على Gemini يتم في حلقة الأحداث؛ فك الصور والهاش في مجمع خيوط،
+# وعمليات قاعدة البيانات في خيط مخصص واحد (يسلسل كتابات SQLite بدل التنافس على القفل).
+ANALYZE_CPU_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get('ANALYZE_CPU_THREADS', '4')), thread_name_prefix='analyze-cpu')
+ANALYZE_DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='analyze-db')
+
+def _call_in_app_context(fn, *args):
+    with app.app_context():
+        return fn(*args)
+
+async def analyze_social_action_async(action_type_constant, specific_prompt, request_data, request_files):
+    """نسخة async من _analyze_social_action. يجب استدعاؤها داخل app.app_context()."""
+    loop = asyncio.get_running_loop()
+    run_db = lambda fn, *args: loop.run_in_executor(ANALYZE_DB_EXECUTOR, _call_in_app_context, fn, *args)
+    run_cpu = lambda fn, *args: loop.run_in_executor(ANALYZE_CPU_EXECUTOR, _call_in_app_context, fn, *args)
+
+    ctx, error_response = await run_db(_validate_social_action_request, action_type_constant, request_data)
+    if error_response: return error_response
+    payloads, error_response = await run_cpu(_read_and_hash_image, ctx, request_files)
+    if error_response: return error_response
+    error_response = await run_db(_check_social_action_duplicates, ctx)
+    if error_response: return error_response
+    images, error_response = await run_cpu(_decode_image, ctx, payloads)
+    if error_response: return error_response
+
+    try:
+        final_prompt, error_response = _build_social_action_prompt(ctx, specific_prompt, request_data)
+        if error_response: return error_response
+        app.logger.info(f"User {ctx['user_id']}: Sending {len(images)} img(s) {ctx['img_hash']} to Gemini async ({action_type_constant}) for Ad {ctx['advertisement_id']}...")
+        raw_result, error_response = await _verify_with_cascade_async(ctx, final_prompt, images)
+        if error_response: return error_response
+    except Exception as e:
+        app.logger.error(f"User {ctx['user_id']}: Gemini API error ({action_type_constant}) for {ctx['img_hash']} Ad {ctx['advertisement_id']}: {e}", exc_info=True)
+        return jsonify({"error": f"Image analysis error: {str(e)}"}), 500
+    return await run_db(_record_social_action_result, ctx, raw_result)
+
+# path -> (action_type, prompt) للمسارات التي يخدمها asgi.py مباشرة
+ANALYZE_ROUTES = {
+    '/analyze_like_status': ("like", LIKE_DETECTION_PROMPT),
+    '/analyze_comment_status': ("comment", COMMENT_DETECTION_PROMPT),
+    '/analyze_share_status': ("share", SHARE_DETECTION_PROMPT),
+    '/analyze_subscribe_status': ("subscribe", SUBSCRIBE_DETECTION_PROMPT),
+}
 
 @app.route('/analyze_like_status', methods=['POST'])
+@idempotent
 def analyze_like_status():
     return _analyze_social_action("like", LIKE_DETECTION_PROMPT, request.form, request.files)
 
 @app.route('/analyze_comment_status', methods=['POST'])
+@idempotent
 def analyze_comment_status():
     return _analyze_social_action("comment", COMMENT_DETECTION_PROMPT, request.form, request.files)
 
 @app.route('/analyze_share_status', methods=['POST'])
+@idempotent
 def analyze_share_status():
     return _analyze_social_action("share", SHARE_DETECTION_PROMPT, request.form, request.files)
 
 @app.route('/analyze_subscribe_status', methods=['POST'])
+@idempotent
 def analyze_subscribe_status():
     return _analyze_social_action("subscribe", SUBSCRIBE_DETECTION_PROMPT, request.form, request.files)
 
 
+@app.route('/admin/screenshots/<sha256_hex>', methods=['GET'])
+def get_stored_screenshot(sha256_hex):
+    """يعيد ملفًا من مخزن لقطات الشاشة (للنزاعات وإعادة التدقيق)."""
+    # !!! هام: يجب إضافة آلية تحقق من هوية المشرف هنا !!!
+    if not SHA256_HEX_RE.match(sha256_hex): return jsonify({"error": "Invalid sha256"}), 400
+    blob = ScreenshotBlob.query.get(sha256_hex)
+    mapped = screenshot_store.open(sha256_hex) if blob else None
+    if mapped is None: return jsonify({"error": f"Screenshot {sha256_hex} not found (never stored or evicted)."}), 404
+
+    def stream():
+        try:
+            # with: الـ view يُحرر حتى إذا أُغلق المولد مبكرًا (انقطاع العميل)، وإلا يرفض mmap.close() الإغلاق
+            with memoryview(mapped) as view:
+                for offset in range(0, len(view), 64 * 1024):
+                    yield bytes(view[offset:offset + 64 * 1024])
+        finally:
+            if isinstance(mapped, mmap.mmap): mapped.close()
+    return Response(stream(), mimetype=blob.media_type or 'application/octet-stream',
+                    headers={"Content-Length": str(len(mapped)), "ETag": sha256_hex})
+
+@app.route('/admin/verification_records', methods=['GET'])
+def get_verification_records():
+    # !!! هام: يجب إضافة آلية تحقق من هوية المشرف هنا !!!
+    query = VerificationRecord.query
+    for arg, column in (('user_id', VerificationRecord.user_id), ('advertisement_id', VerificationRecord.advertisement_id)):
+        value = request.args.get(arg, type=int)
+        if value: query = query.filter(column == value)
+    if request.args.get('action_type'): query = query.filter(VerificationRecord.action_type == request.args.get('action_type'))
+    before_id = request.args.get('before_id', type=int)
+    if before_id: query = query.filter(VerificationRecord.id < before_id)
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    records = query.order_by(VerificationRecord.id.desc()).limit(limit).all()
+    return jsonify({
+        "records": [record.to_dict() for record in records],
+        "next_before_id": records[-1].id if len(records) == limit else None
+    }), 200
+
+@app.route('/admin/verification/stats', methods=['GET'])
+def get_verification_stats():
+    """نسبة التحققات التي حسمها كل مستوى في سلسلة التحقق (لهذا العامل منذ التشغيل)."""
+    # !!! هام: يجب إضافة آلية تحقق من هوية المشرف هنا !!!
+    with _verification_stats_lock:
+        snapshot = {action: {tier: dict(c) for tier, c in tiers.items()} for action, tiers in verification_stats.items()}
+    report = {}
+    for action_type, tiers in snapshot.items():
+        total_resolved = sum(c["resolved"] for c in tiers.values())
+        report[action_type] = {
+            "escalate_below": VERIFICATION_ESCALATE_BELOW.get(action_type),
+            "tiers": {
+                tier: dict(c,
+                           avg_latency_ms=round(c["latency_ms_total"] / c["calls"], 1) if c["calls"] else None,
+                           share_resolved=round(c["resolved"] / total_resolved, 4) if total_resolved else None)
+                for tier, c in tiers.items()
+            }
+        }
+    return jsonify({
+        "models": {"fast": GEMINI_FAST_MODEL_NAME if gemini_fast_model else None, "strong": GEMINI_STRONG_MODEL_NAME},
+        "by_action_type": report
+    }), 200
+
+@app.route('/admin/compression/stats', methods=['GET'])
+def get_compression_stats():
+    """حجم الاستجابات قبل وبعد الضغط وزمن المعالج لكل مسار (لهذا العامل منذ التشغيل)."""
+    # !!! هام: يجب إضافة آلية تحقق من هوية المشرف هنا !!!
+    with _compression_stats_lock:
+        snapshot = {route: dict(c, by_encoding=dict(c["by_encoding"])) for route, c in compression_stats.items()}
+    report = {}
+    for route, c in snapshot.items():
+        report[route] = dict(c,
+                             cpu_seconds=round(c["cpu_seconds"], 4),
+                             ratio=round(c["compressed_bytes"] / c["raw_bytes"], 4) if c["raw_bytes"] else None,
+                             cpu_ms_per_mb=round(c["cpu_seconds"] * 1000 / (c["raw_bytes"] / 1048576), 2) if c["raw_bytes"] else None)
+    return jsonify({
+        "enabled": COMPRESSION_ENABLED,
+        "encodings": ["br", "gzip"] if brotli is not None else ["gzip"],
+        "min_bytes": COMPRESSION_MIN_BYTES,
+        "gzip_level": COMPRESSION_GZIP_LEVEL,
+        "brotli_quality": COMPRESSION_BROTLI_QUALITY if brotli is not None else None,
+        "by_route": report
+    }), 200
+
+CLICK_UPDATE_SQL = db.text("""
+    UPDATE advertisement
+    SET number_of_clicks = number_of_clicks + 1, updated_at = :now,
+        clicked_by_user_ids = json_insert(COALESCE(clicked_by_user_ids, '[]'), '$[#]', :user_id)
+    WHERE id = :ad_id AND NOT EXISTS (SELECT 1 FROM json_each(COALESCE(advertisement.clicked_by_user_ids, '[]')) WHERE value = :user_id)
+    RETURNING number_of_clicks
+""").bindparams(db.bindparam('now', type_=db.DateTime))
+
 @app.route('/advertisements/<int:ad_id>/click', methods=['POST'])
+@idempotent
 def click_advertisement(ad_id): # هذا لـ "نقر الرابط" وليس لإجراءات السوشيال ميديا
     if not request.is_json:
         return jsonify({"error": "Request must be JSON"}), 400
@@ -833,8 +4222,17 @@ def click_advertisement(ad_id): # هذا لـ "نقر الرابط" وليس ل
     except ValueError:
         return jsonify({"error": "'user_id' must be an integer"}), 400
 
-    advertisement = Advertisement.query.get(ad_id)
-    clicking_user = User.query.get(clicking_user_id)
+    # نقرة مكررة: يُجاب عنها من الكتالوج بدون استعلام (غير ذلك يُتحقق في القاعدة كالمعتاد)
+    catalog_ad = ad_catalog.snapshot().by_id.get(ad_id)
+    if catalog_ad is not None and catalog_ad.is_active and clicking_user_id in catalog_ad.clicked_by_user_ids:
+        app.logger.info(f"User {clicking_user_id} already clicked Ad link {ad_id}. No new coins awarded to advertiser.")
+        return jsonify({
+            "message": "You have already interacted with this advertisement link.",
+            "advertisement_id": ad_id,
+            "number_of_clicks": catalog_ad.number_of_clicks
+        }), 200
+
+    advertisement, clicking_user = load_advertisement_with_user(ad_id, clicking_user_id)
 
     if not advertisement:
         return jsonify({"error": f"Advertisement with ID {ad_id} not found"}), 404
@@ -852,30 +4250,50 @@ def click_advertisement(ad_id): # هذا لـ "نقر الرابط" وليس ل
             "number_of_clicks": advertisement.number_of_clicks
         }), 200
 
-    advertiser = User.query.get(advertisement.user_id)
+    advertiser = advertisement.advertiser # محمّل مسبقًا مع الإعلان
     if not advertiser:
         app.logger.error(f"CRITICAL: Advertiser (User ID {advertisement.user_id}) for Ad {ad_id} not found!")
         return jsonify({"error": "Internal server error: Advertiser not found"}), 500
 
     try:
-        clicked_ids.append(clicking_user_id)
-        advertisement.set_clicked_by_user_ids(clicked_ids)
-        advertisement.number_of_clicks += 1
-        
-        coins_to_award_advertiser = advertisement.coin_per_click
-        advertiser.coins += coins_to_award_advertiser
-        
-        advertisement.updated_at = datetime.utcnow()
+        # UPDATE شرطي واحد بدل قراءة-تعديل-كتابة في Python: طلبان متزامنان من نفس المستخدم لا يُحسبان مرتين،
+        # وطلبان من مستخدمين مختلفين لا يضيع أحدهما (انظر bench_contention.py)
+        coins_to_award_advertiser, advertiser_id = advertisement.coin_per_click, advertiser.id
+        clicked_at = datetime.utcnow()
+        new_total_clicks = db.session.execute(CLICK_UPDATE_SQL, {
+            "ad_id": ad_id, "user_id": clicking_user_id, "now": clicked_at}).scalar()
+        if new_total_clicks is None:
+            db.session.rollback()
+            app.logger.info(f"User {clicking_user_id} already clicked Ad link {ad_id} (concurrent request). No new coins awarded to advertiser.")
+            return jsonify({
+                "message": "You have already interacted with this advertisement link.",
+                "advertisement_id": ad_id,
+                "number_of_clicks": db.session.query(Advertisement.number_of_clicks).filter(Advertisement.id == ad_id).scalar()
+            }), 200
+        advertiser_balance = db.session.execute(
+            db.update(User).where(User.id == advertiser_id)
+              .values(coins=User.coins + coins_to_award_advertiser)
+              .returning(User.coins)
+        ).scalar()
+        db.session.add(AdClick(user_id=clicking_user_id, advertisement_id=ad_id, advertiser_id=advertiser_id,
+                               coins=coins_to_award_advertiser, created_at=clicked_at))
+        weekly_total = record_earnings(advertiser_id, coins_to_award_advertiser, 'ad_click')
+        publish_event(advertiser_id, "coins", {
+            "coins": advertiser_balance, "delta": coins_to_award_advertiser, "reason": "ad_click", "advertisement_id": ad_id})
 
         db.session.commit()
-        app.logger.info(f"User {clicking_user_id} clicked Ad link {ad_id}. Advertiser {advertiser.id} awarded {coins_to_award_advertiser} coins. New balance: {advertiser.coins}")
+        event_bus.notify()
+        leaderboard.record(advertiser_id, advertiser_balance, coins_to_award_advertiser, weekly_total)
+        interaction_index.record_click(clicking_user_id, ad_id)
+        ad_catalog.record_click(ad_id, clicking_user_id, new_total_clicks, clicked_at)
+        app.logger.info(f"User {clicking_user_id} clicked Ad link {ad_id}. Advertiser {advertiser_id} awarded {coins_to_award_advertiser} coins. New balance: {advertiser_balance}")
         
         return jsonify({
             "message": "Advertisement link clicked successfully!",
             "advertisement_id": ad_id,
-            "new_total_clicks_on_ad": advertisement.number_of_clicks,
+            "new_total_clicks_on_ad": new_total_clicks,
             "coins_awarded_to_advertiser": coins_to_award_advertiser,
-            "advertiser_new_coin_balance": advertiser.coins
+            "advertiser_new_coin_balance": advertiser_balance
         }), 200
 
     except Exception as e:
@@ -901,20 +4319,23 @@ def update_user_data(user_id_param):
     if 'interests' in data:
         user.set_interests(data['interests']) # يجب أن تكون قائمة
         updated_fields.append('interests')
+    # تعديل العملات كتعبير SQL (coins = coins + ?) حتى لا يضيع منح متزامن من مسار آخر
+    coins_expression = None
     if 'add_coins' in data: # هذه عملية إدارية، يجب تأمينها
         try:
             coins_to_add = int(data['add_coins'])
             if coins_to_add < 0: return jsonify({"error": "'add_coins' must be non-negative"}),400
-            user.coins += coins_to_add
+            coins_expression = User.coins + coins_to_add
             updated_fields.append('coins_added')
         except (ValueError, TypeError): return jsonify({"error": "'add_coins' must be int"}),400
     if 'subtract_coins' in data: # هذه عملية إدارية، يجب تأمينها
         try:
             amount_to_subtract = int(data['subtract_coins'])
             if amount_to_subtract < 0: return jsonify({"error": "'subtract_coins' must be non-negative"}),400
-            user.coins = max(0, user.coins - amount_to_subtract)
+            coins_expression = db.func.max(0, (coins_expression if coins_expression is not None else User.coins) - amount_to_subtract)
             updated_fields.append('coins_subtracted')
         except (ValueError, TypeError): return jsonify({"error": "'subtract_coins' must be int"}),400
+    if coins_expression is not None: user.coins = coins_expression
 
     if not updated_fields: return jsonify({"message": "No valid fields to update."}), 200
 
@@ -942,24 +4363,27 @@ def get_all_user_ad_actions():
         ad_id_filter = request.args.get('advertisement_id', type=int)
         action_type_filter = request.args.get('action_type', type=str)
 
-        query = UserAdAction.query
+        # الجدول الساخن والأرشيف معًا
+        actions = user_ad_actions_union()
+        query = db.select(actions)
 
         if user_id_filter:
-            query = query.filter(UserAdAction.user_id == user_id_filter)
+            query = query.where(actions.c.user_id == user_id_filter)
         if ad_id_filter:
-            query = query.filter(UserAdAction.advertisement_id == ad_id_filter)
+            query = query.where(actions.c.advertisement_id == ad_id_filter)
         if action_type_filter:
-            query = query.filter(UserAdAction.action_type.ilike(f"%{action_type_filter}%")) # بحث غير حساس لحالة الأحرف
+            query = query.where(actions.c.action_type.ilike(f"%{action_type_filter}%")) # بحث غير حساس لحالة الأحرف
 
         # الترتيب (يمكنك تغييره حسب الحاجة)
-        actions_query = query.order_by(UserAdAction.created_at.desc())
+        actions_query = query.order_by(actions.c.created_at.desc())
         
         # التقسيم إلى صفحات (Pagination)
-        paginated_actions = actions_query.paginate(page=page, per_page=per_page, error_out=False)
+        page, per_page = max(page or 1, 1), max(per_page or 20, 1)
+        total_actions = db.session.execute(db.select(db.func.count()).select_from(query.subquery())).scalar()
+        total_pages = (total_actions + per_page - 1) // per_page
+        page_rows = db.session.execute(actions_query.limit(per_page).offset((page - 1) * per_page)).all()
         
-        actions_list = []
-        for action in paginated_actions.items:
-            actions_list.append({
+        actions_list = ({
                 "id": action.id,
                 "user_id": action.user_id,
                 "advertisement_id": action.advertisement_id,
@@ -968,17 +4392,16 @@ def get_all_user_ad_actions():
                 # يمكنك إضافة معلومات عن المستخدم أو الإعلان إذا أردت (يتطلب join)
                 # "user_email": action.user.email if action.user else None, 
                 # "advertisement_title": action.advertisement.title if action.advertisement else None
-            })
+            } for action in page_rows)
         
-        return jsonify({
-            "actions": actions_list,
-            "total_actions": paginated_actions.total,
-            "current_page": paginated_actions.page,
-            "total_pages": paginated_actions.pages,
-            "per_page": paginated_actions.per_page,
-            "has_next": paginated_actions.has_next,
-            "has_prev": paginated_actions.has_prev
-        }), 200
+        return stream_json_response(actions_list, list_key="actions", envelope={
+            "total_actions": total_actions,
+            "current_page": page,
+            "total_pages": total_pages,
+            "per_page": per_page,
+            "has_next": page < total_pages,
+            "has_prev": page > 1
+        })
 
     except Exception as e:
         app.logger.error(f"Error fetching all UserAdActions: {e}", exc_info=True)
@@ -990,37 +4413,13 @@ def get_ads_available_for_any_interaction(requesting_user_id):
         return jsonify({"error": f"User with ID {requesting_user_id} not found."}), 404
 
     try:
-        # 1. احصل على الإجراءات (مهام السوشيال ميديا) التي قام بها المستخدم
-        actions_done_by_user_raw = db.session.query(
-                                        UserAdAction.advertisement_id, 
-                                        UserAdAction.action_type).filter(UserAdAction.user_id == requesting_user_id).all()
-        
-        # مجموعة بمعرفات الإعلانات التي قام المستخدم بأي مهمة سوشيال ميديا عليها
-        ads_with_social_interaction_ids = {ad_id for ad_id, _ in actions_done_by_user_raw}
-        app.logger.debug(f"User {requesting_user_id} has social interactions with ad_ids: {ads_with_social_interaction_ids}")
-
-        # 2. احصل على جميع الإعلانات النشطة والموافق عليها
-        #    (يمكنك إضافة فلتر لاستبعاد إعلانات المستخدم نفسه إذا أردت)
-        query = Advertisement.query.filter(
-            Advertisement.is_approved == True,
-            Advertisement.is_active == True
-            # Advertisement.user_id != requesting_user_id # اختياري
-        )
-        all_active_approved_ads = query.order_by(Advertisement.created_at.desc()).all()
+        # الإعلانات النشطة التي لم ينقر المستخدم رابطها ولم يقم بأي مهمة سوشيال عليها، من فهرس الـ bitsets
+        available_ad_ids = interaction_index.available_ad_ids(requesting_user_id)
 
-        available_ads = []
-        for ad in all_active_approved_ads:
-            # 3. تحقق مما إذا كان المستخدم قد نقر على رابط هذا الإعلان
-            users_who_clicked_this_ad_link = ad.get_clicked_by_user_ids()
-            did_click_link = requesting_user_id in users_who_clicked_this_ad_link
+        # بيانات الإعلانات من الكتالوج (مرتبة مسبقًا) بدل استعلام IN على دفعات
+        available_ad_ids = set(available_ad_ids)
+        available_ads = [ad.to_dict() for ad in ad_catalog.snapshot().active if ad.id in available_ad_ids]
 
-            # 4. تحقق مما إذا كان المستخدم قد قام بأي مهمة سوشيال ميديا على هذا الإعلان
-            did_social_interaction = ad.id in ads_with_social_interaction_ids
-            
-            # 5. إذا لم ينقر على الرابط ولم يقم بأي مهمة سوشيال ميديا، أضف الإعلان
-            if not did_click_link and not did_social_interaction:
-                available_ads.append(ad.to_dict())
-        
         app.logger.info(f"Found {len(available_ads)} ads available for ANY interaction by user {requesting_user_id}.")
         return jsonify(available_ads), 200
 
@@ -1211,10 +4610,16 @@ def get_approved_advertisements():
     تقبل بارامتر اختياري في الرابط 'exclude_user_id' لاستبعاد إعلانات مستخدم معين.
     مثال (بدون استبعاد): /advertisements/approved
     مثال (مع استبعاد):   /advertisements/approved?exclude_user_id=5
+    مزامنة تزايدية: ?since=<watermark> يعيد فقط ما تغير بعده
+    {"advertisements": [...], "removed_ids": [...], "watermark": "..."}؛ الاستجابة الكاملة تحمل الترويسة X-Sync-Watermark.
     """
+    since, error_response = parse_sync_since(request.args.get('since'))
+    if error_response: return error_response
+    user_id_to_exclude = None
     try:
-        # 1. ابدأ بالاستعلام الأساسي: جلب كل الإعلانات التي is_approved = True
-        query = Advertisement.query.filter_by(is_approved=True)
+        # 1. ابدأ بكل الإعلانات التي is_approved = True (من كتالوج العامل، مرتبة من الأحدث إلى الأقدم)
+        snapshot = ad_catalog.snapshot()
+        approved_ads = snapshot.approved
         
         # 2. تحقق من وجود البارامتر الاختياري 'exclude_user_id' في الرابط
         user_id_to_exclude_str = request.args.get('exclude_user_id')
@@ -1226,7 +4631,7 @@ def get_approved_advertisements():
                 user_id_to_exclude = int(user_id_to_exclude_str)
                 
                 # أضف الشرط الجديد: حيث "user_id" لا يساوي (!=) الرقم المطلوب استبعاده
-                query = query.filter(Advertisement.user_id != user_id_to_exclude)
+                approved_ads = [ad for ad in approved_ads if ad.user_id != user_id_to_exclude]
                 
                 app.logger.info(f"Fetching approved ads, excluding those from user_id: {user_id_to_exclude}")
 
@@ -1234,13 +4639,20 @@ def get_approved_advertisements():
                 app.logger.warning(f"Invalid 'exclude_user_id' provided: {user_id_to_exclude_str}")
                 return jsonify({"error": "Invalid 'exclude_user_id'. It must be an integer."}), 400
 
-        # 4. ترتيب النتائج من الأحدث إلى الأقدم وتنفيذ الاستعلام
-        approved_ads = query.order_by(Advertisement.created_at.desc()).all()
-        
+        if since is not None:
+            changed_ads, removed_ids, watermark = load_ad_changes(since)
+            upserts, now = [], datetime.utcnow()
+            for ad in changed_ads:
+                if ad.deleted_at is not None or not ad.is_approved or (ad.ends_at is not None and ad.ends_at <= now):
+                    removed_ids.add(ad.id)
+                elif ad.user_id != user_id_to_exclude: upserts.append(ad.to_dict())
+            app.logger.info(f"Approved ads delta since {since.isoformat()}: {len(upserts)} changed, {len(removed_ids)} removed.")
+            return ad_sync_response(upserts, removed_ids, watermark)
+
         app.logger.info(f"Fetched {len(approved_ads)} approved advertisements after filtering.")
         
-        # 5. تحويل النتائج إلى صيغة JSON وإرسالها
-        return jsonify([ad.to_dict() for ad in approved_ads]), 200
+        # 4. تحويل النتائج إلى صيغة JSON وإرسالها
+        return stream_json_response((ad.to_dict() for ad in approved_ads), headers={"X-Sync-Watermark": snapshot.watermark.isoformat()})
 
     except Exception as e:
         app.logger.error(f"Error fetching approved advertisements: {e}", exc_info=True)
@@ -1264,6 +4676,90 @@ def delete_coin_package(package_id):
         db.session.rollback()
         app.logger.error(f"Error deleting coin package {package_id}: {e}", exc_info=True)
         return jsonify({"error": "Internal Server Error deleting coin package"}), 500
+# --- Spin Prize Endpoints ---
+
+def _validate_spin_prize_fields(data, partial=False):
+    """يعيد (fields, error_message)."""
+    fields = {}
+    if 'label' in data or not partial:
+        if not data.get('label'): return None, "Missing required field: label"
+        fields['label'] = data['label']
+    for key in ('coins', 'weight'):
+        if key in data or not partial:
+            value = data.get(key)
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                return None, f"'{key}' must be a non-negative integer."
+            fields[key] = value
+    if 'is_active' in data:
+        if not isinstance(data['is_active'], bool): return None, "'is_active' must be a boolean."
+        fields['is_active'] = data['is_active']
+    return fields, None
+
+@app.route('/admin/spin_prizes', methods=['POST'])
+def create_spin_prize():
+    # !!! هام: يجب إضافة آلية تحقق من هوية المشرف هنا !!!
+    if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
+    fields, error = _validate_spin_prize_fields(request.get_json())
+    if error: return jsonify({"error": error}), 400
+    try:
+        prize = SpinPrize(**fields)
+        db.session.add(prize)
+        db.session.commit()
+        invalidate_spin_prize_table()
+        app.logger.info(f"Admin: Spin prize created: {prize}")
+        return jsonify({"message": "Spin prize created successfully", "prize": prize.to_dict()}), 201
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error creating spin prize: {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error creating spin prize"}), 500
+
+@app.route('/admin/spin_prizes', methods=['GET'])
+def get_spin_prizes_admin():
+    # !!! هام: يجب إضافة آلية تحقق من هوية المشرف هنا !!!
+    prizes = SpinPrize.query.order_by(SpinPrize.id).all()
+    total_weight = sum(p.weight for p in prizes if p.is_active) or 0
+    return jsonify([
+        dict(p.to_dict(), probability=(p.weight / total_weight if p.is_active and total_weight else 0.0))
+        for p in prizes
+    ]), 200
+
+@app.route('/admin/spin_prizes/<int:prize_id>', methods=['PUT'])
+def update_spin_prize(prize_id):
+    # !!! هام: يجب إضافة آلية تحقق من هوية المشرف هنا !!!
+    prize = SpinPrize.query.get(prize_id)
+    if prize is None: return jsonify({"error": f"Spin prize with ID {prize_id} not found."}), 404
+    if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
+    fields, error = _validate_spin_prize_fields(request.get_json(), partial=True)
+    if error: return jsonify({"error": error}), 400
+    if not fields: return jsonify({"message": "No valid fields provided for update."}), 200
+    try:
+        for key, value in fields.items():
+            setattr(prize, key, value)
+        db.session.commit()
+        invalidate_spin_prize_table()
+        app.logger.info(f"Admin: Spin prize {prize_id} updated. Fields: {', '.join(fields)}")
+        return jsonify({"message": "Spin prize updated successfully", "prize": prize.to_dict()}), 200
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error updating spin prize {prize_id}: {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error updating spin prize"}), 500
+
+@app.route('/admin/spin_prizes/<int:prize_id>', methods=['DELETE'])
+def delete_spin_prize(prize_id):
+    # !!! هام: يجب إضافة آلية تحقق من هوية المشرف هنا !!!
+    prize = SpinPrize.query.get(prize_id)
+    if prize is None: return jsonify({"error": f"Spin prize with ID {prize_id} not found"}), 404
+    try:
+        db.session.delete(prize)
+        db.session.commit()
+        invalidate_spin_prize_table()
+        app.logger.info(f"Admin: Spin prize {prize_id} deleted.")
+        return jsonify({"message": f"Spin prize {prize_id} deleted successfully."}), 200
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error deleting spin prize {prize_id}: {e}", exc_info=True)
+        return jsonify({"error": "Internal Server Error deleting spin prize"}), 500
+
 # --- التشغيل المحلي ---
 if __name__ == '__main__':
     print("Starting Flask development server (for local testing)...")
@@ -0,0 +1,109 @@
+"""
+نقطة دخول ASGI للتطبيق.
+
+مسارات /analyze_*_status تُخدم بشكل غير متزامن (generate_content_async) حتى تستطيع
+عملية واحدة حمل مئات التحليلات المتزامنة؛ بقية المسارات تمر إلى تطبيق Flask عبر WsgiToAsgi.
+المسارات غير المتزامنة لا تمر بـ before_request، لذلك تُشغَّل الخيوط الخلفية من حدث lifespan.startup،
+وتُطبق دوال after_request (ضغط الاستجابة) على استجاباتها يدويًا.
+
+التشغيل:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 2
+أو:
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker -w 2
+"""
+import asyncio
+import io
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.formparser import parse_form_data
+
+from app import (app, ANALYZE_ROUTES, ANALYZE_CPU_EXECUTOR, ANALYZE_DB_EXECUTOR, analyze_social_action_async,
+                 run_idempotent_async, _call_in_app_context, _idempotency_user_id, _request_fingerprint,
+                 _start_background_workers)
+
+MAX_ANALYZE_BODY_BYTES = 16 * 1024 * 1024 # 16MB
+
+flask_application = WsgiToAsgi(app)
+
+
+async def _read_body(receive, limit):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            return False
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+def _parse_multipart(headers, body):
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'CONTENT_TYPE': headers.get('content-type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+    _, form, files = parse_form_data(environ)
+    return form, files
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            _start_background_workers() # داخل عملية العامل (بعد fork)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def _send_flask_response(send, scope, headers, rv):
+    with app.test_request_context(scope['path'], method=scope['method'], headers=headers):
+        response = app.process_response(app.make_response(rv)) # after_request: ضغط الاستجابة حسب Accept-Encoding
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response.headers.items()],
+    })
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in ANALYZE_ROUTES:
+        await flask_application(scope, receive, send)
+        return
+
+    action_type, prompt = ANALYZE_ROUTES[scope['path']]
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', [])}
+    body = await _read_body(receive, MAX_ANALYZE_BODY_BYTES)
+    if body is None:
+        return
+    if body is False:
+        await _send_flask_response(send, scope, headers, ({"error": "Request body too large."}, 413))
+        return
+
+    loop = asyncio.get_running_loop()
+    form, files = await loop.run_in_executor(ANALYZE_CPU_EXECUTOR, _parse_multipart, headers, body)
+    with app.app_context():
+        handler = lambda: analyze_social_action_async(action_type, prompt, form, files)
+        key = headers.get('idempotency-key')
+        user_id = _idempotency_user_id(form, None) if key else None
+        if key and len(key) > 255:
+            rv = ({"error": "Idempotency-Key must be at most 255 characters."}, 400)
+        elif user_id is not None:
+            fingerprint = await loop.run_in_executor(
+                ANALYZE_CPU_EXECUTOR, _request_fingerprint, 'POST', scope['path'], form, files, None)
+            run_db = lambda fn, *args: loop.run_in_executor(ANALYZE_DB_EXECUTOR, _call_in_app_context, fn, *args)
+            rv = await run_idempotent_async(user_id, key, fingerprint, handler, run_db)
+        else:
+            rv = await handler()
+    await _send_flask_response(send, scope, headers, rv)
@@ -0,0 +1,373 @@
+"""
+اختبار تحميل متزامن لمسارات الكتابة على العملات والنقرات، مع فحص الثوابت بعده.
+
+يشغّل --processes عملية × --threads خيطًا، كل خيط يرسل طلبات عشوائية عبر app.test_client() إلى:
+    click    POST /advertisements/<id>/click        (number_of_clicks و clicked_by_user_ids وعملات المعلن)
+    analyze  POST /analyze_<type>_status            (_analyze_social_action بمُحقق بديل بدل Gemini)
+    update   PATCH /users/<id> {"add_coins": n}     (update_user_data)
+على قاعدة بيانات مؤقتة منفصلة (DATABASE_PATH)، ثم يطبع الإنتاجية وزمن الاستجابة ووقت الانتظار في
+عبارات الكتابة و commit وعدد أخطاء "database is locked"، ويفحص:
+    - عملات كل مستخدم = مجموع ما أكدته الاستجابات الناجحة (لا تحديث مفقود ولا منح بدون استجابة)
+    - number_of_clicks = عدد الناقرين المختلفين في clicked_by_user_ids و ad_click = النقرات المؤكدة
+    - لا يوجد UserAdAction مكرر، وكل إجراء مؤكد له صف واحد بالضبط
+رمز الخروج 1 إذا فشل أي ثابت (بوابة لأي تغيير في التخزين أو التزامن).
+
+أمثلة:
+    python bench_contention.py --processes 2 --threads 8 --duration 10
+    python bench_contention.py --mix click=1 --users 200 --ads 5 --json
+    python bench_contention.py --db /tmp/bench.db --keep-db --verifier-latency 0.05
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+OPERATIONS = ("click", "analyze", "update")
+ACTION_TYPES = ("like", "comment", "share", "subscribe")
+
+
+class _StubResponse:
+    def __init__(self, text):
+        self.text = text
+        self.parts = [text]
+        self.usage_metadata = None
+
+
+class StubVerifier:
+    """بديل لـ Gemini: يوافق دائمًا بعد latency ثانية (الانتظار خارج أي معاملة، كما في الإنتاج)."""
+    model_name = 'stub'
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def generate_content(self, request_parts):
+        if self.latency: time.sleep(self.latency)
+        return _StubResponse("1 99")
+
+
+class LockErrorCounter(logging.Handler):
+    """يعد أخطاء 'database is locked' التي يسجلها app.logger من مسارات الكتابة."""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        exc = record.exc_info[1] if record.exc_info else None
+        if 'database is locked' in (str(exc) if exc else record.getMessage()):
+            with self.lock:
+                self.count += 1
+
+
+class WriteTimer:
+    """
+    وقت كل عبارة INSERT/UPDATE/DELETE وكل session.commit() في هذا العامل. تحت التنافس يهيمن عليه
+    انتظار قفل SQLite (busy timeout) فيُستخدم كتقدير لوقت انتظار القفل.
+    """
+
+    def __init__(self, db):
+        from sqlalchemy import event
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.write_seconds = []
+        self.commit_seconds = []
+        event.listen(db.engine, 'before_cursor_execute', self._before_execute)
+        event.listen(db.engine, 'after_cursor_execute', self._after_execute)
+        event.listen(db.session, 'before_commit', self._before_commit)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_rollback', self._after_commit)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.local.execute_started = time.monotonic() if statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE') else None
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(self.local, 'execute_started', None)
+        if started is not None:
+            with self.lock: self.write_seconds.append(time.monotonic() - started)
+
+    def _before_commit(self, session):
+        self.local.commit_started = time.monotonic()
+
+    def _after_commit(self, session):
+        started = getattr(self.local, 'commit_started', None)
+        if started is not None:
+            self.local.commit_started = None
+            with self.lock: self.commit_seconds.append(time.monotonic() - started)
+
+
+def _png(rng):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), tuple(rng.randrange(256) for _ in range(3))).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def _parse_mix(value):
+    weights = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS: raise argparse.ArgumentTypeError(f"unknown operation {name!r}")
+        try:
+            weights[name] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid weight for {name!r}")
+    if not any(weights.values()): raise argparse.ArgumentTypeError("at least one operation needs a positive weight")
+    return weights
+
+
+# --- التجهيز ---
+def create_fixtures(users, ads):
+    """مستخدمون بعملات 0 وإعلانات موافق عليها (كل إعلان لمستخدم من نفس المجموعة)؛ يعيد (user_ids, ad_ids)."""
+    from werkzeug.security import generate_password_hash
+    from app import app, db, User, Advertisement, bump_catalog_version
+    password_hash = generate_password_hash('bench')
+    with app.app_context():
+        user_rows = [User(name=f"bench {i}", email=f"bench-{i}@bench.invalid", phone_number=str(i),
+                          password_hash=password_hash, coins=0, referred_by_me_ids='[]') for i in range(users)]
+        db.session.add_all(user_rows)
+        db.session.flush()
+        user_ids = [user.id for user in user_rows]
+        ad_rows = [Advertisement(user_id=user_ids[i % len(user_ids)], title=f"bench ad {i}", link="https://bench.invalid",
+                                 coin_per_click=1 + i % 5, is_approved=True, is_active=True, clicked_by_user_ids='[]')
+                   for i in range(ads)]
+        db.session.add_all(ad_rows)
+        db.session.flush()
+        ad_ids = [ad.id for ad in ad_rows]
+        bump_catalog_version()
+        db.session.commit()
+    return user_ids, ad_ids
+
+
+# --- العامل (عملية) ---
+def _run_thread(app, client_factory, options, user_ids, ad_ids, seed, deadline, result):
+    from app import COIN_VALUES
+    rng = random.Random(seed)
+    client = client_factory()
+    operations = [name for name in OPERATIONS if options["mix"].get(name)]
+    weights = [options["mix"][name] for name in operations]
+    while time.monotonic() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        user_id = rng.choice(user_ids)
+        started = time.monotonic()
+        if operation == "click":
+            ad_id = rng.choice(ad_ids)
+            response = client.post(f'/advertisements/{ad_id}/click', json={"user_id": user_id})
+            body = response.get_json(silent=True) or {}
+            if response.status_code == 200 and "coins_awarded_to_advertiser" in body:
+                result["clicks"].append((ad_id, user_id))
+                result["awards"].append((None, ad_id, body["coins_awarded_to_advertiser"]))
+        elif operation == "analyze":
+            ad_id, action_type = rng.choice(ad_ids), rng.choice(ACTION_TYPES)
+            data = {"user_id": str(user_id), "advertisement_id": str(ad_id), "username": "bench",
+                    "image": (io.BytesIO(_png(rng)), 'bench.png', 'image/png')}
+            response = client.post(f'/analyze_{action_type}_status', data=data, content_type='multipart/form-data')
+            body = response.get_json(silent=True) or {}
+            if response.status_code == 200 and body.get("status") == 1:
+                result["actions"].append((user_id, ad_id, action_type))
+                result["awards"].append((user_id, None, COIN_VALUES.get(action_type, 0)))
+        else:
+            amount = rng.randint(1, 5)
+            response = client.patch(f'/users/{user_id}', json={"add_coins": amount})
+            if response.status_code == 200:
+                result["awards"].append((user_id, None, amount))
+        elapsed = time.monotonic() - started
+        stats = result["operations"].setdefault(operation, {"latencies": [], "statuses": {}})
+        stats["latencies"].append(elapsed)
+        stats["statuses"][str(response.status_code)] = stats["statuses"].get(str(response.status_code), 0) + 1
+
+
+def worker_process(index, options, user_ids, ad_ids, start_at, results_queue):
+    sys.stdout = sys.stderr # رسائل تهيئة app لا تختلط بتقرير --json
+    import app as app_module
+    from app import app, db
+    app.logger.setLevel(logging.ERROR)
+    app.logger.handlers[:] = [handler for handler in app.logger.handlers if isinstance(handler, LockErrorCounter)]
+    lock_errors = LockErrorCounter()
+    app.logger.addHandler(lock_errors)
+    app_module.gemini_model = StubVerifier(options["verifier_latency"])
+    app_module.gemini_fast_model = None
+    with app.app_context():
+        timer = WriteTimer(db)
+
+    # قبل deadline: كل العمليات تبدأ معًا بعد انتهاء الاستيراد وتهيئة الكتالوجات
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = time.monotonic() + options["duration"]
+    threads, results = [], []
+    for thread_index in range(options["threads"]):
+        result = {"operations": {}, "clicks": [], "actions": [], "awards": []}
+        results.append(result)
+        seed = options["seed"] * 1_000_003 + index * 1009 + thread_index
+        threads.append(threading.Thread(target=_run_thread, args=(app, app.test_client, options, user_ids, ad_ids,
+                                                                 seed, deadline, result)))
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    merged = {"operations": {}, "clicks": [], "actions": [], "awards": [],
+              "lock_errors": lock_errors.count, "write_seconds": timer.write_seconds, "commit_seconds": timer.commit_seconds}
+    for result in results:
+        for key in ("clicks", "actions", "awards"): merged[key].extend(result[key])
+        for operation, stats in result["operations"].items():
+            target = merged["operations"].setdefault(operation, {"latencies": [], "statuses": {}})
+            target["latencies"].extend(stats["latencies"])
+            for status, count in stats["statuses"].items():
+                target["statuses"][status] = target["statuses"].get(status, 0) + count
+    results_queue.put(merged)
+
+
+# --- الثوابت ---
+def check_invariants(user_ids, ad_ids, merged):
+    """يعيد [(name, ok, detail)]."""
+    from app import app, db, User, Advertisement, AdClick, UserAdAction, UserAdActionArchive, ACTION_TYPE_CODES, _decode_json_list
+    expected_coins = {user_id: 0 for user_id in user_ids}
+    with app.app_context():
+        advertiser_by_ad = dict(db.session.query(Advertisement.id, Advertisement.user_id).filter(Advertisement.id.in_(ad_ids)))
+        for user_id, ad_id, coins in merged["awards"]:
+            expected_coins[advertiser_by_ad[ad_id] if ad_id is not None else user_id] += coins
+        actual_coins = dict(db.session.query(User.id, User.coins).filter(User.id.in_(user_ids)))
+        coin_mismatches = {user_id: (actual_coins.get(user_id), expected) for user_id, expected in expected_coins.items()
+                           if actual_coins.get(user_id) != expected}
+
+        confirmed_clicks = {}
+        for ad_id, user_id in merged["clicks"]:
+            confirmed_clicks.setdefault(ad_id, []).append(user_id)
+        logged_clicks = dict(db.session.query(AdClick.advertisement_id, db.func.count(db.distinct(AdClick.user_id)))
+                               .filter(AdClick.advertisement_id.in_(ad_ids)).group_by(AdClick.advertisement_id))
+        click_mismatches = {}
+        for ad_id, number_of_clicks, clicked_json in db.session.query(
+                Advertisement.id, Advertisement.number_of_clicks, Advertisement.clicked_by_user_ids).filter(Advertisement.id.in_(ad_ids)):
+            clickers = _decode_json_list(clicked_json)
+            confirmed = confirmed_clicks.get(ad_id, [])
+            counts = (number_of_clicks, len(set(clickers)), len(clickers), logged_clicks.get(ad_id, 0), len(confirmed))
+            if len(set(counts)) != 1 or set(clickers) != set(confirmed):
+                click_mismatches[ad_id] = dict(zip(("number_of_clicks", "unique_clickers", "clicked_by_user_ids",
+                                                    "ad_click_users", "confirmed"), counts))
+
+        hot_duplicates = db.session.query(UserAdAction.user_id, UserAdAction.advertisement_id, UserAdAction.action_type)\
+                                   .group_by(UserAdAction.user_id, UserAdAction.advertisement_id, UserAdAction.action_type)\
+                                   .having(db.func.count() > 1).count()
+        cross_duplicates = db.session.query(UserAdAction.id).join(UserAdActionArchive, db.and_(
+            UserAdActionArchive.user_id == UserAdAction.user_id,
+            UserAdActionArchive.advertisement_id == UserAdAction.advertisement_id,
+            UserAdActionArchive.action_code == db.case(ACTION_TYPE_CODES, value=UserAdAction.action_type))).count()
+        stored_actions = set(db.session.query(UserAdAction.user_id, UserAdAction.advertisement_id, UserAdAction.action_type)
+                               .filter(UserAdAction.user_id.in_(user_ids)).all())
+        confirmed_actions = merged["actions"]
+    return [
+        ("coins == sum of confirmed awards", not coin_mismatches,
+         f"{len(coin_mismatches)} users differ, e.g. {dict(list(coin_mismatches.items())[:3])} (actual, expected)"),
+        ("clicks == unique clickers == confirmed clicks", not click_mismatches,
+         f"{len(click_mismatches)} ads differ, e.g. {dict(list(click_mismatches.items())[:3])}"),
+        ("no duplicate UserAdAction", hot_duplicates == 0 and cross_duplicates == 0 and len(confirmed_actions) == len(set(confirmed_actions)),
+         f"{hot_duplicates} duplicated keys, {cross_duplicates} rows also archived, "
+         f"{len(confirmed_actions) - len(set(confirmed_actions))} actions confirmed twice"),
+        ("every confirmed action stored", stored_actions == {tuple(action) for action in confirmed_actions},
+         f"{len(stored_actions)} stored vs {len(set(confirmed_actions))} confirmed"),
+    ]
+
+
+# --- التقرير ---
+def _percentile(sorted_values, fraction):
+    if not sorted_values: return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))] * 1000, 2)
+
+
+def build_report(merged, duration, invariants):
+    report = {"duration_seconds": duration, "operations": {}, "lock_errors": merged["lock_errors"]}
+    for operation, stats in sorted(merged["operations"].items()):
+        latencies = sorted(stats["latencies"])
+        report["operations"][operation] = {
+            "requests": len(latencies), "per_second": round(len(latencies) / duration, 1), "statuses": stats["statuses"],
+            "latency_ms": {"p50": _percentile(latencies, 0.50), "p95": _percentile(latencies, 0.95),
+                           "p99": _percentile(latencies, 0.99), "max": _percentile(latencies, 1.0)}}
+    for key in ("write_seconds", "commit_seconds"):
+        values = sorted(merged[key])
+        report[key.replace("_seconds", "_wait")] = {
+            "count": len(values), "total_seconds": round(sum(values), 3),
+            "p95_ms": _percentile(values, 0.95), "max_ms": _percentile(values, 1.0)}
+    report["invariants"] = [{"name": name, "ok": ok, **({} if ok else {"detail": detail})} for name, ok, detail in invariants]
+    report["ok"] = all(ok for _, ok, _ in invariants)
+    return report
+
+
+def print_report(report):
+    print(f"\n{'operation':<10} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>9}  statuses")
+    for operation, stats in report["operations"].items():
+        latency = stats["latency_ms"]
+        print(f"{operation:<10} {stats['requests']:>9} {stats['per_second']:>8} {latency['p50']:>8} {latency['p95']:>8} "
+              f"{latency['p99']:>8} {latency['max']:>9}  {stats['statuses']}")
+    for key, label in (("write_wait", "write statements"), ("commit_wait", "commits")):
+        wait = report[key]
+        print(f"Time in {label}: {wait['total_seconds']}s over {wait['count']} (p95 {wait['p95_ms']} ms, max {wait['max_ms']} ms)")
+    print(f"'database is locked' errors: {report['lock_errors']}")
+    print()
+    for invariant in report["invariants"]:
+        print(f"[{'PASS' if invariant['ok'] else 'FAIL'}] {invariant['name']}" + (f": {invariant['detail']}" if not invariant['ok'] else ""))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent write benchmark for coin and click paths with invariant checks.")
+    parser.add_argument('--processes', type=int, default=2, help="worker processes (default 2)")
+    parser.add_argument('--threads', type=int, default=8, help="threads per process (default 8)")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of load (default 10)")
+    parser.add_argument('--users', type=int, default=50, help="fixture users (default 50; fewer = more contention)")
+    parser.add_argument('--ads', type=int, default=20, help="fixture advertisements (default 20)")
+    parser.add_argument('--mix', type=_parse_mix, default=_parse_mix("click=4,analyze=2,update=1"),
+                        help="operation weights (default click=4,analyze=2,update=1)")
+    parser.add_argument('--verifier-latency', type=float, default=0.0, help="seconds the stub verifier sleeps per call")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', help="SQLite file to create (default: a new temporary file)")
+    parser.add_argument('--keep-db', action='store_true', help="do not delete the database afterwards")
+    parser.add_argument('--json', dest='json_output', action='store_true', help="print the report as JSON")
+    args = parser.parse_args(argv)
+    if args.users < 2 or args.ads < 1: parser.error("need at least 2 users and 1 advertisement")
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='bench-contention-'), 'bench.db')
+    if os.path.exists(db_path): parser.error(f"{db_path} already exists; the benchmark needs a fresh database")
+    os.environ['DATABASE_PATH'] = db_path # قبل استيراد app هنا وفي العمليات (spawn ترث البيئة)
+    options = {"mix": args.mix, "threads": args.threads, "duration": args.duration,
+               "verifier_latency": args.verifier_latency, "seed": args.seed}
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            user_ids, ad_ids = create_fixtures(args.users, args.ads)
+        print(f"Benchmarking {args.processes} processes x {args.threads} threads for {args.duration}s "
+              f"on {len(user_ids)} users / {len(ad_ids)} ads ({db_path}).", file=sys.stderr)
+        context = multiprocessing.get_context('spawn')
+        results_queue = context.Queue()
+        start_at = time.time() + 3.0 + args.processes # وقت استيراد app في كل عملية
+        processes = [context.Process(target=worker_process, args=(index, options, user_ids, ad_ids, start_at, results_queue))
+                     for index in range(args.processes)]
+        for process in processes: process.start()
+        partials = [results_queue.get() for _ in processes]
+        for process in processes: process.join()
+
+        merged = {"operations": {}, "clicks": [], "actions": [], "awards": [], "lock_errors": 0,
+                  "write_seconds": [], "commit_seconds": []}
+        for partial in partials:
+            for key in ("clicks", "actions", "awards", "write_seconds", "commit_seconds"): merged[key].extend(partial[key])
+            merged["lock_errors"] += partial["lock_errors"]
+            for operation, stats in partial["operations"].items():
+                target = merged["operations"].setdefault(operation, {"latencies": [], "statuses": {}})
+                target["latencies"].extend(stats["latencies"])
+                for status, count in stats["statuses"].items():
+                    target["statuses"][status] = target["statuses"].get(status, 0) + count
+        report = build_report(merged, args.duration, check_invariants(user_ids, ad_ids, merged))
+    finally:
+        if not args.keep_db:
+            for suffix in ('', '-journal', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix): os.remove(db_path + suffix)
+    if args.json_output: print(json.dumps(report, indent=2))
+    else: print_report(report)
+    return 0 if report["ok"] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
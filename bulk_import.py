@@ -0,0 +1,467 @@
+"""
+استيراد جماعي للمستخدمين والإعلانات والإجراءات التاريخية من CSV أو NDJSON (بيانات الشركاء).
+
+بدل طلب /register أو /add_advertisement لكل سجل (hash بطيء و commit لكل صف): يُقرأ المصدر كتيار،
+ويُتحقق منه على دفعات، ويُدرج بـ executemany في معاملة واحدة لكل دفعة. كلمات المرور تُحسب على
+مجموعة عمليات (ProcessPoolExecutor). التقدم محفوظ في جدول import_job في نفس معاملة كل دفعة،
+فإعادة تشغيل نفس الأمر بعد أي انقطاع تكمل من أول سجل لم يُثبت.
+
+الحقول:
+    users:   name, email, phone_number, password | password_hash, [id, coins, interests]
+    ads:     user_id, title, link, coin_per_click, [id, description, category, subcategory, interests,
+             is_approved, created_at, starts_at, ends_at]
+    actions: user_id, advertisement_id, action_type, [created_at]
+interests في CSV: مصفوفة JSON أو قيم مفصولة بـ '|'. التواريخ ISO-8601 (بدون منطقة زمنية = UTC).
+
+أمثلة:
+    python bulk_import.py users partner_users.csv --workers 8
+    python bulk_import.py ads partner_ads.ndjson --rejects /tmp/ads.rejects.jsonl
+    python bulk_import.py actions actions.csv --defer-indexes   # قاعدة بيانات لا يخدمها التطبيق أثناء الاستيراد
+    python bulk_import.py users partner_users.csv --restart      # يتجاهل التقدم المحفوظ
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from werkzeug.security import generate_password_hash
+
+from app import (app, db, ImportJob, ACTION_TYPE_CODES, COIN_VALUES, normalize_search_text, normalize_phone,
+                 parse_ad_schedule, bump_catalog_version)
+
+DEFAULT_CHUNK_SIZE = 5000
+_REQUIRED = object()
+
+ARCHIVED_ACTION_TYPES = ' '.join(f"WHEN {code} THEN '{action_type}'" for action_type, code in ACTION_TYPE_CODES.items())
+
+USER_EARNINGS_BULK_UPSERT_SQL = """
+    INSERT INTO user_earnings (user_id, source, count, coins) VALUES (:user_id, :source, :count, :coins)
+    ON CONFLICT (user_id, source) DO UPDATE SET count = count + excluded.count, coins = coins + excluded.coins
+"""
+
+
+class RecordError(ValueError):
+    """سجل غير صالح: يُكتب في ملف المرفوضات ويستمر الاستيراد."""
+
+
+# --- قراءة المصدر ---
+def detect_format(path, fmt):
+    if fmt: return fmt
+    return 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+
+def read_records(path, fmt):
+    """يولد (رقم السجل، dict | None، خطأ | None) بدون تحميل الملف كله؛ الترقيم ثابت بين التشغيلات (للاستئناف)."""
+    with open(path, newline='', encoding='utf-8-sig') as source:
+        if fmt == 'csv':
+            for number, row in enumerate(csv.DictReader(source), 1):
+                yield number, {key: (value if value != '' else None) for key, value in row.items() if key}, None
+            return
+        number = 0
+        for line in source:
+            line = line.strip()
+            if not line: continue
+            number += 1
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield number, None, f"invalid JSON: {e}"
+                continue
+            if not isinstance(record, dict):
+                yield number, None, "record must be a JSON object"
+                continue
+            yield number, record, None
+
+
+# --- التحقق من الحقول ---
+def _string(record, field, default=_REQUIRED):
+    value = record.get(field)
+    if isinstance(value, str): value = value.strip() or None
+    if value is None:
+        if default is _REQUIRED: raise RecordError(f"missing '{field}'")
+        return default
+    if not isinstance(value, str): raise RecordError(f"'{field}' must be a string")
+    return value
+
+
+def _integer(record, field, default=_REQUIRED, minimum=0):
+    value = record.get(field)
+    if value is None:
+        if default is _REQUIRED: raise RecordError(f"missing '{field}'")
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, str)): raise RecordError(f"'{field}' must be an integer")
+    try:
+        value = int(value)
+    except ValueError:
+        raise RecordError(f"'{field}' must be an integer")
+    if minimum is not None and value < minimum: raise RecordError(f"'{field}' must be >= {minimum}")
+    return value
+
+
+def _boolean(record, field, default):
+    value = record.get(field)
+    if value is None: return default
+    if isinstance(value, bool): return value
+    if isinstance(value, str) and value.strip().lower() in ('1', 'true', 'yes'): return True
+    if isinstance(value, str) and value.strip().lower() in ('0', 'false', 'no'): return False
+    raise RecordError(f"'{field}' must be a boolean")
+
+
+def _datetime(record, field, default):
+    value = record.get(field)
+    if value is None: return default
+    try:
+        value = datetime.fromisoformat(value) if isinstance(value, str) else None
+    except ValueError:
+        value = None
+    if value is None: raise RecordError(f"'{field}' must be an ISO-8601 datetime")
+    if value.tzinfo is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    return value
+
+
+def _interests(record):
+    """نفس تخزين set_interests: None => NULL، وإلا مصفوفة JSON من النصوص."""
+    value = record.get('interests')
+    if value is None: return None
+    if isinstance(value, str):
+        if value.lstrip().startswith('['):
+            try:
+                value = json.loads(value)
+            except json.JSONDecodeError:
+                raise RecordError("'interests' is not a valid JSON array")
+        else:
+            value = [item.strip() for item in value.split('|') if item.strip()]
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise RecordError("'interests' must be a list of strings")
+    return json.dumps(value)
+
+
+def _existing_ids(sql, ids):
+    if not ids: return set()
+    statement = db.text(sql).bindparams(db.bindparam('ids', expanding=True))
+    return {row[0] for row in db.session.execute(statement, {"ids": sorted(ids)})}
+
+
+# --- المستوردات (نوع لكل جدول) ---
+class UsersImporter:
+    table, fts_table = 'user', 'user_search_fts'
+    insert_sql = db.text("""
+        INSERT OR IGNORE INTO user (id, name, email, phone_number, search_name, search_email, search_phone,
+                                    password_hash, interests, coins, referred_by_me_ids)
+        VALUES (:id, :name, :email, :phone_number, :search_name, :search_email, :search_phone,
+                :password_hash, :interests, :coins, '[]')
+    """)
+
+    def __init__(self, pool, workers):
+        self.pool = pool
+        self.workers = workers
+
+    def validate(self, record):
+        name = _string(record, 'name')
+        email = _string(record, 'email')
+        phone_number = _string(record, 'phone_number')
+        password_hash = _string(record, 'password_hash', None)
+        password = None if password_hash else _string(record, 'password')
+        return {"id": _integer(record, 'id', None, minimum=1), "name": name, "email": email,
+                "phone_number": phone_number, "search_name": normalize_search_text(name),
+                "search_email": normalize_search_text(email), "search_phone": normalize_phone(phone_number),
+                "password": password, "password_hash": password_hash, "interests": _interests(record),
+                "coins": _integer(record, 'coins', 0)}
+
+    def insert(self, rows):
+        """يعيد (inserted, duplicates, [(number, error)])."""
+        existing = _existing_ids("SELECT email FROM user WHERE email IN :ids", {params["email"] for _, params in rows})
+        fresh, seen = [], set()
+        for number, params in rows:
+            if params["email"] in existing or params["email"] in seen: continue # لا تُحسب hash لمكرر
+            seen.add(params["email"])
+            fresh.append(params)
+        pending = [params for params in fresh if params["password_hash"] is None]
+        hashes = self._hash_passwords([params["password"] for params in pending])
+        for params, password_hash in zip(pending, hashes):
+            params["password_hash"] = password_hash
+        for params in fresh:
+            del params["password"]
+        if fresh:
+            inserted = db.session.execute(self.insert_sql, fresh).rowcount # OR IGNORE: تعارض id موجود
+        else:
+            inserted = 0
+        return inserted, len(rows) - inserted, []
+
+    def _hash_passwords(self, passwords):
+        if not passwords: return []
+        if self.pool is None: return [generate_password_hash(password) for password in passwords]
+        return list(self.pool.map(generate_password_hash, passwords,
+                                  chunksize=max(1, len(passwords) // (self.workers * 4))))
+
+    def after_chunk(self):
+        pass
+
+
+class AdsImporter:
+    table, fts_table = 'advertisement', 'advertisement_fts'
+    insert_sql = db.text("""
+        INSERT OR IGNORE INTO advertisement (id, user_id, title, description, link, interests, number_of_clicks,
+            coin_per_click, category, subcategory, created_at, updated_at, is_active, is_approved,
+            clicked_by_user_ids, starts_at, ends_at)
+        VALUES (:id, :user_id, :title, :description, :link, :interests, 0, :coin_per_click, :category, :subcategory,
+                :created_at, :updated_at, :is_active, :is_approved, '[]', :starts_at, :ends_at)
+    """).bindparams(*(db.bindparam(name, type_=db.DateTime) for name in ('created_at', 'updated_at', 'starts_at', 'ends_at')))
+
+    def __init__(self, pool, workers):
+        self.now = datetime.utcnow()
+
+    def validate(self, record):
+        schedule = {field: record[field] for field in ('starts_at', 'ends_at') if record.get(field) is not None}
+        starts_at, ends_at, schedule_error = parse_ad_schedule(schedule)
+        if schedule_error: raise RecordError(schedule_error)
+        return {"id": _integer(record, 'id', None, minimum=1), "user_id": _integer(record, 'user_id', minimum=1),
+                "title": _string(record, 'title'), "link": _string(record, 'link'),
+                "description": _string(record, 'description', None), "interests": _interests(record),
+                "coin_per_click": _integer(record, 'coin_per_click'),
+                "category": _string(record, 'category', None),
+                "subcategory": _string(record, 'subcategory', None),
+                "created_at": _datetime(record, 'created_at', self.now), "updated_at": self.now,
+                "is_active": (starts_at is None or starts_at <= self.now) and (ends_at is None or ends_at > self.now),
+                "is_approved": _boolean(record, 'is_approved', False), "starts_at": starts_at, "ends_at": ends_at}
+
+    def insert(self, rows):
+        users = _existing_ids("SELECT id FROM user WHERE id IN :ids", {params["user_id"] for _, params in rows})
+        rejects = [(number, f"user_id {params['user_id']} not found") for number, params in rows if params["user_id"] not in users]
+        valid = [params for _, params in rows if params["user_id"] in users]
+        inserted = db.session.execute(self.insert_sql, valid).rowcount if valid else 0
+        if inserted:
+            # SQLite قد يعيد استخدام id إعلان حذفه المنظف؛ الإعلان الجديد يلغي شاهد الحذف القديم (كما في /add_advertisement)
+            db.session.execute(db.text(
+                "DELETE FROM advertisement_tombstone WHERE advertisement_id IN "
+                "(SELECT a.id FROM advertisement a JOIN advertisement_tombstone t ON t.advertisement_id = a.id "
+                "WHERE a.deleted_at IS NULL)"))
+            bump_catalog_version()
+        return inserted, len(valid) - inserted, rejects
+
+    def after_chunk(self):
+        self.now = datetime.utcnow()
+
+
+class ActionsImporter:
+    table, fts_table = 'user_ad_action', None
+    insert_sql = db.text(
+        "INSERT INTO user_ad_action (user_id, advertisement_id, action_type, created_at) "
+        "VALUES (:user_id, :advertisement_id, :action_type, :created_at)"
+    ).bindparams(db.bindparam('created_at', type_=db.DateTime))
+
+    def __init__(self, pool, workers):
+        self.now = datetime.utcnow()
+
+    def validate(self, record):
+        action_type = _string(record, 'action_type')
+        if action_type not in COIN_VALUES:
+            raise RecordError(f"'action_type' must be one of {sorted(COIN_VALUES)}")
+        return {"user_id": _integer(record, 'user_id', minimum=1),
+                "advertisement_id": _integer(record, 'advertisement_id', minimum=1),
+                "action_type": action_type, "created_at": _datetime(record, 'created_at', self.now)}
+
+    def insert(self, rows):
+        user_ids = {params["user_id"] for _, params in rows}
+        ad_ids = {params["advertisement_id"] for _, params in rows}
+        users = _existing_ids("SELECT id FROM user WHERE id IN :ids", user_ids)
+        ads = _existing_ids("SELECT id FROM advertisement WHERE id IN :ids AND deleted_at IS NULL", ad_ids)
+        # الإجراءات الموجودة في الجدول الساخن والأرشيف (uq_user_ad_action يشمل الاثنين)
+        statement = db.text("""
+            SELECT user_id, advertisement_id, action_type FROM user_ad_action
+            WHERE user_id IN :user_ids AND advertisement_id IN :ad_ids
+            UNION ALL
+            SELECT user_id, advertisement_id, CASE action_code {ARCHIVED_ACTION_TYPES} END
+            FROM user_ad_action_archive WHERE user_id IN :user_ids AND advertisement_id IN :ad_ids
+        """.format(ARCHIVED_ACTION_TYPES=ARCHIVED_ACTION_TYPES)).bindparams(db.bindparam('user_ids', expanding=True), db.bindparam('ad_ids', expanding=True))
+        seen = set(db.session.execute(statement, {"user_ids": sorted(users) or [0], "ad_ids": sorted(ads) or [0]}).all())
+        fresh, rejects, earnings = [], [], {}
+        for number, params in rows:
+            if params["user_id"] not in users:
+                rejects.append((number, f"user_id {params['user_id']} not found"))
+                continue
+            if params["advertisement_id"] not in ads:
+                rejects.append((number, f"advertisement_id {params['advertisement_id']} not found"))
+                continue
+            key = (params["user_id"], params["advertisement_id"], params["action_type"])
+            if key in seen: continue
+            seen.add(key)
+            fresh.append(params)
+            summary = earnings.setdefault((params["user_id"], params["action_type"]), [0, 0])
+            summary[0] += 1
+            summary[1] += COIN_VALUES[params["action_type"]]
+        if fresh:
+            db.session.execute(self.insert_sql, fresh)
+            # ملخص الأرباح كما في migration 6 (الرصيد نفسه يأتي من بيانات المستخدمين المستوردة)
+            db.session.execute(db.text(USER_EARNINGS_BULK_UPSERT_SQL), [
+                {"user_id": user_id, "source": source, "count": count, "coins": coins}
+                for (user_id, source), (count, coins) in earnings.items()])
+        return len(fresh), len(rows) - len(rejects) - len(fresh), rejects
+
+    def after_chunk(self):
+        self.now = datetime.utcnow()
+
+
+IMPORTERS = {"users": UsersImporter, "ads": AdsImporter, "actions": ActionsImporter}
+
+
+# --- الفهارس المؤجلة (--defer-indexes) ---
+def defer_indexes(job, importer):
+    """
+    يسقط الفهارس الثانوية غير الفريدة و trigger الإضافة لفهرس FTS على الجدول الهدف، ويحفظ تعريفاتها في job
+    (في نفس المعاملة) حتى يعيد restore_indexes بناءها مرة واحدة في النهاية، حتى بعد استئناف.
+    الفهارس الفريدة تبقى: عليها يعتمد كشف المكرر.
+    """
+    if job.deferred_ddl: return
+    objects = db.session.execute(db.text(
+        "SELECT type, name, sql FROM sqlite_master WHERE tbl_name = :table AND sql IS NOT NULL AND "
+        "((type = 'index' AND sql NOT LIKE 'CREATE UNIQUE%') OR (type = 'trigger' AND name = :fts_trigger)) "
+        "ORDER BY type, name"
+    ), {"table": importer.table, "fts_trigger": f"{importer.fts_table}_ai"}).all()
+    for object_type, name, _ in objects:
+        db.session.execute(db.text(f'DROP {object_type.upper()} IF EXISTS "{name}"'))
+    job.deferred_ddl = json.dumps({"fts_table": importer.fts_table,
+                                   "objects": [{"type": t, "name": n, "sql": s} for t, n, s in objects]})
+    db.session.commit()
+    print(f"Deferred {len(objects)} indexes/triggers on {importer.table} until the import finishes.", file=sys.stderr)
+
+
+def restore_indexes(job):
+    if not job.deferred_ddl: return
+    started = time.monotonic()
+    deferred = json.loads(job.deferred_ddl)
+    existing = {row[0] for row in db.session.execute(db.text("SELECT name FROM sqlite_master")).all()}
+    for entry in deferred["objects"]:
+        if entry["name"] not in existing: db.session.execute(db.text(entry["sql"]))
+    fts_table = deferred["fts_table"]
+    if fts_table: db.session.execute(db.text(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')"))
+    job.deferred_ddl = None
+    db.session.commit()
+    print(f"Rebuilt {len(deferred['objects'])} indexes/triggers in {time.monotonic() - started:.1f}s.", file=sys.stderr)
+
+
+# --- الحلقة الرئيسية ---
+def _load_job(name, kind, source, restart):
+    job = db.session.get(ImportJob, name)
+    if job is None:
+        job = ImportJob(name=name, kind=kind, source=source)
+        db.session.add(job)
+    elif job.kind != kind or job.source != source:
+        raise SystemExit(f"Job '{name}' belongs to '{job.kind}' import of {job.source}; use another --job name.")
+    elif restart:
+        job.records_done, job.inserted, job.duplicates, job.rejected, job.finished_at = 0, 0, 0, 0, None
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+    return job
+
+
+class Progress:
+    def __init__(self, kind, job):
+        self.kind = kind
+        self.started = time.monotonic()
+        self.records_at_start = job.records_done
+
+    def report(self, job, chunk_records, chunk_seconds, final=False):
+        processed = job.records_done - self.records_at_start
+        elapsed = time.monotonic() - self.started
+        rate = processed / elapsed if elapsed else 0.0
+        line = (f"[{self.kind}] {job.records_done} records: inserted={job.inserted} duplicates={job.duplicates} "
+                f"rejected={job.rejected}  {rate:,.0f} rec/s")
+        if final: line += f"  total {elapsed:.1f}s"
+        elif chunk_seconds: line += f" (last chunk {chunk_records / chunk_seconds:,.0f} rec/s)"
+        print(line, file=sys.stderr)
+
+
+def run_import(importer, records, job, chunk_size, rejects_file):
+    progress = Progress(job.kind, job)
+    records = itertools.dropwhile(lambda item: item[0] <= job.records_done, records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk: break
+        started = time.monotonic()
+        rows, rejects = [], []
+        for number, record, error in chunk:
+            if error is None:
+                try:
+                    rows.append((number, importer.validate(record)))
+                    continue
+                except RecordError as e:
+                    error = str(e)
+            rejects.append((number, error))
+        try:
+            inserted, duplicates, insert_rejects = importer.insert(rows) if rows else (0, 0, [])
+            rejects.extend(insert_rejects)
+            job.records_done = chunk[-1][0]
+            job.inserted += inserted
+            job.duplicates += duplicates
+            job.rejected += len(rejects)
+            job.updated_at = datetime.utcnow()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            print(f"Import failed in records {chunk[0][0]}-{chunk[-1][0]}; re-run the same command to resume "
+                  f"after record {job.records_done}.", file=sys.stderr)
+            raise
+        importer.after_chunk()
+        if rejects_file:
+            for number, error in sorted(rejects):
+                rejects_file.write(json.dumps({"record": number, "error": error}) + "\n")
+            rejects_file.flush()
+        progress.report(job, len(chunk), time.monotonic() - started)
+    return progress
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-import users, advertisements or historical actions from CSV/NDJSON.")
+    parser.add_argument('kind', choices=sorted(IMPORTERS))
+    parser.add_argument('path', help="CSV or NDJSON file")
+    parser.add_argument('--format', choices=('csv', 'ndjson'), help="default: from the file extension (.csv => csv)")
+    parser.add_argument('--job', help="progress key in import_job (default: <kind>:<absolute path>)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help=f"records per transaction (default {DEFAULT_CHUNK_SIZE})")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="password hashing processes (default: CPU count)")
+    parser.add_argument('--rejects', help="append rejected records (number + error) to this JSONL file")
+    parser.add_argument('--defer-indexes', action='store_true',
+                        help="drop secondary indexes of the target table during the load; only for a database the app is not serving")
+    parser.add_argument('--restart', action='store_true', help="ignore saved progress and start from the first record")
+    args = parser.parse_args(argv)
+    if args.chunk_size < 1: parser.error("--chunk-size must be positive")
+    if not os.path.exists(args.path): parser.error(f"{args.path} does not exist")
+
+    source = os.path.abspath(args.path)
+    pool = ProcessPoolExecutor(max_workers=args.workers) if args.kind == 'users' and args.workers > 1 else None
+    rejects_file = open(args.rejects, 'a') if args.rejects else None
+    try:
+        with app.app_context():
+            job = _load_job(args.job or f"{args.kind}:{source}", args.kind, source, args.restart)
+            if job.finished_at is not None and not job.deferred_ddl:
+                print(f"Job '{job.name}' already finished at {job.finished_at.isoformat()}; use --restart to import again.",
+                      file=sys.stderr)
+                return 0
+            if job.records_done: print(f"Resuming after record {job.records_done}.", file=sys.stderr)
+            importer = IMPORTERS[args.kind](pool, args.workers)
+            if args.defer_indexes: defer_indexes(job, importer)
+            try:
+                progress = run_import(importer, read_records(args.path, detect_format(args.path, args.format)),
+                                      job, args.chunk_size, rejects_file)
+            except KeyboardInterrupt:
+                db.session.rollback()
+                print(f"\nInterrupted after record {job.records_done}; re-run the same command to resume.", file=sys.stderr)
+                return 130
+            restore_indexes(job)
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            progress.report(job, 0, 0, final=True)
+    finally:
+        if pool: pool.shutdown()
+        if rejects_file: rejects_file.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
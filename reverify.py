@@ -0,0 +1,306 @@
+"""
+إعادة التحقق دفعةً واحدة من لقطات الشاشة المخزنة (VerificationRecord + ScreenshotStore).
+
+يعيد تشغيل القرارات السابقة عبر البرومبتات والنماذج الحالية لقياس أثر تغيير
+LIKE_DETECTION_PROMPT وغيره أو تغيير النموذج، ويطبع مصفوفة اتفاق (القرار المسجل × القرار الجديد)
+مع إحصاءات زمن الاستجابة والتكلفة.
+
+أمثلة:
+    python reverify.py --action-type like --since 2026-01-01 --workers 8 --rate 5
+    python reverify.py --checkpoint /tmp/reverify.jsonl          # يستأنف من حيث توقف
+    python reverify.py --stub --stub-agreement 0.9 --limit 200   # بدون Gemini (للاختبار)
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+from app import (app, ANALYZE_ROUTES, CONFIDENCE_PROMPT_SUFFIX, ScreenshotBlob, VerificationRecord, screenshot_store,
+                 _build_model_request, _decode_image, _parse_model_response, _verification_tiers)
+
+PROMPTS_BY_ACTION = {action_type: prompt for action_type, prompt in ANALYZE_ROUTES.values()}
+OUTCOMES = ("1", "0", "error", "missing")
+RECORD_BATCH_SIZE = 500
+
+
+class RateLimiter:
+    """Token bucket مشترك بين الخيوط: rate طلب/ثانية كحد أقصى لاستدعاءات النموذج."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval: return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now: time.sleep(slot - now)
+
+
+class _StubResponse:
+    def __init__(self, text):
+        self.text = text
+        self.parts = [text]
+        self.usage_metadata = None
+
+
+class StubVerifier:
+    """
+    بديل لـ Gemini: يوافق القرار المسجل باحتمال agreement (حتمي لكل سجل)، مع تأخير latency ثانية.
+    """
+    model_name = 'stub'
+
+    def __init__(self, agreement=1.0, latency=0.0):
+        self.agreement = agreement
+        self.latency = latency
+
+    def verdict_for(self, record):
+        agrees = random.Random(record["id"]).random() < self.agreement
+        verdict = record["verdict"] if agrees else 1 - record["verdict"]
+        if self.latency: time.sleep(self.latency)
+        return _StubResponse(f"{verdict} 99")
+
+
+def _load_records(action_types, since, until, done_ids, limit):
+    """يولد السجلات على دفعات (keyset على id) حتى لا تُحمل كلها في الذاكرة."""
+    last_id, yielded = 0, 0
+    while True:
+        with app.app_context():
+            query = VerificationRecord.query.filter(VerificationRecord.id > last_id)
+            if action_types: query = query.filter(VerificationRecord.action_type.in_(action_types))
+            if since: query = query.filter(VerificationRecord.created_at >= since)
+            if until: query = query.filter(VerificationRecord.created_at < until)
+            batch = query.order_by(VerificationRecord.id).limit(RECORD_BATCH_SIZE).all()
+            rows = [dict(record.to_dict(), prompt_params=json.loads(record.prompt_params) if record.prompt_params else {})
+                    for record in batch]
+        if not rows: return
+        for row in rows:
+            last_id = row["id"]
+            if row["id"] in done_ids: continue
+            if limit is not None and yielded >= limit: return
+            yielded += 1
+            yield row
+
+
+def _load_payloads(record):
+    """يعيد [(kind, bytes)] كما يبنيها _read_and_hash_image، أو None إذا أُخلي أحد الملفات."""
+    with app.app_context():
+        blobs = {blob.sha256: blob for blob in ScreenshotBlob.query.filter(ScreenshotBlob.sha256.in_(record["image_hashes"]))}
+    payloads = []
+    for sha256_hex in record["image_hashes"]:
+        mapped = screenshot_store.open(sha256_hex)
+        if mapped is None or sha256_hex not in blobs: return None
+        try:
+            data = bytes(mapped)
+        finally:
+            if hasattr(mapped, 'close'): mapped.close()
+        media_type = blobs[sha256_hex].media_type or ''
+        kind = 'video:' + media_type.split('/', 1)[1] if media_type.startswith('video/') else 'image'
+        payloads.append((kind, data))
+    return payloads
+
+
+def _empty_result(record):
+    return {"id": record["id"], "action_type": record["action_type"], "recorded": str(record["verdict"]),
+            "new": "error", "verified_by": None, "confidence": None, "latency": 0.0,
+            "calls": {}, "input_tokens": 0, "output_tokens": 0}
+
+
+def _verify_record_safely(record, limiter, stub):
+    """خطأ في سجل واحد (ملف تالف أو غير مقروء...) يُحسب خلية error ولا يوقف التشغيل القابل للاستئناف."""
+    try:
+        return _verify_record(record, limiter, stub)
+    except Exception as e:
+        app.logger.warning(f"Reverify record {record['id']}: {type(e).__name__}: {e}")
+        return dict(_empty_result(record), error=f"{type(e).__name__}: {e}")
+
+
+def _verify_record(record, limiter, stub):
+    """يعيد dict نتيجة سجل واحد (تُكتب كما هي في ملف الاستئناف)."""
+    result = _empty_result(record)
+    if not record["image_hashes"]:
+        result["new"] = "missing"
+        return result
+    payloads = _load_payloads(record)
+    if payloads is None:
+        result["new"] = "missing"
+        return result
+
+    ctx = {"user_id": record["user_id"], "advertisement_id": record["advertisement_id"],
+           "action_type": record["action_type"], "img_hashes": record["image_hashes"],
+           "img_hash": record["image_hashes"][0]}
+    with app.app_context():
+        images, error_response = _decode_image(ctx, payloads)
+        if error_response: return result
+        prompt = PROMPTS_BY_ACTION[record["action_type"]]
+        if record["action_type"] == "comment":
+            prompt = prompt.format(username=record["prompt_params"].get("username", ""))
+        request_parts = _build_model_request(prompt + CONFIDENCE_PROMPT_SUFFIX, images)
+
+        tiers = [("stub", stub, None)] if stub else _verification_tiers(record["action_type"])
+        for tier_name, model, threshold in tiers:
+            limiter.acquire() # زمن الانتظار هنا لا يُحسب ضمن latency
+            result["calls"][tier_name] = result["calls"].get(tier_name, 0) + 1
+            started = time.monotonic()
+            try:
+                response = stub.verdict_for(record) if stub else model.generate_content(request_parts)
+            except Exception as e:
+                result["latency"] += time.monotonic() - started
+                app.logger.warning(f"Reverify record {record['id']}: {tier_name} tier error: {e}")
+                if threshold is None: break
+                continue
+            result["latency"] += time.monotonic() - started
+            usage = getattr(response, 'usage_metadata', None)
+            if usage is not None:
+                result["input_tokens"] += getattr(usage, 'prompt_token_count', 0) or 0
+                result["output_tokens"] += getattr(usage, 'candidates_token_count', 0) or 0
+            raw_result, error_response = _parse_model_response(ctx, response)
+            if threshold is not None and (error_response or ctx["confidence"] is None or ctx["confidence"] < threshold):
+                continue
+            if not error_response:
+                result["new"], result["verified_by"], result["confidence"] = raw_result, tier_name, ctx["confidence"]
+            break
+    return result
+
+
+def _read_checkpoint(path):
+    results = {}
+    if not path or not os.path.exists(path): return results
+    with open(path) as checkpoint:
+        for line in checkpoint:
+            line = line.strip()
+            if not line: continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue # سطر مبتور من تشغيل انقطع أثناء الكتابة
+            results[row["id"]] = row
+    return results
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values: return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))], 4)
+
+
+def build_report(results, input_price, output_price):
+    """مصفوفة الاتفاق لكل نوع إجراء + إحصاءات زمن الاستجابة والتكلفة."""
+    report = {"actions": {}, "total": len(results)}
+    latencies, calls, input_tokens, output_tokens = [], {}, 0, 0
+    for row in results:
+        action = report["actions"].setdefault(row["action_type"], {
+            "matrix": {recorded: {outcome: 0 for outcome in OUTCOMES} for recorded in ("1", "0")},
+            "compared": 0, "agreed": 0})
+        action["matrix"][row["recorded"]][row["new"]] += 1
+        if row["new"] in ("0", "1"):
+            action["compared"] += 1
+            action["agreed"] += row["new"] == row["recorded"]
+            latencies.append(row["latency"])
+        for tier_name, count in row["calls"].items():
+            calls[tier_name] = calls.get(tier_name, 0) + count
+        input_tokens += row["input_tokens"]
+        output_tokens += row["output_tokens"]
+    for action in report["actions"].values():
+        action["agreement"] = round(action["agreed"] / action["compared"], 4) if action["compared"] else None
+    latencies.sort()
+    report["latency_seconds"] = {
+        "mean": round(sum(latencies) / len(latencies), 4) if latencies else None,
+        "p50": _percentile(latencies, 0.50), "p95": _percentile(latencies, 0.95),
+        "max": round(latencies[-1], 4) if latencies else None}
+    report["cost"] = {
+        "model_calls": calls, "input_tokens": input_tokens, "output_tokens": output_tokens,
+        "estimated_usd": round((input_tokens * input_price + output_tokens * output_price) / 1_000_000, 4)}
+    return report
+
+
+def print_report(report):
+    print(f"\nRe-verified {report['total']} records.")
+    for action_type, action in sorted(report["actions"].items()):
+        print(f"\n[{action_type}] agreement: {action['agreement']} ({action['agreed']}/{action['compared']})")
+        print("  " + "recorded \\ new".rjust(16) + " " + " ".join(f"{outcome:>8}" for outcome in OUTCOMES))
+        for recorded in ("1", "0"):
+            print(f"  {recorded:>16} " + " ".join(f"{action['matrix'][recorded][outcome]:>8}" for outcome in OUTCOMES))
+    latency, cost = report["latency_seconds"], report["cost"]
+    print(f"\nLatency (s): mean={latency['mean']} p50={latency['p50']} p95={latency['p95']} max={latency['max']}")
+    print(f"Model calls: {cost['model_calls']}  tokens in/out: {cost['input_tokens']}/{cost['output_tokens']}  "
+          f"estimated cost: ${cost['estimated_usd']}")
+
+
+def _parse_date(value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid ISO date: {value!r}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay stored screenshots through the current verifier configuration.")
+    parser.add_argument('--action-type', action='append', choices=sorted(PROMPTS_BY_ACTION),
+                        help="may be repeated; default: all action types")
+    parser.add_argument('--since', type=_parse_date, help="ISO date/time (inclusive)")
+    parser.add_argument('--until', type=_parse_date, help="ISO date/time (exclusive)")
+    parser.add_argument('--limit', type=int, help="max records to verify in this run")
+    parser.add_argument('--workers', type=int, default=4, help="parallel verifications (default 4)")
+    parser.add_argument('--rate', type=float, default=2.0, help="max model calls per second, 0 = unlimited (default 2)")
+    parser.add_argument('--checkpoint', help="JSONL file of finished records; existing entries are skipped on resume")
+    parser.add_argument('--json', dest='json_output', action='store_true', help="print the report as JSON")
+    parser.add_argument('--input-price', type=float, default=0.0, help="USD per 1M input tokens")
+    parser.add_argument('--output-price', type=float, default=0.0, help="USD per 1M output tokens")
+    parser.add_argument('--stub', action='store_true', help="use a stub verifier instead of Gemini")
+    parser.add_argument('--stub-agreement', type=float, default=1.0, help="probability the stub agrees with the recorded verdict")
+    parser.add_argument('--stub-latency', type=float, default=0.0, help="seconds the stub sleeps per call")
+    args = parser.parse_args(argv)
+
+    stub = StubVerifier(args.stub_agreement, args.stub_latency) if args.stub else None
+    from app import gemini_model
+    if stub is None and gemini_model is None:
+        parser.error("Gemini is not configured (GOOGLE_API_KEY); use --stub to run without it.")
+
+    results = _read_checkpoint(args.checkpoint)
+    if results: print(f"Resuming: {len(results)} records already in {args.checkpoint}.", file=sys.stderr)
+    limiter = RateLimiter(args.rate)
+    checkpoint_file = open(args.checkpoint, 'a') if args.checkpoint else None
+    records = _load_records(args.action_type, args.since, args.until, set(results), args.limit)
+    completed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            pending = set()
+            for record in records:
+                pending.add(executor.submit(_verify_record_safely, record, limiter, stub))
+                if len(pending) >= args.workers * 2: # نافذة محدودة: لا تُقرأ كل الملفات مسبقًا
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    completed += _collect(done, results, checkpoint_file)
+            done, _ = wait(pending)
+            completed += _collect(done, results, checkpoint_file)
+    except KeyboardInterrupt:
+        print(f"\nInterrupted after {completed} records; re-run with the same --checkpoint to resume.", file=sys.stderr)
+        return 130
+    finally:
+        if checkpoint_file: checkpoint_file.close()
+
+    report = build_report(results.values(), args.input_price, args.output_price)
+    if args.json_output: print(json.dumps(report, indent=2))
+    else: print_report(report)
+    return 0
+
+
+def _collect(futures, results, checkpoint_file):
+    for future in futures:
+        row = future.result()
+        results[row["id"]] = row
+        if checkpoint_file:
+            checkpoint_file.write(json.dumps(row) + "\n")
+            checkpoint_file.flush()
+    return len(futures)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# app.py يقرأ DATABASE_PATH ويهيئ قاعدة البيانات عند الاستيراد: قاعدة مؤقتة لجلسة الاختبارات كلها
+_test_dir = tempfile.mkdtemp(prefix='app-tests-')
+os.environ['DATABASE_PATH'] = os.path.join(_test_dir, 'test.db')
+for _worker_flag in ('AD_PURGER_ENABLED', 'SCREENSHOT_STORE_ENABLED', 'ACTION_ARCHIVE_ENABLED', 'AD_SCHEDULE_ENABLED'):
+    os.environ[_worker_flag] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,17 @@
+import pytest
+
+from app import app, check_hot_query_plans, HOT_QUERY_PLANS
+
+
+@pytest.fixture(scope='module')
+def plans():
+    with app.app_context():
+        return {result["name"]: result for result in check_hot_query_plans()}
+
+
+@pytest.mark.parametrize('name', [name for name, _, _ in HOT_QUERY_PLANS])
+def test_hot_query_uses_index(plans, name):
+    result = plans[name]
+    assert any(result["expected_index"] in step for step in result["plan"]), \
+        f"{name} does not use {result['expected_index']}: {result['plan']}"
+    assert not any('USE TEMP B-TREE' in step for step in result["plan"]), f"{name} sorts in a temp B-tree: {result['plan']}"
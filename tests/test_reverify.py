@@ -0,0 +1,86 @@
+import hashlib
+import io
+import json
+import os
+
+import pytest
+from PIL import Image
+
+import reverify
+from app import app, db, screenshot_store, Advertisement, ScreenshotBlob, User, VerificationRecord
+
+
+def _png(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (20, 20), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def fixture_records(tmp_path, monkeypatch):
+    """3 سجلات سليمة، سجل ملفه أُخلي، وسجل ملفه غير مقروء (مجلد بدل ملف)."""
+    monkeypatch.setattr(screenshot_store, 'root', str(tmp_path / 'screenshots'))
+    with app.app_context():
+        user = User(name='reverify', email='reverify@example.com', password_hash='x', phone_number='1')
+        db.session.add(user)
+        db.session.flush()
+        ad = Advertisement(user_id=user.id, title='ad', link='http://example.com', coin_per_click=1)
+        db.session.add(ad)
+        db.session.flush()
+
+        def add_record(verdict, data, stored=True, unreadable=False):
+            sha256_hex = hashlib.sha256(data).hexdigest()
+            if unreadable:
+                os.makedirs(screenshot_store.path_for(sha256_hex))
+            elif stored:
+                screenshot_store.put(sha256_hex, data)
+            if stored or unreadable:
+                db.session.merge(ScreenshotBlob(sha256=sha256_hex, size_bytes=len(data), media_type='image/png', ref_count=1))
+            db.session.add(VerificationRecord(user_id=user.id, advertisement_id=ad.id, action_type='like',
+                                              verdict=verdict, image_hashes=json.dumps([sha256_hex])))
+
+        add_record(1, _png('red'))
+        add_record(1, _png('green'))
+        add_record(0, _png('blue'))
+        add_record(1, _png('white'), stored=False)
+        add_record(0, _png('black'), unreadable=True)
+        db.session.commit()
+    yield
+    with app.app_context():
+        VerificationRecord.query.delete()
+        ScreenshotBlob.query.delete()
+        Advertisement.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+
+def _run(capsys, *args):
+    assert reverify.main(['--stub', '--rate', '0', '--json', *args]) == 0
+    return json.loads(capsys.readouterr().out)
+
+
+def test_stub_agreement_matrix(fixture_records, capsys, tmp_path):
+    checkpoint = tmp_path / 'reverify.jsonl'
+    report = _run(capsys, '--checkpoint', str(checkpoint))
+
+    like = report['actions']['like']
+    assert report['total'] == 5
+    assert like['matrix'] == {
+        "1": {"1": 2, "0": 0, "error": 0, "missing": 1},
+        "0": {"1": 0, "0": 1, "error": 1, "missing": 0},
+    }
+    assert (like['agreed'], like['compared'], like['agreement']) == (3, 3, 1.0)
+    assert report['cost']['model_calls'] == {"stub": 3}
+    assert len(checkpoint.read_text().splitlines()) == 5
+
+    # الاستئناف: كل السجلات في ملف الاستئناف، فلا يُستدعى المُحقق مرة أخرى
+    resumed = _run(capsys, '--checkpoint', str(checkpoint))
+    assert resumed['actions']['like']['matrix'] == like['matrix']
+    assert len(checkpoint.read_text().splitlines()) == 5
+
+
+def test_stub_disagreement_is_counted(fixture_records, capsys):
+    report = _run(capsys, '--stub-agreement', '0')
+    like = report['actions']['like']
+    assert like['matrix']["1"]["0"] == 2 and like['matrix']["0"]["1"] == 1
+    assert like['agreement'] == 0.0
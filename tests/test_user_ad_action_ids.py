@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import (app, db, archive_user_ad_actions, interaction_index, Advertisement, User, UserAdAction,
+                 UserAdActionArchive, ACTION_ARCHIVE_AGE)
+
+
+@pytest.fixture
+def archived_user():
+    """مستخدم نُقل إجراءاه (أحدث صفوف user_ad_action) إلى الأرشيف، مع إعلان ثانٍ لم يتفاعل معه بعد."""
+    with app.app_context():
+        user = User(name='archived', email='archived@example.com', password_hash='x', phone_number='2')
+        db.session.add(user)
+        db.session.flush()
+        ads = [Advertisement(user_id=user.id, title=f'ad {i}', link='http://example.com', coin_per_click=1,
+                             is_approved=True, is_active=True) for i in range(2)]
+        db.session.add_all(ads)
+        db.session.flush()
+        old = datetime.utcnow() - ACTION_ARCHIVE_AGE - timedelta(days=1)
+        db.session.add_all([UserAdAction(user_id=user.id, advertisement_id=ads[0].id, action_type=action_type, created_at=old)
+                            for action_type in ('like', 'share')])
+        db.session.commit()
+        interaction_index.rebuild()
+        assert archive_user_ad_actions() == 2
+        assert db.session.query(UserAdAction).filter(UserAdAction.user_id == user.id).count() == 0
+        yield user.id, ads[1].id
+
+
+def test_new_action_after_archive_gets_fresh_id(archived_user):
+    user_id, ad_id = archived_user
+    archived_ids = set(db.session.scalars(db.select(UserAdActionArchive.id).where(UserAdActionArchive.user_id == user_id)))
+    action = UserAdAction(user_id=user_id, advertisement_id=ad_id, action_type='like')
+    db.session.add(action)
+    db.session.commit()
+    assert action.id > max(archived_ids)
+
+    interaction_index.sync(force=True)
+    assert interaction_index.social.get(user_id, 0) & (1 << interaction_index.slot_by_ad[ad_id])
+
+    response = app.test_client().get(f'/admin/user_ad_actions?user_id={user_id}')
+    assert response.status_code == 200
+    listed_ids = [row["id"] for row in response.get_json()["actions"]]
+    assert sorted(listed_ids) == sorted(archived_ids | {action.id})